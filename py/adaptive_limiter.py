@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import deque
+from logging import Logger
+from typing import Any, Callable, Deque, Dict, List
+
+from bitcoin_rpc import BitcoinRPCError, BitcoinRPCTransportError
+
+# the default max matches the default connection pool size of BitcoinRPC
+DEFAULT_MAX_LIMIT = 16
+
+# number of recent latency samples (per kind of request) the baseline is taken from
+LATENCY_SAMPLES = 200
+
+
+def is_overload_error(e: Exception) -> bool:
+    """
+    return True if the given exception means bitcoind is overloaded, i.e. its RPC
+    work queue is full. bitcoind answers such requests with HTTP 503
+    """
+    if isinstance(e, BitcoinRPCTransportError):
+        return e.status == 503
+    if isinstance(e, BitcoinRPCError):
+        return "work queue depth exceeded" in e.message.lower()
+    return False
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limit the number of in-flight requests to bitcoind, and tune that limit from
+    the observed latency and errors, AIMD-style (as TCP congestion control does):
+    
+    - every `limit` successful requests raise the limit by 1 (additive increase)
+    - an overload error (see is_overload_error), or a latency much higher than the
+      lowest recent latency for that kind of request, multiplies the limit by
+      backoff_factor (multiplicative decrease). requests that were already in
+      flight when the limit was decreased don't decrease it again
+    
+    Requests are made through `run`, from any number of threads. Threads beyond the
+    limit wait until a request completes, so an executor may have max_limit workers
+    and let the limiter decide how many of them actually query bitcoind.
+    
+    If a logger is given, the limit and the throughput are logged every
+    report_interval seconds. the reports are also kept in `history`
+    """
+    
+    def __init__(
+        self,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = DEFAULT_MAX_LIMIT,
+        backoff_factor: float = 0.5,
+        latency_tolerance: float = 3.0,
+        overload_retries: int = 8,
+        overload_sleep: float = 0.5,
+        report_interval: float = 60,
+        logger: Logger = None,
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.overload_retries = overload_retries
+        self.overload_sleep = overload_sleep
+        self.report_interval = report_interval
+        self.logger = logger
+        
+        self.limit: float = max(min_limit, min(initial_limit, max_limit))
+        self.in_flight = 0
+        self.completed = 0  # in calls. a batch counts as all of its calls
+        self.overloads = 0
+        self.history: List[Dict[str, float]] = []
+        
+        self.__cond = threading.Condition()
+        self.__latencies: Dict[str, Deque[float]] = {}
+        # completions since the last decrease. the limit is not decreased again
+        # before the requests that were in flight at that time completed
+        self.__since_decrease = 0
+        self.__in_flight_at_decrease = 0
+        self.__report_time = time.time()
+        self.__report_completed = 0
+    
+    def acquire(self) -> None:
+        with self.__cond:
+            while self.in_flight >= int(self.limit):
+                self.__cond.wait()
+            self.in_flight += 1
+    
+    def release(self, kind: str = "", latency: float = None, cost: int = 1, overloaded: bool = False) -> None:
+        """
+        mark a request as done.
+        
+        kind: the kind of request (e.g. the method). latencies are compared only with
+              latencies of the same kind
+        latency: the time the request took, or None if it failed
+        cost: the number of calls in the request
+        overloaded: True if the request failed since bitcoind is overloaded
+        """
+        with self.__cond:
+            self.in_flight -= 1
+            self.__since_decrease += 1
+            if overloaded:
+                self.overloads += 1
+                self.__decrease()
+            elif latency is not None:
+                self.completed += cost
+                samples = self.__latencies.setdefault(kind, deque(maxlen=LATENCY_SAMPLES))
+                normalized = latency / cost
+                baseline = min(samples) if samples else normalized
+                samples.append(normalized)
+                if normalized > self.latency_tolerance * baseline:
+                    self.__decrease()
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.__cond.notify_all()
+            self.__maybe_report()
+    
+    def __decrease(self) -> None:
+        if self.__since_decrease < self.__in_flight_at_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+        self.__since_decrease = 0
+        self.__in_flight_at_decrease = self.in_flight
+    
+    def run(self, func: Callable, *args, kind: str = "", cost: int = 1) -> Any:
+        """
+        call func(*args) once a slot is free, and return its result.
+        if it fails with an overload error, it is retried (after a short sleep, as
+        bitcoind's queue needs to drain) up to overload_retries times
+        """
+        for attempt in range(self.overload_retries + 1):
+            self.acquire()
+            t0 = time.time()
+            try:
+                result = func(*args)
+            except Exception as e:
+                overloaded = is_overload_error(e)
+                self.release(kind=kind, cost=cost, overloaded=overloaded)
+                if not overloaded or attempt == self.overload_retries:
+                    raise
+            else:
+                self.release(kind=kind, latency=time.time() - t0, cost=cost)
+                return result
+            time.sleep(self.overload_sleep * (attempt + 1))
+    
+    def snapshot(self) -> Dict[str, float]:
+        with self.__cond:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "overloads": self.overloads,
+            }
+    
+    def __maybe_report(self) -> None:
+        # called with the lock held
+        now = time.time()
+        elapsed = now - self.__report_time
+        if elapsed < self.report_interval:
+            return
+        throughput = (self.completed - self.__report_completed) / elapsed if elapsed > 0 else 0.0
+        report = {
+            "time": now,
+            "limit": self.limit,
+            "throughput": throughput,
+            "overloads": self.overloads,
+        }
+        self.history.append(report)
+        self.__report_time = now
+        self.__report_completed = self.completed
+        if self.logger is not None:
+            self.logger.info(
+                f"concurrency limit: {round(self.limit, 1)}, throughput: {round(throughput, 1)} calls/sec, "
+                f"overload errors so far: {self.overloads}"
+            )
@@ -1,11 +1,23 @@
 import json
 import os
 import subprocess
+import time
+from concurrent.futures import Executor
 from functools import lru_cache
-from typing import List, Optional
-
-from datatypes import (Address, BTC, Block, BlockHeight, Feerate, TX, TXID, Timestamp, btc_to_sat)
-from utils import leveldb_cache
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from adaptive_limiter import AdaptiveConcurrencyLimiter
+from bitcoin_rpc import BitcoinRPC, BitcoinRPCError
+from cache_codecs import TXID_FLOAT64_CODEC, TXID_VARINT_CODEC
+from datatypes import (
+    Address, BTC, Block, BlockHash, BlockHeight, Feerate, Outpoint, Satoshi, TX, TXID, Timestamp, TxStats,
+    btc_to_sat_exact,
+)
+from height_index import BlockHeightIndex
+from instrumentation import METRICS
+from outpoint_store import OutpointValueStore
+from single_flight import single_flight
+from utils import get_leveldb_cache_fullpath, leveldb_cache
 
 ln = os.path.expandvars("$LN")
 
@@ -14,8 +26,28 @@ BITCOIN_CLI_USER = "/cs/usr/jonahar/mainnet/bitcoin-cli.sh "
 
 BITCOIN_CLI = BITCOIN_CLI_MASTER
 
+# if set, queries are sent to bitcoind over JSON-RPC instead of spawning bitcoin-cli
+BITCOIN_RPC: Optional[BitcoinRPC] = None
+
+# if set, all queries to bitcoind go through this limiter
+RPC_LIMITER: Optional[AdaptiveConcurrencyLimiter] = None
+
+# if set, values of spent outputs are looked up in this store before fetching parent txs
+OUTPOINT_STORE: Optional[OutpointValueStore] = None
+
+# if set, block hashes, times and sizes of indexed heights are taken from this index
+HEIGHT_INDEX: Optional[BlockHeightIndex] = None
+
 TRANSACTIONS_CACHE_SIZE = 2 ** 13  # 8192. probably enough to hold transactions of an entire block
 
+# max number of calls in a single JSON-RPC batch request. bitcoind handles a batch
+# in a single worker thread, so smaller batches sent concurrently spread the load
+RPC_BATCH_SIZE = 500
+
+# number of blocks fetched in every step of sync_height_index. getblock returns the
+# txids of the block, so a step holds a few tens of MB
+HEIGHT_INDEX_SYNC_STEP = 100
+
 
 def set_bitcoin_cli(target: str) -> None:
     """
@@ -31,6 +63,24 @@ def set_bitcoin_cli(target: str) -> None:
         raise ValueError(f"unrecognized bitcoin-cli target: {target}")
 
 
+def set_bitcoin_rpc(rpc: Optional[BitcoinRPC]) -> None:
+    """
+    talk to bitcoind over JSON-RPC using the given client, instead of spawning
+    a bitcoin-cli process per call. if rpc is None, go back to using bitcoin-cli
+    """
+    global BITCOIN_RPC
+    BITCOIN_RPC = rpc
+
+
+def set_rpc_limiter(limiter: Optional[AdaptiveConcurrencyLimiter]) -> None:
+    """
+    make all queries to bitcoind (over JSON-RPC or bitcoin-cli) through the given
+    limiter, which adapts the number of concurrent queries to bitcoind's load
+    """
+    global RPC_LIMITER
+    RPC_LIMITER = limiter
+
+
 def decode_stdout(result: subprocess.CompletedProcess) -> str:
     out = result.stdout.decode("utf-8")
     # remove newline at the end if exist
@@ -39,11 +89,111 @@ def decode_stdout(result: subprocess.CompletedProcess) -> str:
     return out
 
 
-def run_cli_command(args: List[str]) -> subprocess.CompletedProcess:
+def run_cli_command(args: List[str], capture_stderr: bool = False) -> subprocess.CompletedProcess:
+    """
+    run bitcoin-cli with the given args. its stderr goes to ours, unless
+    capture_stderr is True
+    """
     return subprocess.run(
         BITCOIN_CLI.split() + args,
         stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if capture_stderr else None,
+    )
+
+
+def set_outpoint_store(store: Optional[OutpointValueStore]) -> None:
+    """
+    use the given store for values of spent outputs when computing the stats of
+    block txs, and add every block that goes through get_block_txs_stats to it
+    """
+    global OUTPOINT_STORE
+    OUTPOINT_STORE = store
+
+
+def set_height_index(index: Optional[BlockHeightIndex]) -> None:
+    """
+    use the given index for looking up blocks by height. heights that are not in
+    the index (yet) are looked up in bitcoind
+    """
+    global HEIGHT_INDEX
+    HEIGHT_INDEX = index
+
+
+def cli_arg(param: Any) -> str:
+    """
+    convert an RPC parameter to its bitcoin-cli command line representation
+    """
+    return param if isinstance(param, str) else json.dumps(param)
+
+
+def rpc_call(method: str, *params, limited: bool = True) -> Any:
+    """
+    call the given bitcoind RPC method and return its (parsed) result.
+    the call goes over JSON-RPC if a client was set by set_bitcoin_rpc, otherwise
+    bitcoin-cli is used.
+    
+    limited: if False, the call doesn't go through the RPC limiter (if set). used for
+             long-polling calls, whose latency says nothing about bitcoind's load
+    """
+    limiter = RPC_LIMITER
+    if limiter is not None and limited:
+        return limiter.run(__rpc_call, method, *params, kind=method)
+    return __rpc_call(method, *params)
+
+
+def __rpc_call(method: str, *params) -> Any:
+    if BITCOIN_RPC is not None:
+        return BITCOIN_RPC.call(method, *params)
+    
+    args = [method] + [cli_arg(param) for param in params]
+    t0 = time.perf_counter()
+    result = run_cli_command(args, capture_stderr=True)
+    METRICS.record_query(
+        transport="cli", method=method, seconds=time.perf_counter() - t0,
+        bytes_sent=sum(len(arg) for arg in args), bytes_received=len(result.stdout),
+        error=result.returncode != 0,
     )
+    if result.returncode != 0:
+        # bitcoin-cli prints errors (e.g. "error code: -5\nerror message:\n...") to stderr
+        raise BitcoinRPCError(code=result.returncode, message=result.stderr.decode("utf-8").strip())
+    out = result.stdout.decode("utf-8").strip()
+    try:
+        return json.loads(out)
+    except ValueError:
+        # bitcoin-cli prints string results (e.g. a block hash) without quotes
+        return out
+
+
+def rpc_batch(
+    method: str,
+    params_list: Sequence[Sequence],
+    batch_size: int = RPC_BATCH_SIZE,
+    executor: Executor = None,
+) -> List[Any]:
+    """
+    call the given method once for every params in params_list and return
+    the results, in the same order.
+    
+    over JSON-RPC, calls are sent in batches of batch_size. if an executor is given,
+    the batches are sent concurrently on it. with bitcoin-cli, there are no batches and
+    every call spawns a process
+    """
+    if BITCOIN_RPC is None:
+        call = lambda params: rpc_call(method, *params)
+        return list(executor.map(call, params_list) if executor else map(call, params_list))
+    
+    rpc = BITCOIN_RPC
+    limiter = RPC_LIMITER
+    batches = [
+        [(method, params) for params in params_list[i:i + batch_size]]
+        for i in range(0, len(params_list), batch_size)
+    ]
+    if limiter is None:
+        send = rpc.batch
+    else:
+        send = lambda batch: limiter.run(rpc.batch, batch, kind=method, cost=len(batch))
+    mapper = executor.map if executor else map
+    return [result for batch_results in mapper(send, batches) for result in batch_results]
 
 
 def __gen_bitcoin_address() -> Address:
@@ -78,21 +228,34 @@ def fund_addresses(addresses: List[Address]) -> Optional[str]:
 
 
 def blockchain_height() -> int:
-    result = run_cli_command(["-getinfo"])
-    return json.loads(decode_stdout(result))["blocks"]
+    return rpc_call("getblockcount")
 
 
 def get_mempool_txids() -> List[TXID]:
-    result = run_cli_command(["getrawmempool"])
-    return json.loads(decode_stdout(result))
+    return rpc_call("getrawmempool")
 
 
 # ----- Transactions -----
 
+# concurrent misses of the same txid (e.g. of parents shared by many transactions)
+# make a single call
 @lru_cache(maxsize=TRANSACTIONS_CACHE_SIZE)
+@single_flight
 def get_transaction(txid: TXID) -> TX:
-    result = run_cli_command(["getrawtransaction", txid, "1"])
-    return json.loads(decode_stdout(result))
+    return rpc_call("getrawtransaction", txid, 1)
+
+
+METRICS.register_lru_cache("get_transaction", get_transaction)
+
+
+def get_transactions(txids: Iterable[TXID], executor: Executor = None) -> Dict[TXID, TX]:
+    """
+    batched version of get_transaction.
+    return a dictionary from txid to the transaction, for all given txids
+    """
+    txids = list(dict.fromkeys(txids))  # remove duplicates but keep the order
+    txs = rpc_batch("getrawtransaction", [(txid, 1) for txid in txids], executor=executor)
+    return dict(zip(txids, txs))
 
 
 def coinbase_tx(txid: TXID) -> bool:
@@ -135,32 +298,184 @@ def get_tx_size(txid: TXID) -> int:
     return get_transaction(txid)["size"]
 
 
-@leveldb_cache(value_to_str=str, str_to_value=int)
+@leveldb_cache(value_to_str=str, str_to_value=int, binary_codec=TXID_VARINT_CODEC)
 def get_tx_weight(txid: TXID) -> int:
     return get_transaction(txid)["weight"]
 
 
-@leveldb_cache(value_to_str=str, str_to_value=float)
+@leveldb_cache(value_to_str=str, str_to_value=float, binary_codec=TXID_FLOAT64_CODEC)
 def get_tx_feerate(txid: TXID) -> Feerate:
     if coinbase_tx(txid):
         return 0
     tx_size = get_tx_size(txid)
-    fee_sat = btc_to_sat(get_tx_fee(txid))
+    # rounded as compute_tx_fee rounds it, so the cache holds the same feerate
+    # whether it was filled by this function or by the ingester (see TxStats)
+    fee_sat = btc_to_sat_exact(get_tx_fee(txid))
     return fee_sat / tx_size
 
 
+def is_coinbase(tx: TX) -> bool:
+    return "coinbase" in tx["vin"][0]
+
+
 # ----- Blocks -----
 
 
 def get_block_by_hash(block_hash: str) -> Block:
-    result = run_cli_command(["getblock", block_hash])
-    return json.loads(decode_stdout(result))
+    return rpc_call("getblock", block_hash)
+
+
+def get_block_hash(height: BlockHeight) -> BlockHash:
+    index = HEIGHT_INDEX
+    if index is not None and height in index:
+        return index.block_hash(height)
+    return rpc_call("getblockhash", height)
+
+
+def get_block_hashes(heights: Iterable[BlockHeight], executor: Executor = None) -> Dict[BlockHeight, BlockHash]:
+    """
+    batched version of get_block_hash
+    """
+    index = HEIGHT_INDEX
+    heights = list(heights)
+    block_hashes = {h: index.block_hash(h) for h in heights if index is not None and h in index}
+    missing = [h for h in heights if h not in block_hashes]
+    block_hashes.update(zip(missing, rpc_batch("getblockhash", [(h,) for h in missing], executor=executor)))
+    return {h: block_hashes[h] for h in heights}
 
 
 def get_block_by_height(height: BlockHeight) -> Block:
-    result = run_cli_command(["getblockhash", str(height)])
-    block_hash = decode_stdout(result)
-    return get_block_by_hash(block_hash)
+    return get_block_by_hash(get_block_hash(height))
+
+
+def sync_height_index(index: BlockHeightIndex, executor: Executor = None) -> int:
+    """
+    extend the index up to the current tip, and return the number of blocks added.
+    
+    blocks that were disconnected by a reorg are first removed from the index. only
+    blocks above the (remaining) indexed tip are fetched, HEIGHT_INDEX_SYNC_STEP
+    at a time: one batch of getblockhash and one of getblock per step
+    """
+    tip_height = blockchain_height()
+    
+    indexed = min(len(index), tip_height + 1)
+    while indexed > 0 and rpc_call("getblockhash", indexed - 1) != index.block_hash(indexed - 1):
+        indexed -= 1
+    index.truncate(indexed)
+    
+    added = 0
+    for start in range(indexed, tip_height + 1, HEIGHT_INDEX_SYNC_STEP):
+        heights = range(start, min(start + HEIGHT_INDEX_SYNC_STEP, tip_height + 1))
+        block_hashes = rpc_batch("getblockhash", [(h,) for h in heights], executor=executor)
+        blocks = rpc_batch("getblock", [(block_hash, 1) for block_hash in block_hashes], executor=executor)
+        
+        # a reorg may happen while we fetch. keep only blocks that extend the indexed
+        # chain. the rest are handled by the next sync
+        prev_hash = index.block_hash(start - 1) if start > 0 else None
+        connected = []
+        for block in blocks:
+            if block.get("previousblockhash") != prev_hash:
+                break
+            connected.append(block)
+            prev_hash = block["hash"]
+        index.append(connected)
+        added += len(connected)
+        if len(connected) < len(blocks):
+            break
+    
+    return added
+
+
+def get_block_with_txs(block_hash: BlockHash, prevouts: bool = True) -> Block:
+    """
+    return the block with the full body of every transaction in it (getblock verbosity 2),
+    instead of only txids.
+    
+    if prevouts is True, verbosity 3 is requested, in which every input also contains
+    the output it spends under "prevout". bitcoind supports it since 22.0. older
+    versions treat verbosity 3 as 2, so callers should not assume prevouts exist
+    """
+    return rpc_call("getblock", block_hash, 3 if prevouts else 2)
+
+
+def compute_tx_fee(tx: TX, outpoint_values: Dict[Outpoint, Satoshi]) -> Satoshi:
+    """
+    compute the fee of a tx from a block with full transactions.
+    the values of the spent outputs are taken from the prevout data of the inputs
+    if exist, otherwise from `outpoint_values`
+    """
+    if is_coinbase(tx):
+        return 0
+    if "fee" in tx:
+        # getblock verbosity 2 includes the fee, if bitcoind has the block's undo data
+        return btc_to_sat_exact(tx["fee"])
+    
+    incoming_value = sum(
+        btc_to_sat_exact(src_entry["prevout"]["value"]) if "prevout" in src_entry
+        else outpoint_values[(src_entry["txid"], src_entry["vout"])]
+        for src_entry in tx["vin"]
+    )
+    outgoing_value = sum(btc_to_sat_exact(entry["value"]) for entry in tx["vout"])
+    return incoming_value - outgoing_value
+
+
+def tx_outputs_values(tx: TX) -> Dict[Outpoint, Satoshi]:
+    return {(tx["txid"], out["n"]): btc_to_sat_exact(out["value"]) for out in tx["vout"]}
+
+
+def compute_block_txs_stats(block: Block, executor: Executor = None) -> Dict[TXID, TxStats]:
+    """
+    compute the stats of all txs in a block with full transactions (see get_block_with_txs).
+    the returned dictionary is ordered as the txs in the block.
+    
+    if the block contains prevouts (or fees), no RPC is made. otherwise, values of
+    outputs spent by the block are looked up in the outpoint store (if set), and the
+    parents of the rest are fetched in batches
+    """
+    outpoint_values: Dict[Outpoint, Satoshi] = {}
+    for tx in block["tx"]:
+        outpoint_values.update(tx_outputs_values(tx))
+    
+    unknown_outpoints = [
+        (src_entry["txid"], src_entry["vout"])
+        for tx in block["tx"] if not is_coinbase(tx) and "fee" not in tx
+        for src_entry in tx["vin"]
+        if "prevout" not in src_entry and (src_entry["txid"], src_entry["vout"]) not in outpoint_values
+    ]
+    if OUTPOINT_STORE is not None:
+        outpoint_values.update(
+            (outpoint, value)
+            for outpoint, value in OUTPOINT_STORE.get_many(unknown_outpoints).items() if value is not None
+        )
+    
+    missing_parents = {txid for txid, n in unknown_outpoints if (txid, n) not in outpoint_values}
+    for parent in get_transactions(missing_parents, executor=executor).values():
+        outpoint_values.update(tx_outputs_values(parent))
+    
+    stats = {
+        tx["txid"]: TxStats(
+            txid=tx["txid"],
+            fee=compute_tx_fee(tx, outpoint_values),
+            size=tx["size"],
+            weight=tx["weight"],
+        )
+        for tx in block["tx"]
+    }
+    
+    if OUTPOINT_STORE is not None:
+        OUTPOINT_STORE.add_block(block)
+    
+    return stats
+
+
+def get_block_txs_stats(height: BlockHeight, executor: Executor = None) -> Dict[TXID, TxStats]:
+    """
+    return the stats (fee, size, weight, feerate) of all txs in block 'height', ordered
+    as in the block. this takes a getblockhash (none if the height is in the height
+    index) and a getblock. if bitcoind doesn't provide prevouts (< 22.0), the parents
+    of the block's txs are also fetched, in a few batched RPCs
+    """
+    return compute_block_txs_stats(get_block_with_txs(get_block_hash(height)), executor=executor)
 
 
 def num_tx_in_block(block: Block) -> int:
@@ -172,26 +487,29 @@ def get_txs_in_block(height: BlockHeight, include_coinbase=True) -> List[TXID]:
     return a list of transactions in block 'height'
     if include_coinbase is False, the coinbase transaction of the block is not included
     """
-    block: Block = get_block_by_height(height)
-    txids = block["tx"]
-    
-    if not include_coinbase:
-        # the coinbase tx is usually the first, but we loop until we find it, in case it's not
-        coinbase_txid = None
-        for txid in txids:
-            if "coinbase" in get_transaction(txid)["vin"][0]:
-                coinbase_txid = txid
-                break
-        # we assume coinbase_txid was found
-        txids.remove(coinbase_txid)
+    if include_coinbase:
+        return get_block_by_height(height)["tx"]
     
-    return txids
+    # the coinbase tx is usually the first, but we look for it in case it's not.
+    # with the full transactions in the block, this doesn't require querying every tx
+    block = get_block_with_txs(get_block_hash(height), prevouts=False)
+    return [tx["txid"] for tx in block["tx"] if not is_coinbase(tx)]
 
 
 def get_block_size(height: BlockHeight) -> int:
+    index = HEIGHT_INDEX
+    if index is not None and height in index:
+        return index.block_size(height)
     return get_block_by_height(height)["size"]
 
 
-@leveldb_cache(value_to_str=str, str_to_value=int)
 def get_block_time(h: BlockHeight) -> Timestamp:
+    index = HEIGHT_INDEX
+    if index is not None and h in index:
+        return index.block_time(h)
+    return __get_block_time_cached(h)
+
+
+@leveldb_cache(value_to_str=str, str_to_value=int, db_path=get_leveldb_cache_fullpath("get_block_time"))
+def __get_block_time_cached(h: BlockHeight) -> Timestamp:
     return get_block_by_height(h)["time"]
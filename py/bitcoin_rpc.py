@@ -0,0 +1,294 @@
+import base64
+import http.client
+import json
+import os
+import queue
+import socket
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from instrumentation import METRICS
+
+DEFAULT_RPC_PORTS = {
+    "main": 8332,
+    "test": 18332,
+    "regtest": 18443,
+}
+
+# bitcoind serves at most `rpcthreads` requests at once (4 by default) and queues
+# up to `rpcworkqueue` more (16 by default), so there is no point in holding more
+# connections than that
+DEFAULT_POOL_SIZE = 16
+
+DEFAULT_TIMEOUT = 300  # seconds. some calls (e.g. getblock of a full block) may be slow
+
+# errors that may be raised when a keep-alive connection was closed by the server
+# while it was idle in the pool
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    BrokenPipeError,
+    ConnectionResetError,
+)
+
+
+class BitcoinRPCError(Exception):
+    """
+    an error returned by bitcoind for a specific call (e.g. unknown txid)
+    """
+    
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(f"bitcoind RPC error {code}: {message}")
+        self.code = code
+        self.message = message
+
+
+class BitcoinRPCTransportError(Exception):
+    """
+    the HTTP request to bitcoind failed without a JSON-RPC response,
+    e.g. wrong credentials (401) or an exceeded work queue (503)
+    """
+    
+    def __init__(self, status: int, reason: str, body: str) -> None:
+        super().__init__(f"bitcoind HTTP error {status} ({reason}): {body}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class BitcoinRPC:
+    """
+    A JSON-RPC client for bitcoind.
+    
+    The client keeps HTTP/1.1 keep-alive connections in a pool, so a single client
+    may (and should) be shared by all threads of the process. A thread that makes
+    a call takes a connection from the pool (or opens a new one if all existing
+    connections are idle-less and the pool is not exhausted) and returns it when
+    the call is done. If the pool is exhausted, the caller blocks until some
+    connection is returned.
+    """
+    
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_RPC_PORTS["main"],
+        user: str = None,
+        password: str = None,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeout: float = DEFAULT_TIMEOUT,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.__headers = {"Content-Type": "application/json"}
+        if user is not None:
+            credentials = base64.b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+            self.__headers["Authorization"] = f"Basic {credentials}"
+        
+        # None entries are 'free slots' for which a connection wasn't opened yet.
+        # LIFO, so recently used (and probably still alive) connections are reused first
+        self.__pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self.__pool.put(None)
+        
+        self.__request_id = 0
+    
+    @classmethod
+    def from_conf(cls, conf_path: str, **kwargs) -> "BitcoinRPC":
+        """
+        create a client for the node configured by the given bitcoin.conf.
+        
+        credentials are taken from rpcuser/rpcpassword if they exist, otherwise
+        from the cookie file (rpccookiefile, or .cookie in the node's datadir).
+        kwargs are passed as is to the constructor
+        """
+        conf = parse_bitcoin_conf(conf_path)
+        network = "main"
+        if conf.get("regtest") == "1":
+            network = "regtest"
+        elif conf.get("testnet") == "1":
+            network = "test"
+        
+        host = conf.get("rpcconnect", "127.0.0.1")
+        port = int(conf.get("rpcport", DEFAULT_RPC_PORTS[network]))
+        
+        user = conf.get("rpcuser")
+        password = conf.get("rpcpassword")
+        if user is None:
+            cookie_path = conf.get("rpccookiefile")
+            if cookie_path is None:
+                datadir = conf.get("datadir", os.path.dirname(os.path.abspath(conf_path)))
+                network_dir = {"main": "", "test": "testnet3", "regtest": "regtest"}[network]
+                cookie_path = os.path.join(datadir, network_dir, ".cookie")
+            with open(cookie_path) as f:
+                user, password = f.read().strip().split(":", 1)
+        
+        return cls(host=host, port=port, user=user, password=password, **kwargs)
+    
+    def __next_id(self) -> int:
+        # not thread-safe, but ids are only used for debugging, and we don't rely
+        # on their uniqueness (each request waits for its own response)
+        self.__request_id += 1
+        return self.__request_id
+    
+    def __new_connection(self) -> http.client.HTTPConnection:
+        conn = http.client.HTTPConnection(host=self.host, port=self.port, timeout=self.timeout)
+        conn.connect()
+        # requests are small and we always wait for the response, so Nagle's
+        # algorithm only adds latency
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+    
+    def __post_once(self, conn: http.client.HTTPConnection, body: bytes) -> bytes:
+        conn.request("POST", "/", body=body, headers=self.__headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            # bitcoind returns JSON-RPC errors with status 500/404, and these
+            # have a JSON body. anything else is a transport-level error
+            try:
+                json.loads(data)
+            except ValueError:
+                raise BitcoinRPCTransportError(
+                    status=response.status,
+                    reason=response.reason,
+                    body=data.decode("utf-8", errors="replace").strip(),
+                )
+        return data
+    
+    def post(self, body: bytes) -> bytes:
+        """
+        send the given request body to bitcoind, using a pooled connection,
+        and return the raw response body
+        """
+        conn: Optional[http.client.HTTPConnection] = self.__pool.get()
+        try:
+            if conn is None:
+                conn = self.__new_connection()
+                return self.__post_once(conn, body)
+            
+            try:
+                return self.__post_once(conn, body)
+            except STALE_CONNECTION_ERRORS:
+                # the server closed this connection while it was idle. retry once
+                # with a fresh connection
+                conn.close()
+                conn = self.__new_connection()
+                return self.__post_once(conn, body)
+        except BitcoinRPCTransportError:
+            # the connection itself is still usable
+            raise
+        except Exception:
+            if conn is not None:
+                conn.close()
+            conn = None
+            raise
+        finally:
+            self.__pool.put(conn)
+    
+    def call(self, method: str, *params) -> Any:
+        """
+        call the given RPC method and return its result.
+        raise BitcoinRPCError if bitcoind returned an error
+        """
+        body = json.dumps({
+            "jsonrpc": "1.0",
+            "id": self.__next_id(),
+            "method": method,
+            "params": list(params),
+        }).encode("utf-8")
+        t0 = time.perf_counter()
+        data = b""
+        error = True
+        try:
+            data = self.post(body)
+            result = extract_result(json.loads(data))
+            error = False
+            return result
+        finally:
+            METRICS.record_query(
+                transport="rpc", method=method, seconds=time.perf_counter() - t0,
+                bytes_sent=len(body), bytes_received=len(data), error=error,
+            )
+    
+    def batch(self, calls: Sequence[Tuple[str, Sequence]]) -> List[Any]:
+        """
+        make all given calls (pairs of method and params) in a single JSON-RPC
+        batch request, and return their results in the same order.
+        raise BitcoinRPCError if any of the calls failed
+        
+        note that bitcoind handles all calls of a batch sequentially, in a single
+        worker thread. very large batches should be split by the caller
+        """
+        if not calls:
+            return []
+        body = json.dumps([
+            {"jsonrpc": "1.0", "id": i, "method": method, "params": list(params)}
+            for i, (method, params) in enumerate(calls)
+        ]).encode("utf-8")
+        methods = {method for method, _ in calls}
+        t0 = time.perf_counter()
+        data = b""
+        error = True
+        try:
+            data = self.post(body)
+            responses = json.loads(data)
+            if isinstance(responses, dict):
+                # the batch as a whole was rejected
+                extract_result(responses)
+            responses.sort(key=lambda response: response["id"])
+            results = [extract_result(response) for response in responses]
+            error = False
+            return results
+        finally:
+            METRICS.record_query(
+                transport="rpc", method=methods.pop() if len(methods) == 1 else "batch",
+                seconds=time.perf_counter() - t0, calls=len(calls),
+                bytes_sent=len(body), bytes_received=len(data), error=error,
+            )
+    
+    def close(self) -> None:
+        """
+        close all idle connections in the pool
+        """
+        conns = []
+        while True:
+            try:
+                conns.append(self.__pool.get_nowait())
+            except queue.Empty:
+                break
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+            self.__pool.put(None)
+
+
+def extract_result(response: Dict[str, Any]) -> Any:
+    """
+    return the result of a single JSON-RPC response object, or raise
+    BitcoinRPCError if it contains an error
+    """
+    error = response.get("error")
+    if error is not None:
+        raise BitcoinRPCError(code=error.get("code"), message=error.get("message"))
+    return response["result"]
+
+
+def parse_bitcoin_conf(conf_path: str) -> Dict[str, str]:
+    """
+    parse a bitcoin.conf file into a dictionary.
+    network sections (e.g. [regtest]) are flattened - values in sections
+    override the global ones
+    """
+    conf = {}
+    with open(conf_path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line or line.startswith("["):
+                continue
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            conf[key.strip()] = value.strip()
+    return conf
@@ -0,0 +1,466 @@
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import plyvel
+
+from bitcoin_cli import get_transactions, tx_outputs_values
+from datatypes import BlockHash, BlockHeight, Outpoint, Satoshi, TXID, Timestamp, TxStats
+from outpoint_store import OutpointValueStore
+
+"""
+Read blocks straight from Bitcoin Core's block files (blocks/blk*.dat), without bitcoind.
+
+Block files are a sequence of records: 4 bytes network magic, 4 bytes block size,
+and the serialized block. The block index (blocks/index, a LevelDB) tells for every
+block its height and its position in the block files. bitcoind holds a lock on the
+index while running, in which case a copy of it is opened.
+"""
+
+NETWORK_MAGIC = {
+    "main": bytes.fromhex("f9beb4d9"),
+    "test": bytes.fromhex("0b110907"),
+    "signet": bytes.fromhex("0a03cf40"),
+    "regtest": bytes.fromhex("fabfb5da"),
+}
+
+# block status flags, from bitcoin/src/chain.h
+BLOCK_VALID_MASK = 7
+BLOCK_VALID_TRANSACTIONS = 3
+BLOCK_HAVE_DATA = 8
+BLOCK_HAVE_UNDO = 16
+BLOCK_FAILED_MASK = 32 | 64
+
+# number of block files that are kept memory-mapped at once
+MAX_OPEN_FILES = 8
+
+HEADER_SIZE = 80
+WITNESS_SCALE_FACTOR = 4
+
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
+
+
+def double_sha256(data: bytes) -> bytes:
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash_to_hex(h: bytes) -> str:
+    # hashes are displayed in reverse byte order
+    return h[::-1].hex()
+
+
+def block_work(bits: int) -> int:
+    """
+    the expected number of hashes for a block with the given target (nBits), as
+    bitcoind computes it (GetBlockProof)
+    """
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    target = mantissa << (8 * (exponent - 3)) if exponent > 3 else mantissa >> (8 * (3 - exponent))
+    if target == 0 or bits & 0x00800000:
+        return 0
+    return (1 << 256) // (target + 1)
+
+
+def read_compact_size(buf, pos: int) -> Tuple[int, int]:
+    """
+    read a CompactSize integer (used for lengths in txs and blocks).
+    return the value and the position after it
+    """
+    first = buf[pos]
+    if first < 0xfd:
+        return first, pos + 1
+    if first == 0xfd:
+        return int.from_bytes(buf[pos + 1:pos + 3], "little"), pos + 3
+    if first == 0xfe:
+        return int.from_bytes(buf[pos + 1:pos + 5], "little"), pos + 5
+    return int.from_bytes(buf[pos + 1:pos + 9], "little"), pos + 9
+
+
+def read_varint(buf, pos: int) -> Tuple[int, int]:
+    """
+    read a VARINT, the MSB base-128 encoding used by the block index db.
+    return the value and the position after it
+    """
+    n = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n = (n << 7) | (b & 0x7f)
+        if b & 0x80:
+            n += 1
+        else:
+            return n, pos
+
+
+@dataclass
+class ParsedTx:
+    txid: TXID
+    size: int
+    weight: int
+    inputs: List[Outpoint]  # the outputs spent by this tx. empty for a coinbase
+    outputs: List[Satoshi]  # values, by output index
+    
+    @property
+    def coinbase(self) -> bool:
+        return not self.inputs
+
+
+@dataclass
+class ParsedBlock:
+    hash: BlockHash
+    prev_hash: BlockHash
+    time: Timestamp
+    size: int
+    weight: int
+    txs: List[ParsedTx]
+
+
+def parse_tx(buf, pos: int) -> Tuple[ParsedTx, int]:
+    """
+    parse the serialized tx that starts at buf[pos].
+    return the tx and the position after it
+    """
+    start = pos
+    pos += 4  # version
+    segwit = buf[pos] == 0 and buf[pos + 1] != 0
+    if segwit:
+        pos += 2  # marker and flag
+    body_start = pos
+    
+    num_inputs, pos = read_compact_size(buf, pos)
+    inputs = []
+    for _ in range(num_inputs):
+        prev_txid = bytes(buf[pos:pos + 32])
+        prev_n = UINT32.unpack_from(buf, pos + 32)[0]
+        script_len, pos = read_compact_size(buf, pos + 36)
+        pos += script_len + 4  # script and sequence
+        inputs.append((prev_txid, prev_n))
+    
+    num_outputs, pos = read_compact_size(buf, pos)
+    outputs = []
+    for _ in range(num_outputs):
+        outputs.append(UINT64.unpack_from(buf, pos)[0])
+        script_len, pos = read_compact_size(buf, pos + 8)
+        pos += script_len
+    body_end = pos
+    
+    if segwit:
+        for _ in range(num_inputs):
+            num_items, pos = read_compact_size(buf, pos)
+            for _ in range(num_items):
+                item_len, pos = read_compact_size(buf, pos)
+                pos += item_len
+    pos += 4  # locktime
+    end = pos
+    
+    # the txid is the hash of the serialization without the witness data
+    stripped = bytes(buf[start:start + 4]) + bytes(buf[body_start:body_end]) + bytes(buf[end - 4:end])
+    size = end - start
+    weight = len(stripped) * (WITNESS_SCALE_FACTOR - 1) + size
+    
+    coinbase = num_inputs == 1 and inputs[0] == (bytes(32), 0xffffffff)
+    return ParsedTx(
+        txid=hash_to_hex(double_sha256(stripped)),
+        size=size,
+        weight=weight,
+        inputs=[] if coinbase else [(hash_to_hex(prev_txid), n) for prev_txid, n in inputs],
+        outputs=outputs,
+    ), end
+
+
+def parse_block(buf) -> ParsedBlock:
+    """
+    parse a serialized block (that starts at buf[0])
+    """
+    header = bytes(buf[:HEADER_SIZE])
+    num_txs, pos = read_compact_size(buf, HEADER_SIZE)
+    txs = []
+    for _ in range(num_txs):
+        tx, pos = parse_tx(buf, pos)
+        txs.append(tx)
+    # the header and the txs count are not witness data
+    non_tx_size = pos - sum(tx.size for tx in txs)
+    return ParsedBlock(
+        hash=hash_to_hex(double_sha256(header)),
+        prev_hash=hash_to_hex(header[4:36]),
+        time=UINT32.unpack_from(header, 68)[0],
+        size=pos,
+        weight=non_tx_size * WITNESS_SCALE_FACTOR + sum(tx.weight for tx in txs),
+        txs=txs,
+    )
+
+
+class BlockLocation(NamedTuple):
+    file_num: int
+    data_pos: int  # the position of the serialized block (after the magic and size)
+
+
+class BlockFiles:
+    """
+    Access to the blocks in the blk*.dat files of a bitcoind blocks directory.
+    Files are memory-mapped, so reading a block doesn't copy more than the block itself
+    """
+    
+    def __init__(self, blocks_dir: str, network: str = "main") -> None:
+        self.blocks_dir = blocks_dir
+        self.magic = NETWORK_MAGIC[network]
+        self.__mmaps: OrderedDict = OrderedDict()  # file_num -> mmap, in LRU order
+        # blocks may be read by several threads (see read_block_bytes), and an mmap
+        # must not be closed while a block is copied out of it
+        self.__lock = threading.Lock()
+        
+        # since 28.0, bitcoind obfuscates block files by xoring them with a random key
+        self.xor_key: Optional[bytes] = None
+        xor_path = os.path.join(blocks_dir, "xor.dat")
+        if os.path.isfile(xor_path):
+            with open(xor_path, "rb") as f:
+                key = f.read()
+            if any(key):
+                self.xor_key = key
+    
+    def file_path(self, file_num: int) -> str:
+        return os.path.join(self.blocks_dir, f"blk{file_num:05d}.dat")
+    
+    def __get_mmap(self, file_num: int) -> Optional[mmap.mmap]:
+        mm = self.__mmaps.get(file_num)
+        if mm is not None:
+            self.__mmaps.move_to_end(file_num)
+            return mm
+        path = self.file_path(file_num)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return None
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__mmaps[file_num] = mm
+        if len(self.__mmaps) > MAX_OPEN_FILES:
+            _, oldest = self.__mmaps.popitem(last=False)
+            oldest.close()
+        return mm
+    
+    def __read(self, mm: mmap.mmap, pos: int, size: int):
+        if self.xor_key is None:
+            return memoryview(mm)[pos:pos + size]
+        data = np.frombuffer(mm, dtype=np.uint8, count=size, offset=pos)
+        key = np.frombuffer(self.xor_key, dtype=np.uint8)
+        key = np.roll(key, -(pos % len(key)))
+        return np.bitwise_xor(data, np.resize(key, size)).tobytes()
+    
+    def read_block(self, location: BlockLocation) -> ParsedBlock:
+        mm = self.__get_mmap(location.file_num)
+        if mm is None:
+            raise FileNotFoundError(self.file_path(location.file_num))
+        size = UINT32.unpack(bytes(self.__read(mm, location.data_pos - 4, 4)))[0]
+        return parse_block(self.__read(mm, location.data_pos, size))
+    
+    def read_block_bytes(self, location: BlockLocation) -> bytes:
+        """
+        return a copy of the serialized block, to be parsed with parse_block (e.g. in
+        another process). thread-safe
+        """
+        with self.__lock:
+            mm = self.__get_mmap(location.file_num)
+            if mm is None:
+                raise FileNotFoundError(self.file_path(location.file_num))
+            size = UINT32.unpack(bytes(self.__read(mm, location.data_pos - 4, 4)))[0]
+            return bytes(self.__read(mm, location.data_pos, size))
+    
+    def scan(self) -> Iterator[Tuple[BlockLocation, BlockHash, BlockHash, int]]:
+        """
+        go over all blocks in all block files, in file order (which is not height order).
+        yield the location, hash, previous block hash and target (nBits) of every block
+        """
+        file_num = 0
+        while True:
+            mm = self.__get_mmap(file_num)
+            if mm is None:
+                return
+            pos = 0
+            while pos + 8 <= len(mm):
+                record_header = bytes(self.__read(mm, pos, 8))
+                if record_header[:4] != self.magic:
+                    break  # files are pre-allocated, and the rest is zeros
+                size = UINT32.unpack_from(record_header, 4)[0]
+                header = bytes(self.__read(mm, pos + 8, HEADER_SIZE))
+                yield (
+                    BlockLocation(file_num=file_num, data_pos=pos + 8),
+                    hash_to_hex(double_sha256(header)),
+                    hash_to_hex(header[4:36]),
+                    UINT32.unpack_from(header, 72)[0],
+                )
+                pos += 8 + size
+            file_num += 1
+    
+    def close(self) -> None:
+        for mm in self.__mmaps.values():
+            mm.close()
+        self.__mmaps.clear()
+
+
+def read_block_index(index_path: str) -> Dict[BlockHeight, BlockLocation]:
+    """
+    read the block index db (blocks/index) and return the location of every block in
+    the best chain, by height (see __best_chain).
+    if the db is locked (bitcoind is running), a copy of it is read
+    """
+    try:
+        db = plyvel.DB(index_path)
+    except plyvel.IOError:
+        tmpdir = tempfile.mkdtemp()
+        copy_path = os.path.join(tmpdir, "index")
+        shutil.copytree(index_path, copy_path, ignore=shutil.ignore_patterns("LOCK"))
+        try:
+            return read_block_index(copy_path)
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    # hash -> (height, prev hash, work, location)
+    entries: Dict[BlockHash, Tuple[BlockHeight, BlockHash, int, Optional[BlockLocation]]] = {}
+    try:
+        for key, value in db.iterator(prefix=b"b"):
+            _, pos = read_varint(value, 0)  # client version
+            height, pos = read_varint(value, pos)
+            status, pos = read_varint(value, pos)
+            _, pos = read_varint(value, pos)  # number of txs
+            file_num = data_pos = None
+            if status & (BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO):
+                file_num, pos = read_varint(value, pos)
+            if status & BLOCK_HAVE_DATA:
+                data_pos, pos = read_varint(value, pos)
+            if status & BLOCK_HAVE_UNDO:
+                _, pos = read_varint(value, pos)
+            # the rest is the block header
+            prev_hash = hash_to_hex(value[pos + 4:pos + 36])
+            bits = UINT32.unpack_from(value, pos + 72)[0]
+            
+            valid = (
+                status & BLOCK_HAVE_DATA
+                and status & BLOCK_VALID_MASK >= BLOCK_VALID_TRANSACTIONS
+                and not status & BLOCK_FAILED_MASK
+            )
+            location = BlockLocation(file_num=file_num, data_pos=data_pos) if valid else None
+            entries[hash_to_hex(key[1:])] = (height, prev_hash, block_work(bits), location)
+    finally:
+        db.close()
+    
+    return __best_chain(entries)
+
+
+def __best_chain(
+    entries: Dict[BlockHash, Tuple[BlockHeight, BlockHash, int, Optional[BlockLocation]]],
+) -> Dict[BlockHeight, BlockLocation]:
+    """
+    given all known blocks (hash -> height, prev hash, work and location, or None if
+    not usable), return the locations of the blocks in the best chain, by height.
+    
+    as in bitcoind, the best chain ends in the usable block with the most chainwork.
+    of tips with the same chainwork, bitcoind keeps the one it received first, which is
+    approximated by the one that was written first to the block files
+    """
+    chainwork: Dict[BlockHash, int] = {}
+    for block_hash, (_, prev_hash, work, _) in sorted(entries.items(), key=lambda item: item[1][0]):
+        chainwork[block_hash] = chainwork.get(prev_hash, 0) + work
+    
+    usable = [
+        (chainwork[block_hash], -loc.file_num, -loc.data_pos, block_hash)
+        for block_hash, (_, _, _, loc) in entries.items() if loc is not None
+    ]
+    if not usable:
+        return {}
+    *_, tip = max(usable)
+    chain = {}
+    block_hash = tip
+    while block_hash in entries:
+        height, prev_hash, _, location = entries[block_hash]
+        if location is None:
+            break
+        chain[height] = location
+        block_hash = prev_hash
+    return chain
+
+
+def scan_block_files(block_files: BlockFiles) -> Dict[BlockHeight, BlockLocation]:
+    """
+    find the best chain by scanning all block files, without the block index.
+    this is slower than read_block_index, and heights are correct only if the files
+    contain the chain from the genesis block (i.e. the node is not pruned)
+    """
+    prev_of: Dict[BlockHash, BlockHash] = {}
+    location_of: Dict[BlockHash, BlockLocation] = {}
+    work_of: Dict[BlockHash, int] = {}
+    for location, block_hash, prev_hash, bits in block_files.scan():
+        prev_of[block_hash] = prev_hash
+        location_of[block_hash] = location
+        work_of[block_hash] = block_work(bits)
+    
+    # heights are the distances from the first block, whose parent isn't in the files
+    heights: Dict[BlockHash, BlockHeight] = {}
+    for block_hash in prev_of:
+        path = []
+        h = block_hash
+        while h in prev_of and h not in heights:
+            path.append(h)
+            h = prev_of[h]
+        height = heights[h] if h in heights else -1
+        for h in reversed(path):
+            height += 1
+            heights[h] = height
+    
+    return __best_chain({
+        block_hash: (heights[block_hash], prev_of[block_hash], work_of[block_hash], location_of[block_hash])
+        for block_hash in prev_of
+    })
+
+
+def compute_parsed_block_stats(
+    block: ParsedBlock,
+    height: BlockHeight,
+    store: OutpointValueStore,
+) -> Dict[TXID, TxStats]:
+    """
+    compute the stats of all txs in a parsed block, ordered as in the block.
+    
+    the values of spent outputs are taken from the block itself and from the outpoint
+    store. blocks should be processed in height order, so the store contains all
+    outputs created since the first processed block. outputs that are not in the store
+    (created before it was filled) are fetched from bitcoind.
+    the block's outputs are added to the store, and the outputs it spends are removed
+    """
+    created: Dict[Outpoint, Satoshi] = {
+        (tx.txid, n): value
+        for tx in block.txs
+        for n, value in enumerate(tx.outputs)
+    }
+    spent = [outpoint for tx in block.txs for outpoint in tx.inputs]
+    
+    values = dict(created)
+    values.update(
+        (outpoint, value)
+        for outpoint, value in store.get_many(o for o in spent if o not in created).items()
+        if value is not None
+    )
+    missing_parents = {txid for txid, n in spent if (txid, n) not in values}
+    for parent in get_transactions(missing_parents).values():
+        values.update(tx_outputs_values(parent))
+    
+    stats = {
+        tx.txid: TxStats(
+            txid=tx.txid,
+            fee=0 if tx.coinbase else sum(values[outpoint] for outpoint in tx.inputs) - sum(tx.outputs),
+            size=tx.size,
+            weight=tx.weight,
+        )
+        for tx in block.txs
+    }
+    
+    store.apply(created=created, spent=spent, height=height)
+    return stats
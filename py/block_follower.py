@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+import time
+from logging import Logger
+from typing import Callable, Dict, Iterable, Optional
+
+from bitcoin_cli import blockchain_height, rpc_call
+from datatypes import BlockHash, BlockHeight
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+"""
+Follow the best chain and ingest every new block once, as soon as it arrives,
+instead of re-walking all blocks periodically.
+
+A BlockFollower keeps a durable high-water mark (the last ingested height, and the
+hashes of the last ingested blocks), so it resumes where it stopped and detects
+reorgs. New blocks are announced by bitcoind's ZMQ notifications (-zmqpubhashblock
+or -zmqpubrawblock) if available, and otherwise by long-polling waitfornewblock.
+"""
+
+# number of recent block hashes kept in the state. reorgs deeper than that are
+# detected, but the blocks below them are not rolled back
+HASHES_KEPT = 100
+
+DEFAULT_POLL_TIMEOUT = 60  # seconds
+
+
+class LongPollNotifications:
+    """
+    wait for new blocks with bitcoind's waitfornewblock (or waitforblockheight).
+    with waitforblockheight, a reorg to a chain of the same height is noticed only
+    once the wait times out
+    """
+    
+    def wait(self, timeout: float, tip_height: BlockHeight = None) -> None:
+        """
+        return when the tip changes, or after `timeout` seconds.
+        if tip_height (the last tip the caller saw) is given, return as soon as the tip
+        is above it, even if it changed before the wait began
+        """
+        # at least 1 ms, since 0 means no timeout
+        timeout_ms = max(1, int(timeout * 1000))
+        if tip_height is None:
+            rpc_call("waitfornewblock", timeout_ms, limited=False)
+        else:
+            rpc_call("waitforblockheight", tip_height + 1, timeout_ms, limited=False)
+    
+    def close(self) -> None:
+        pass
+
+
+class ZMQNotifications:
+    """
+    wait for new blocks with bitcoind's ZMQ notifications. the endpoint is the
+    address given to -zmqpubhashblock (or -zmqpubrawblock), e.g. tcp://127.0.0.1:28332
+    """
+    
+    def __init__(self, endpoint: str, topics: Iterable[str] = ("hashblock", "rawblock")) -> None:
+        if zmq is None:
+            raise ImportError("ZMQ notifications require pyzmq (pip install pyzmq)")
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.SUB)
+        for topic in topics:
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic.encode("utf-8"))
+        self.socket.connect(endpoint)
+    
+    def wait(self, timeout: float, tip_height: BlockHeight = None) -> None:
+        """
+        return when a block is announced, or after `timeout` seconds.
+        notifications that arrived before the wait began are kept by the socket, so
+        tip_height isn't needed
+        """
+        if self.socket.poll(timeout=int(timeout * 1000)):
+            # the message itself doesn't matter, as the follower asks bitcoind for
+            # the chain anyway. drop all pending ones, so a burst triggers a single sync
+            while self.socket.poll(timeout=0):
+                self.socket.recv_multipart()
+    
+    def close(self) -> None:
+        self.socket.close()
+
+
+def get_notifications(zmq_endpoint: Optional[str]):
+    """
+    return ZMQ notifications from the given endpoint, or long-poll notifications
+    if it is None
+    """
+    return ZMQNotifications(zmq_endpoint) if zmq_endpoint else LongPollNotifications()
+
+
+class BlockFollower:
+    """
+    Call on_block(height) for every block of the best chain from first_block on,
+    in height order, and on_rollback(height) for every ingested block that was
+    disconnected by a reorg (from the top down), before the blocks that replaced
+    it are ingested.
+    
+    on_block may fail by raising or by returning False. the high-water mark is not
+    advanced past a failed block, and it is retried on the next sync.
+    """
+    
+    def __init__(
+        self,
+        state_path: str,
+        first_block: BlockHeight,
+        on_block: Callable[[BlockHeight], Optional[bool]],
+        on_rollback: Callable[[BlockHeight], None] = None,
+        notifications=None,
+        poll_timeout: float = DEFAULT_POLL_TIMEOUT,
+        before_sync: Callable[[], None] = None,
+        logger: Logger = None,
+    ) -> None:
+        """
+        state_path: the file in which the high-water mark is kept
+        notifications: a ZMQNotifications or LongPollNotifications (default)
+        poll_timeout: max seconds to wait for a notification before syncing anyway
+        before_sync: called at the beginning of every sync (e.g. to update an index)
+        """
+        self.state_path = state_path
+        self.first_block = first_block
+        self.on_block = on_block
+        self.on_rollback = on_rollback
+        self.notifications = notifications if notifications is not None else LongPollNotifications()
+        self.poll_timeout = poll_timeout
+        self.before_sync = before_sync
+        self.logger = logger
+        
+        self.height: BlockHeight = first_block - 1  # the high-water mark
+        self.tip_height: Optional[BlockHeight] = None  # the tip at the last sync
+        self.hashes: Dict[BlockHeight, BlockHash] = {}
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            self.height = state["height"]
+            self.hashes = {int(h): block_hash for h, block_hash in state["hashes"].items()}
+    
+    def __log(self, msg: str) -> None:
+        if self.logger is not None:
+            self.logger.info(msg)
+    
+    def __save(self) -> None:
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"height": self.height, "hashes": self.hashes}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.state_path)
+    
+    def __find_fork(self, tip_height: BlockHeight) -> BlockHeight:
+        """
+        return the highest ingested height (up to the tip) whose block is still in the
+        best chain
+        """
+        start = h = min(self.height, tip_height)
+        while h in self.hashes and rpc_call("getblockhash", h) != self.hashes[h]:
+            h -= 1
+        if h >= self.first_block and h not in self.hashes and h < start:
+            self.__log(f"reorg deeper than {HASHES_KEPT} blocks. rolling back to height {h} only")
+        return h
+    
+    def __rollback(self, fork_height: BlockHeight) -> None:
+        self.__log(f"reorg: rolling back blocks {fork_height + 1}-{self.height}")
+        for h in range(self.height, fork_height, -1):
+            if self.on_rollback is not None:
+                self.on_rollback(h)
+            self.hashes.pop(h, None)
+            self.height = h - 1
+            self.__save()
+    
+    def sync(self) -> int:
+        """
+        roll back disconnected blocks and ingest all new blocks up to the current tip.
+        return the number of blocks ingested
+        """
+        if self.before_sync is not None:
+            self.before_sync()
+        tip_height = blockchain_height()
+        self.tip_height = tip_height
+        fork_height = self.__find_fork(tip_height)
+        if fork_height < min(self.height, tip_height):
+            self.__rollback(fork_height)
+        elif tip_height < self.height:
+            # the blocks up to the tip are ours, so bitcoind is behind us (e.g. it is
+            # reindexing, or it's another node that is still syncing), not reorged.
+            # the blocks above its tip are kept until it catches up
+            self.__log(f"bitcoind's tip ({tip_height}) is below the high-water mark ({self.height}). waiting for it")
+            return 0
+        
+        ingested = 0
+        for h in range(self.height + 1, tip_height + 1):
+            # the hash is taken before the block is ingested. if the block changes
+            # in between, the next sync sees the old hash and rolls it back
+            block_hash = rpc_call("getblockhash", h)
+            try:
+                success = self.on_block(h) is not False
+            except Exception as e:
+                self.__log(f"failed to ingest block {h}: {type(e)}: {str(e)}")
+                success = False
+            if not success:
+                break
+            self.height = h
+            self.hashes[h] = block_hash
+            self.hashes.pop(h - HASHES_KEPT, None)
+            self.__save()
+            ingested += 1
+        return ingested
+    
+    def follow(self, stop: threading.Event = None) -> None:
+        """
+        sync, and then sync again whenever a new block arrives, until `stop` is set
+        """
+        while stop is None or not stop.is_set():
+            try:
+                ingested = self.sync()
+                if ingested:
+                    self.__log(f"ingested {ingested} blocks. high-water mark: {self.height}")
+            except Exception as e:
+                # e.g. bitcoind is restarting. we'll try again after the wait
+                self.__log(f"sync failed: {type(e)}: {str(e)}")
+            try:
+                # blocks that arrived since the sync fetched the tip end the wait at once
+                self.notifications.wait(self.poll_timeout, tip_height=self.tip_height)
+            except Exception as e:
+                self.__log(f"waiting for a new block failed: {type(e)}: {str(e)}")
+                if stop is not None:
+                    stop.wait(self.poll_timeout)
+                else:
+                    time.sleep(self.poll_timeout)
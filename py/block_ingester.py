@@ -0,0 +1,533 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from logging import Logger
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import bitcoin_cli
+from bitcoin_cli import compute_block_txs_stats, get_block_hash, get_block_with_txs
+from block_files import BlockFiles, BlockLocation, compute_parsed_block_stats, parse_block
+from columnar_store import ColumnarStore
+from datatypes import BlockHeight, TXID, TxStats
+from ingest_manifest import IngestManifest
+from outpoint_store import OutpointValueStore
+from shared_store import Namespace, migrate_leveldb
+
+"""
+A single pipeline that ingests blocks: every block is fetched once, the stats of
+its txs (fee, size, weight and feerate) are computed once, and are handed to any
+number of sinks (tsv files, the function caches, the columnar store, etc.).
+
+The ingester records the blocks it finished, and the ones that failed, in a manifest
+(see ingest_manifest), so a ranged run fetches only the blocks that are missing,
+without checking the sinks for every block of the range. when following the chain,
+the high-water mark of the BlockFollower decides which blocks are fetched, and the
+manifest is kept up to date.
+
+A ranged run with depth > 1 is pipelined across blocks, in three stages:
+1. up to `depth` blocks after the last committed one are fetched concurrently
+2. they are parsed (on a process pool, if the source's parsing is CPU-bound) and
+   the stats of their txs are computed, for several blocks at once
+3. the stats are written to the sinks, and marked in the manifest, in height order
+so the workers aren't left idle at the end of every block, as when blocks are
+ingested one after another.
+"""
+
+TSV_SEPARATOR = "\t"
+
+# the sinks are flushed, and the manifest is saved, every that many blocks
+CHECKPOINT_EVERY = 100
+
+# max number of tasks waiting for a worker of the pool, per worker
+PENDING_TASKS_PER_WORKER = 4
+
+# number of blocks in flight in a pipelined run
+PIPELINE_DEPTH = 8
+
+
+class BoundedExecutor(ThreadPoolExecutor):
+    """
+    a ThreadPoolExecutor whose submit blocks while max_pending tasks are pending
+    (queued or running), so a producer can't run ahead of the workers (e.g. an
+    executor.map over all the parents of a block)
+    """
+    
+    def __init__(self, max_workers: int = None, max_pending: int = None) -> None:
+        super().__init__(max_workers=max_workers)
+        if max_pending is None:
+            max_pending = self._max_workers * PENDING_TASKS_PER_WORKER
+        self.max_pending = max_pending
+        self.__slots = threading.BoundedSemaphore(max_pending)
+    
+    def submit(self, fn, *args, **kwargs) -> Future:
+        self.__slots.acquire()
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except BaseException:
+            self.__slots.release()
+            raise
+        future.add_done_callback(lambda _: self.__slots.release())
+        return future
+
+
+class Sink:
+    """
+    a destination of the stats of ingested blocks
+    """
+    name = "sink"
+    # True if blocks must be written in height order, without gaps. once a block
+    # fails, no later block of the run is written to such a sink
+    ordered = False
+    
+    def has_block(self, h: BlockHeight) -> bool:
+        """
+        return True if the stats of block h were already written (so they are not
+        fetched again). a sink that can't tell returns False
+        """
+        return False
+    
+    def write_block(self, h: BlockHeight, stats: Dict[TXID, TxStats]) -> None:
+        raise NotImplementedError()
+    
+    def remove_block(self, h: BlockHeight) -> None:
+        """
+        forget block h (e.g. if it was disconnected by a reorg)
+        """
+        pass
+    
+    def flush(self) -> None:
+        """
+        make everything written so far durable
+        """
+        pass
+
+
+class TsvSink(Sink):
+    """
+    a tsv file per block, with a `txid<TAB>value` line per tx, where the value is
+    the given attribute of TxStats (e.g. "feerate", "weight").
+    files are written as a whole, so a file that exists is complete
+    """
+    
+    def __init__(self, folder: str, filename_format: str, attribute: str) -> None:
+        """
+        filename_format: the name of the file of a block, formatted with its height
+                         as `h`, e.g. "block_{h}_feerates.tsv"
+        """
+        self.folder = folder
+        self.filename_format = filename_format
+        self.attribute = attribute
+        self.name = f"tsv:{attribute}"
+    
+    def get_filepath(self, h: BlockHeight) -> str:
+        return os.path.join(self.folder, self.filename_format.format(h=h))
+    
+    def has_block(self, h: BlockHeight) -> bool:
+        return os.path.isfile(self.get_filepath(h))
+    
+    def write_block(self, h: BlockHeight, stats: Dict[TXID, TxStats]) -> None:
+        filepath = self.get_filepath(h)
+        # use tmp suffix until we finish with that block (in case we crash before we dumped all txs)
+        filepath_tmp = f"{filepath}.tmp"
+        with open(filepath_tmp, mode="w") as f:
+            for txid, tx_stats in stats.items():
+                f.write(f"{txid}{TSV_SEPARATOR}{getattr(tx_stats, self.attribute)}\n")
+        os.rename(filepath_tmp, filepath)
+    
+    def remove_block(self, h: BlockHeight) -> None:
+        filepath = self.get_filepath(h)
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+
+class CacheSink(Sink):
+    """
+    the caches of functions of a single txid (e.g. get_tx_feerate), by the attribute
+    of TxStats they cache. if marks (a db, e.g. a Namespace of the shared store) are
+    given, the blocks that were written are marked in it, by their height.
+    
+    the caches are written with cache_put_many, so they are buffered and batched
+    under bulk_population. the marks are kept in memory until flush, which writes
+    them once the caches were flushed, so a block is never marked before its txs
+    are on disk
+    """
+    name = "caches"
+    
+    MARK = b"True"
+    
+    def __init__(self, funcs: Dict[str, Callable], marks: Namespace = None) -> None:
+        self.funcs = funcs
+        self.marks = marks
+        # height -> True if it should be marked, False if its mark should be deleted
+        self.__pending_marks: Dict[BlockHeight, bool] = {}
+    
+    @property
+    def cached_funcs(self) -> List[Callable]:
+        """
+        the cached functions, to give to bulk_population
+        """
+        return list(self.funcs.values())
+    
+    @staticmethod
+    def __mark_key(h: BlockHeight) -> bytes:
+        # as leveldb_cache keyed the marks when blocks were marked by calling a cached function
+        return str(h).encode("utf-8")
+    
+    def has_block(self, h: BlockHeight) -> bool:
+        if self.marks is None:
+            return False
+        if h in self.__pending_marks:
+            return self.__pending_marks[h]
+        return self.marks.get(self.__mark_key(h)) is not None
+    
+    def write_block(self, h: BlockHeight, stats: Dict[TXID, TxStats]) -> None:
+        args_list = [(txid,) for txid in stats.keys()]
+        for attribute, func in self.funcs.items():
+            func.cache_put_many([getattr(tx_stats, attribute) for tx_stats in stats.values()], args_list)
+        if self.marks is not None:
+            self.__pending_marks[h] = True
+    
+    def remove_block(self, h: BlockHeight) -> None:
+        # cached values are kept, as they are per tx and don't depend on the block
+        if self.marks is not None:
+            self.__pending_marks[h] = False
+    
+    def flush(self) -> None:
+        for func in self.cached_funcs:
+            func.flush()
+        if self.__pending_marks:
+            with self.marks.write_batch() as wb:
+                for h, marked in self.__pending_marks.items():
+                    if marked:
+                        wb.put(self.__mark_key(h), self.MARK)
+                    else:
+                        wb.delete(self.__mark_key(h))
+            self.__pending_marks.clear()
+
+
+# written to the marks of CacheSink once the marks of a legacy db were copied into them
+LEGACY_MARKS_MIGRATED_KEY = b"\x00legacy_marks_migrated"
+
+
+def migrate_legacy_marks(marks: Namespace, legacy_path: str, logger: Logger = None) -> None:
+    """
+    copy the marks of the blocks that were populated when they were kept in a db of
+    their own (the leveldb_cache of populate_block) into marks, once. the legacy db
+    is left in place (delete it with migrate_caches_to_shared_store.py --delete-old).
+    marks deleted since the migration (e.g. by a reorg) are not brought back
+    """
+    if not os.path.isdir(legacy_path) or marks.get(LEGACY_MARKS_MIGRATED_KEY) is not None:
+        return
+    copied = migrate_leveldb(legacy_path, marks)
+    marks.put(LEGACY_MARKS_MIGRATED_KEY, b"True")
+    if logger is not None:
+        logger.info(f"copied {copied} marks of populated blocks from {legacy_path}")
+
+
+class ColumnarSink(Sink):
+    """
+    the columnar store (see columnar_store), to which blocks are appended in height order
+    """
+    name = "columnar"
+    ordered = True
+    
+    def __init__(self, store: ColumnarStore) -> None:
+        self.store = store
+    
+    def has_block(self, h: BlockHeight) -> bool:
+        return h in self.store
+    
+    def write_block(self, h: BlockHeight, stats: Dict[TXID, TxStats]) -> None:
+        self.store.append_block(h, stats)
+    
+    def remove_block(self, h: BlockHeight) -> None:
+        # blocks are removed from the tip (see BlockFollower), so this removes h only
+        self.store.truncate(h)
+    
+    def flush(self) -> None:
+        self.store.flush()
+
+
+class BlockSource:
+    """
+    where the ingester gets blocks from, and how it computes the stats of their txs.
+    a block goes through fetch (I/O-bound, on a thread), parse (CPU-bound, may run on
+    a process pool, so it must be a picklable function) and compute_stats
+    """
+    # a picklable function of what fetch returns, run on the process pool of the
+    # ingester (if any). None if fetch returns blocks that are already parsed
+    parse: Optional[Callable[[Any], Any]] = None
+    
+    @property
+    def ordered(self) -> bool:
+        """
+        True if compute_stats must be called for every block, in height order (e.g.
+        it updates the outpoint store), in which case the ingester doesn't skip
+        blocks that all sinks have, and doesn't compute stats of several blocks at once
+        """
+        return False
+    
+    def fetch(self, h: BlockHeight) -> Any:
+        raise NotImplementedError()
+    
+    def compute_stats(self, h: BlockHeight, block: Any, executor: Executor) -> Dict[TXID, TxStats]:
+        raise NotImplementedError()
+
+
+class RpcBlockSource(BlockSource):
+    """
+    blocks from bitcoind (with prevouts, if supported). the response is parsed as it
+    is received, so there is no parse stage. the parents of txs are fetched on the
+    given executor if needed, which is I/O-bound, so the stats of several blocks may
+    be computed at once on threads
+    """
+    
+    @property
+    def ordered(self) -> bool:
+        return bitcoin_cli.OUTPOINT_STORE is not None
+    
+    def fetch(self, h: BlockHeight) -> Any:
+        return get_block_with_txs(get_block_hash(h))
+    
+    def compute_stats(self, h: BlockHeight, block: Any, executor: Executor) -> Dict[TXID, TxStats]:
+        return compute_block_txs_stats(block, executor=executor)
+
+
+class BlockFilesSource(BlockSource):
+    """
+    blocks from bitcoind's block files (see block_files), where parsing the raw
+    blocks is the CPU-bound part. fees are computed with the outpoint store, in
+    height order
+    """
+    parse = staticmethod(parse_block)
+    
+    def __init__(self, block_files: BlockFiles, chain: Dict[BlockHeight, BlockLocation], store: OutpointValueStore) -> None:
+        self.block_files = block_files
+        self.chain = chain
+        self.store = store
+    
+    @property
+    def ordered(self) -> bool:
+        return True
+    
+    def fetch(self, h: BlockHeight) -> bytes:
+        return self.block_files.read_block_bytes(self.chain[h])
+    
+    def compute_stats(self, h: BlockHeight, block: Any, executor: Executor) -> Dict[TXID, TxStats]:
+        return compute_parsed_block_stats(block, height=h, store=self.store)
+
+
+class BlockIngester:
+    """
+    fetch blocks, compute the stats of their txs, and write them to all sinks.
+    
+    the parents of txs (when bitcoind doesn't provide prevouts) are fetched on a
+    single pool of max_workers workers, shared by all blocks, whose queue is
+    bounded by max_pending tasks
+    """
+    
+    def __init__(
+        self,
+        sinks: Sequence[Sink],
+        manifest: IngestManifest = None,
+        max_workers: int = None,
+        max_pending: int = None,
+        checkpoint_every: int = CHECKPOINT_EVERY,
+        source: BlockSource = None,
+        depth: int = 1,
+        processes: int = 0,
+        logger: Logger = None,
+    ) -> None:
+        """
+        manifest: where the blocks that were ingested, or failed, are recorded (None
+                  to check the sinks for every block)
+        source: where blocks are taken from (bitcoind by default)
+        depth: the number of blocks in flight in a ranged run (1 to ingest blocks one
+               after another)
+        processes: the size of the process pool the blocks are parsed on, in a ranged
+                   run (0 to parse them on the threads that fetch them)
+        """
+        self.sinks = list(sinks)
+        self.manifest = manifest
+        self.checkpoint_every = checkpoint_every
+        self.source = source if source is not None else RpcBlockSource()
+        self.depth = max(depth, 1)
+        self.processes = processes
+        self.logger = logger
+        self.executor = BoundedExecutor(max_workers=max_workers, max_pending=max_pending)
+    
+    def __log(self, msg: str, error: bool = False) -> None:
+        if self.logger is not None:
+            if error:
+                self.logger.error(msg)
+            else:
+                self.logger.info(msg)
+    
+    def __is_done(self, h: BlockHeight) -> bool:
+        return self.manifest is not None and self.manifest.is_done(h)
+    
+    def __sinks_to_write(self, h: BlockHeight) -> List[Sink]:
+        if self.__is_done(h):
+            return []
+        return [sink for sink in self.sinks if not sink.has_block(h)]
+    
+    def __mark_done(self, h: BlockHeight) -> None:
+        if self.manifest is not None:
+            self.manifest.mark_done(h)
+    
+    def __mark_failed(self, h: BlockHeight, e: Exception) -> None:
+        self.__log(f"Failed to retrieve the txs of block {h}: {type(e)}: {str(e)}", error=True)
+        if self.manifest is not None:
+            self.manifest.mark_failed(h, reason=f"{type(e).__name__}: {str(e)}")
+    
+    def __prepare_block(self, h: BlockHeight, parse_pool: Optional[Executor], compute: bool) -> Any:
+        """
+        the fetch and parse stages of block h, followed by its stats if compute is True
+        """
+        block = self.source.fetch(h)
+        if self.source.parse is not None:
+            if parse_pool is not None:
+                block = parse_pool.submit(self.source.parse, block).result()
+            else:
+                block = self.source.parse(block)
+        if compute:
+            return self.source.compute_stats(h, block, self.executor)
+        return block
+    
+    def __write_block(self, h: BlockHeight, sinks: List[Sink], stats: Dict[TXID, TxStats]) -> None:
+        if sinks:
+            self.__log(f"Ingesting block {h} into {', '.join(sink.name for sink in sinks)}")
+        for sink in sinks:
+            sink.write_block(h, stats)
+    
+    def ingest_block(self, h: BlockHeight) -> bool:
+        """
+        write the stats of block h to the sinks that don't have it yet.
+        return False if the block couldn't be retrieved
+        """
+        sinks = self.__sinks_to_write(h)
+        if not sinks and not self.source.ordered:
+            self.__mark_done(h)
+            return True  # this block was already ingested
+        
+        try:
+            stats = self.__prepare_block(h, parse_pool=None, compute=True)
+        except Exception as e:
+            self.__mark_failed(h, e)
+            return False
+        self.__write_block(h, sinks, stats)
+        self.__mark_done(h)
+        return True
+    
+    def ingest_block_and_flush(self, h: BlockHeight) -> bool:
+        """
+        ingest block h and make it durable in all sinks (e.g. before the follower
+        advances its high-water mark)
+        """
+        success = self.ingest_block(h)
+        self.flush()
+        return success
+    
+    def remove_block(self, h: BlockHeight) -> None:
+        for sink in self.sinks:
+            sink.remove_block(h)
+        if self.manifest is not None:
+            self.manifest.unmark(h)
+        self.flush()
+    
+    def flush(self) -> None:
+        """
+        make the sinks durable, and then the manifest, so it never records a block
+        that isn't in the sinks
+        """
+        for sink in self.sinks:
+            sink.flush()
+        if self.manifest is not None:
+            self.manifest.save()
+    
+    def __heights_to_run(self, first_block: BlockHeight, last_block: BlockHeight, max_retries: int = None) -> List[BlockHeight]:
+        if self.manifest is None:
+            return list(range(first_block, last_block + 1))
+        missing = self.manifest.missing(first_block, last_block, max_retries=max_retries)
+        if missing and self.source.ordered:
+            # the stats are computed for every block from the first missing one, in order
+            missing = list(range(missing[0], last_block + 1))
+        skipped = (last_block - first_block + 1) - len(missing)
+        if skipped > 0:
+            self.__log(f"skipping {skipped} blocks that were ingested (or failed {max_retries} times)")
+        return missing
+    
+    def run(self, first_block: BlockHeight, last_block: BlockHeight, max_retries: int = None) -> List[BlockHeight]:
+        """
+        ingest the blocks of first_block..last_block (inclusive) that the manifest
+        doesn't have (all of them, if there is no manifest). a block that fails
+        doesn't stop the run, and is retried by the next run.
+        max_retries: skip blocks that already failed that many times
+        return the heights of the blocks that failed
+        """
+        heights = iter(self.__heights_to_run(first_block, last_block, max_retries=max_retries))
+        ordered = self.source.ordered
+        failed = []
+        
+        fetch_pool = ThreadPoolExecutor(max_workers=self.depth)
+        parse_pool = ProcessPoolExecutor(max_workers=self.processes) if self.processes > 0 else None
+        # the blocks in flight, in height order: (height, sinks to write, future of
+        # the stats, or of the parsed block if the stats are computed in order).
+        # None instead of a future if there is nothing to do
+        in_flight: Deque[Tuple[BlockHeight, List[Sink], Optional[Future]]] = deque()
+        
+        def submit_next() -> None:
+            h = next(heights, None)
+            if h is None:
+                return
+            sinks = self.__sinks_to_write(h)
+            future = None
+            if sinks or ordered:
+                future = fetch_pool.submit(self.__prepare_block, h, parse_pool, not ordered)
+            in_flight.append((h, sinks, future))
+        
+        try:
+            for _ in range(self.depth):
+                submit_next()
+            i = 0
+            while in_flight:
+                h, sinks, future = in_flight.popleft()
+                submit_next()
+                stats = None
+                try:
+                    if future is not None:
+                        stats = future.result()
+                        if ordered:
+                            stats = self.source.compute_stats(h, stats, self.executor)
+                except Exception as e:
+                    self.__mark_failed(h, e)
+                    failed.append(h)
+                else:
+                    complete = True
+                    if failed and any(sink.ordered for sink in sinks):
+                        # the block before is missing in the ordered sinks
+                        sinks = [sink for sink in sinks if not sink.ordered]
+                        complete = False
+                    if stats is not None:
+                        self.__write_block(h, sinks, stats)
+                    if complete:
+                        self.__mark_done(h)
+                i += 1
+                if i % self.checkpoint_every == 0:
+                    self.flush()
+        finally:
+            # on an error (e.g. a sink failed), don't wait for the blocks in flight
+            for _, _, future in in_flight:
+                if future is not None:
+                    future.cancel()
+            fetch_pool.shutdown()
+            if parse_pool is not None:
+                parse_pool.shutdown()
+        
+        self.flush()
+        return failed
+    
+    def close(self) -> None:
+        self.flush()
+        self.executor.shutdown()
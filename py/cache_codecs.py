@@ -0,0 +1,182 @@
+import os
+import shutil
+import struct
+import time
+from logging import Logger
+from typing import Any, Callable
+
+import plyvel
+
+from cache_eviction import METADATA_PREFIX
+
+"""
+Binary encodings of the keys and values of leveldb_cache decorated functions.
+
+By default the caches hold strings (see leveldb_cache), so that other applications
+can read them. A cache may be converted to binary (see convert_cache_format.py),
+which is smaller and faster to parse: e.g. a txid key is 32 raw bytes instead of 64
+hex chars, and a feerate is a packed float64 instead of its repr.
+
+The format of a db is recorded in the db itself, under FORMAT_KEY. a db without
+that key is in text format.
+"""
+
+# no text key starts with a zero byte, and no binary key is that short
+FORMAT_KEY = b"\x00cache_format"
+TEXT_FORMAT = b"text"
+BINARY_FORMAT = b"binary"
+
+__FLOAT64 = struct.Struct("<d")
+
+
+def encode_varint(n: int) -> bytes:
+    """
+    encode a non-negative int as a LEB128 varint (7 bits per byte, little endian)
+    """
+    if n < 0:
+        raise ValueError(f"varint can't encode a negative number: {n}")
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(b: bytes) -> int:
+    n = 0
+    for i, byte in enumerate(b):
+        n |= (byte & 0x7f) << (7 * i)
+    return n
+
+
+def encode_float64(x: float) -> bytes:
+    return __FLOAT64.pack(x)
+
+
+def decode_float64(b: bytes) -> float:
+    return __FLOAT64.unpack(b)[0]
+
+
+class BinaryCodec:
+    """
+    how the keys and values of a cache are encoded in binary format.
+    
+    key_to_bytes: takes the arguments of the cached function and returns the key
+    str_key_to_bytes, bytes_to_str_key: convert between the key of some arguments
+                                        in text format and in binary format
+    value_to_bytes, bytes_to_value: encode and decode results of the function
+    """
+    
+    def __init__(
+        self,
+        key_to_bytes: Callable[..., bytes],
+        str_key_to_bytes: Callable[[str], bytes],
+        bytes_to_str_key: Callable[[bytes], str],
+        value_to_bytes: Callable[[Any], bytes],
+        bytes_to_value: Callable[[bytes], Any],
+    ) -> None:
+        self.key_to_bytes = key_to_bytes
+        self.str_key_to_bytes = str_key_to_bytes
+        self.bytes_to_str_key = bytes_to_str_key
+        self.value_to_bytes = value_to_bytes
+        self.bytes_to_value = bytes_to_value
+
+
+def txid_to_bytes(txid: str) -> bytes:
+    return bytes.fromhex(txid)
+
+
+# for functions of a single txid
+TXID_FLOAT64_CODEC = BinaryCodec(
+    key_to_bytes=txid_to_bytes,
+    str_key_to_bytes=txid_to_bytes,
+    bytes_to_str_key=bytes.hex,
+    value_to_bytes=encode_float64,
+    bytes_to_value=decode_float64,
+)
+TXID_VARINT_CODEC = BinaryCodec(
+    key_to_bytes=txid_to_bytes,
+    str_key_to_bytes=txid_to_bytes,
+    bytes_to_str_key=bytes.hex,
+    value_to_bytes=encode_varint,
+    bytes_to_value=decode_varint,
+)
+
+# the text and binary formats of the caches that may be converted, by function
+# name: (value_to_str, str_to_value, binary codec).
+# the decorators of these functions must use the same conversions
+CONVERTIBLE_CACHES = {
+    "get_tx_feerate": (str, float, TXID_FLOAT64_CODEC),
+    "get_tx_weight": (str, int, TXID_VARINT_CODEC),
+}
+
+
+def convert_leveldb_format(
+    db_path: str,
+    value_to_str: Callable[[Any], str],
+    str_to_value: Callable[[str], Any],
+    binary_codec: BinaryCodec,
+    to_binary: bool,
+    batch_size: int = 100_000,
+    logger: Logger = None,
+) -> int:
+    """
+    convert the leveldb of a leveldb_cache decorated function to binary format
+    (to_binary=True) or back to text format, and return the number of converted entries.
+    a db that doesn't exist is created empty in the requested format.
+    
+    the converted db is written next to the original one, which is replaced only
+    once the conversion completes. the db must not be open by anyone else
+    """
+    tmp_path = f"{db_path}.converting"
+    old_path = f"{db_path}.old"
+    if not os.path.exists(db_path) and os.path.exists(old_path) and os.path.exists(tmp_path):
+        # a previous conversion completed, but stopped before replacing the db
+        os.rename(tmp_path, db_path)
+        shutil.rmtree(old_path)
+    
+    src = plyvel.DB(db_path, create_if_missing=True)
+    if (src.get(FORMAT_KEY) == BINARY_FORMAT) == to_binary:
+        src.close()
+        return 0
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    dst = plyvel.DB(tmp_path, create_if_missing=True)
+    
+    t0 = time.time()
+    converted = 0
+    wb = dst.write_batch()
+    for key, value in src.iterator():
+        if key == FORMAT_KEY or key.startswith(METADATA_PREFIX):
+            # the access metadata of bounded caches isn't converted. it is rebuilt
+            continue
+        if to_binary:
+            wb.put(
+                binary_codec.str_key_to_bytes(key.decode("utf-8")),
+                binary_codec.value_to_bytes(str_to_value(value.decode("utf-8"))),
+            )
+        else:
+            wb.put(
+                binary_codec.bytes_to_str_key(key).encode("utf-8"),
+                value_to_str(binary_codec.bytes_to_value(value)).encode("utf-8"),
+            )
+        converted += 1
+        if converted % batch_size == 0:
+            wb.write()
+            wb = dst.write_batch()
+            if logger is not None:
+                logger.info(f"converted {converted} entries ({round(converted / (time.time() - t0))} entries/sec)")
+    if to_binary:
+        wb.put(FORMAT_KEY, BINARY_FORMAT)
+    wb.write()
+    src.close()
+    dst.close()
+    
+    os.rename(db_path, old_path)
+    os.rename(tmp_path, db_path)
+    shutil.rmtree(old_path)
+    return converted
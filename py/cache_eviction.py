@@ -0,0 +1,233 @@
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+"""
+Capacity limits, eviction and expiration of the disk caches (leveldb_cache and
+sqlite_cache), which are unlimited by default.
+
+The access metadata of every entry (when it was written, when it was last read
+and how many times) is kept in memory, so a cache hit is still a single db lookup
+plus a dictionary update. The metadata is written to the db in batches (see
+EvictionPolicy.take_dirty), and read back on the first use of the cache (not when it
+is opened, which would scan the whole db at import time). metadata that wasn't
+written before a crash only makes the eviction order less accurate.
+
+Entries are evicted in bulk: once the cache exceeds its capacity, it is trimmed
+down to LOW_WATERMARK of it, so the cost of sorting the entries is amortized over
+many insertions.
+"""
+
+# keys of entries in the db: bytes in leveldb, str in sqlite
+CacheKey = Union[bytes, str]
+
+# in a leveldb, the metadata of the entry with key k is kept under METADATA_PREFIX + k
+METADATA_PREFIX = b"\x00cache_meta\x00"
+
+LRU = "lru"
+LFU = "lfu"
+
+LOW_WATERMARK = 0.9
+
+# metadata of an entry: written at, last access (both unix time) and access count
+__METADATA = struct.Struct("<ddI")
+
+# number of dirty metadata records after which they should be written
+DIRTY_FLUSH_THRESHOLD = 1000
+
+
+class EntryMetadata:
+    __slots__ = ("size", "written_at", "last_access", "count")
+    
+    def __init__(self, size: int, written_at: float, last_access: float, count: int) -> None:
+        self.size = size
+        self.written_at = written_at
+        self.last_access = last_access
+        self.count = count
+
+
+def encode_metadata(metadata: EntryMetadata) -> bytes:
+    return __METADATA.pack(metadata.written_at, metadata.last_access, metadata.count)
+
+
+def decode_metadata(b: bytes, size: int) -> EntryMetadata:
+    written_at, last_access, count = __METADATA.unpack(b)
+    return EntryMetadata(size=size, written_at=written_at, last_access=last_access, count=count)
+
+
+class EvictionPolicy:
+    """
+    Track the entries of a cache and decide which to evict.
+    
+    max_entries: max number of entries in the cache (None for no limit)
+    max_bytes: max total size of the keys and values in the cache (None for no limit)
+    eviction: "lru" evicts the least recently used entries first, "lfu" the least
+              frequently used ones (ties are broken by recency)
+    ttl: seconds after which an entry expires, and is computed again on its next
+         lookup (None for no expiration). expired entries are evicted first
+    """
+    
+    def __init__(
+        self,
+        max_entries: int = None,
+        max_bytes: int = None,
+        eviction: str = LRU,
+        ttl: float = None,
+    ) -> None:
+        if eviction not in (LRU, LFU):
+            raise ValueError(f"unknown eviction policy: {eviction}. must be one of {LRU}, {LFU}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.ttl = ttl
+        self.evicted = 0
+        self.expired = 0
+        
+        self.__lock = threading.Lock()
+        self.__entries: Dict[CacheKey, EntryMetadata] = {}
+        self.__bytes = 0
+        self.__dirty: Dict[CacheKey, Optional[EntryMetadata]] = {}
+        self.__loader: Optional[Callable[[], Iterable[Tuple[CacheKey, int, Optional[bytes]]]]] = None
+    
+    def __len__(self) -> int:
+        with self.__lock:
+            self.__load_pending()
+            return len(self.__entries)
+    
+    @property
+    def total_bytes(self) -> int:
+        with self.__lock:
+            self.__load_pending()
+            return self.__bytes
+    
+    def load(self, entries: Iterable[Tuple[CacheKey, int, Optional[bytes]]]) -> None:
+        """
+        load the existing entries of the cache: tuples of (key, size, encoded metadata).
+        entries without metadata are considered as written and accessed now
+        """
+        with self.__lock:
+            self.__load(entries)
+    
+    def load_lazily(self, get_entries: Callable[[], Iterable[Tuple[CacheKey, int, Optional[bytes]]]]) -> None:
+        """
+        same as load(get_entries()), but called on the first use of the policy
+        """
+        with self.__lock:
+            self.__loader = get_entries
+    
+    def __load_pending(self) -> None:
+        # called with the lock held
+        if self.__loader is not None:
+            get_entries, self.__loader = self.__loader, None
+            self.__load(get_entries())
+    
+    def __load(self, entries: Iterable[Tuple[CacheKey, int, Optional[bytes]]]) -> None:
+        # called with the lock held
+        now = time.time()
+        for key, size, encoded in entries:
+            if encoded is not None:
+                metadata = decode_metadata(encoded, size)
+            else:
+                metadata = EntryMetadata(size=size, written_at=now, last_access=now, count=0)
+            self.__entries[key] = metadata
+            self.__bytes += size
+    
+    def on_hit(self, key: CacheKey) -> bool:
+        """
+        record a lookup that found key in the cache.
+        return False if the entry expired, in which case it should be considered a miss
+        """
+        now = time.time()
+        with self.__lock:
+            self.__load_pending()
+            metadata = self.__entries.get(key)
+            if metadata is None:
+                # e.g. written by another process
+                return True
+            if self.ttl is not None and now - metadata.written_at > self.ttl:
+                self.expired += 1
+                return False
+            metadata.last_access = now
+            metadata.count += 1
+            self.__dirty[key] = metadata
+            return True
+    
+    def on_put(self, key: CacheKey, size: int) -> List[CacheKey]:
+        """
+        record that key was written to the cache, with a key+value of `size` bytes.
+        return the keys that should be evicted (possibly none)
+        """
+        now = time.time()
+        with self.__lock:
+            self.__load_pending()
+            old = self.__entries.get(key)
+            if old is not None:
+                self.__bytes -= old.size
+            metadata = EntryMetadata(
+                size=size, written_at=now, last_access=now, count=old.count if old is not None else 0,
+            )
+            self.__entries[key] = metadata
+            self.__bytes += size
+            self.__dirty[key] = metadata
+            return self.__evict(keep=key)
+    
+    def on_delete(self, key: CacheKey) -> None:
+        with self.__lock:
+            self.__load_pending()
+            self.__remove(key)
+    
+    def __remove(self, key: CacheKey) -> None:
+        metadata = self.__entries.pop(key, None)
+        if metadata is not None:
+            self.__bytes -= metadata.size
+            self.__dirty[key] = None
+    
+    def __over_capacity(self, factor: float = 1.0) -> bool:
+        return (
+            (self.max_entries is not None and len(self.__entries) > self.max_entries * factor)
+            or
+            (self.max_bytes is not None and self.__bytes > self.max_bytes * factor)
+        )
+    
+    def __evict(self, keep: CacheKey) -> List[CacheKey]:
+        # called with the lock held
+        if not self.__over_capacity():
+            return []
+        now = time.time()
+        
+        def rank(item):
+            key, metadata = item
+            expired = self.ttl is not None and now - metadata.written_at > self.ttl
+            if self.eviction == LFU:
+                return not expired, metadata.count, metadata.last_access
+            return not expired, metadata.last_access
+        
+        evicted = []
+        for key, _ in sorted(self.__entries.items(), key=rank):
+            if not self.__over_capacity(LOW_WATERMARK):
+                break
+            if key == keep:
+                continue  # the entry that was just written
+            self.__remove(key)
+            evicted.append(key)
+        self.evicted += len(evicted)
+        return evicted
+    
+    def should_save(self) -> bool:
+        """
+        return True if enough metadata changed for it to be written to the db
+        """
+        return len(self.__dirty) >= DIRTY_FLUSH_THRESHOLD
+    
+    def take_dirty(self) -> Dict[CacheKey, Optional[bytes]]:
+        """
+        return the metadata that changed since the last call, encoded (None for
+        entries that were removed), to be written to the db
+        """
+        with self.__lock:
+            dirty, self.__dirty = self.__dirty, {}
+        return {
+            key: encode_metadata(metadata) if metadata is not None else None
+            for key, metadata in dirty.items()
+        }
@@ -0,0 +1,312 @@
+import os
+import socket
+import socketserver
+import struct
+import threading
+from logging import Logger
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import plyvel
+
+from paths import CACHES_DIR
+
+"""
+A local server that owns the leveldb caches, so several processes can use them at
+the same time (a leveldb can be opened by a single process only).
+
+The server is started once (see run_cache_server.py), and every leveldb_cache that
+finds it running (at SOCKET_PATH) uses it instead of opening its db. each
+request carries many keys (e.g. all the misses of a get_many), and the writes of a
+request are written in a single batch.
+
+Protocol (all integers are little endian). a request is:
+    op (u8), length of the db path (u16), db path (utf-8), number of items (u32), items
+where an item of GET is a key, and an item of WRITE is a key and a value. a key or
+a value is its length (u32) followed by its bytes. a value of length NONE has no
+bytes, and means "missing" (in a GET response) or "delete" (in a WRITE request).
+a response is:
+    status (u8), number of items (u32), items
+where the items of a GET response are the values of the requested keys, in order.
+if the status is ERROR, there is a single item: the error message.
+"""
+
+DEFAULT_SOCKET_PATH = os.path.join(CACHES_DIR, "cache_server.sock")
+
+# the socket clients look for a server at
+SOCKET_PATH = DEFAULT_SOCKET_PATH
+
+OP_GET = 1
+OP_WRITE = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+NONE = 0xffffffff
+
+__U8 = struct.Struct("<B")
+__U16 = struct.Struct("<H")
+__U32 = struct.Struct("<I")
+
+
+class CacheServerError(Exception):
+    pass
+
+
+def set_socket_path(path: str) -> None:
+    """
+    look for the cache server at the given socket (instead of DEFAULT_SOCKET_PATH).
+    affects caches that are opened afterwards
+    """
+    global SOCKET_PATH
+    SOCKET_PATH = path
+
+
+def __read_exact(f: BinaryIO, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError("connection closed")
+    return data
+
+
+def read_u8(f: BinaryIO) -> int:
+    return __U8.unpack(__read_exact(f, 1))[0]
+
+
+def read_u32(f: BinaryIO) -> int:
+    return __U32.unpack(__read_exact(f, 4))[0]
+
+
+def read_bytes(f: BinaryIO) -> Optional[bytes]:
+    """
+    read a key or a value. return None for a missing value
+    """
+    n = read_u32(f)
+    return None if n == NONE else __read_exact(f, n)
+
+
+def read_name(f: BinaryIO) -> str:
+    n = __U16.unpack(__read_exact(f, 2))[0]
+    return __read_exact(f, n).decode("utf-8")
+
+
+def encode_bytes(b: Optional[bytes]) -> bytes:
+    return __U32.pack(NONE) if b is None else __U32.pack(len(b)) + b
+
+
+def encode_request(op: int, db_path: str, items: Sequence[bytes]) -> bytes:
+    name = db_path.encode("utf-8")
+    return b"".join([__U8.pack(op), __U16.pack(len(name)), name, __U32.pack(len(items)), *items])
+
+
+def encode_response(status: int, items: Sequence[Optional[bytes]]) -> bytes:
+    return b"".join([__U8.pack(status), __U32.pack(len(items))] + [encode_bytes(item) for item in items])
+
+
+def leveldb_get_many(db: plyvel.DB, keys: Iterable[bytes]) -> Dict[bytes, bytes]:
+    """
+    return the values of the given keys that exist in db. the keys are looked up in
+    sorted order by a single iterator, so the scan moves forward through the db
+    """
+    values = {}
+    it = db.raw_iterator()
+    try:
+        for key in sorted(set(keys)):
+            it.seek(key)
+            if it.valid() and it.key() == key:
+                values[key] = it.value()
+    finally:
+        it.close()
+    return values
+
+
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    serve the leveldbs at the paths clients ask for (opened on first use) over a
+    unix socket. every connection is served by its own thread until it is closed
+    """
+    daemon_threads = True
+    
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, logger: Logger = None) -> None:
+        if os.path.exists(socket_path):
+            # a socket left by a server that didn't stop cleanly
+            os.remove(socket_path)
+        self.socket_path = socket_path
+        self.logger = logger
+        self.dbs: Dict[str, plyvel.DB] = {}
+        self.__dbs_lock = threading.Lock()
+        super().__init__(socket_path, CacheRequestHandler)
+    
+    def get_db(self, db_path: str) -> plyvel.DB:
+        with self.__dbs_lock:
+            if db_path not in self.dbs:
+                self.dbs[db_path] = plyvel.DB(db_path, create_if_missing=True)
+                if self.logger is not None:
+                    self.logger.info(f"cache server: opened {db_path}")
+            return self.dbs[db_path]
+    
+    def start(self) -> "CacheServer":
+        """
+        serve in a background thread
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        os.remove(self.socket_path)
+        with self.__dbs_lock:
+            for db in self.dbs.values():
+                db.close()
+            self.dbs.clear()
+
+
+class CacheRequestHandler(socketserver.StreamRequestHandler):
+    server: CacheServer
+    
+    def handle(self) -> None:
+        while True:
+            try:
+                op = read_u8(self.rfile)
+            except EOFError:
+                return
+            db_path = read_name(self.rfile)
+            num_items = read_u32(self.rfile)
+            # the request is read as a whole before the db is opened, so a db that
+            # can't be opened doesn't leave its items in the stream
+            if op == OP_GET:
+                keys = [read_bytes(self.rfile) for _ in range(num_items)]
+            elif op == OP_WRITE:
+                items = [(read_bytes(self.rfile), read_bytes(self.rfile)) for _ in range(num_items)]
+            else:
+                # we can't tell where the request ends, so the connection is closed
+                self.wfile.write(encode_response(STATUS_ERROR, [f"unknown op {op}".encode("utf-8")]))
+                return
+            try:
+                db = self.server.get_db(db_path)
+                if op == OP_GET:
+                    values = leveldb_get_many(db, keys)
+                    response = encode_response(STATUS_OK, [values.get(key) for key in keys])
+                else:
+                    with db.write_batch() as wb:
+                        for key, value in items:
+                            if value is None:
+                                wb.delete(key)
+                            else:
+                                wb.put(key, value)
+                    response = encode_response(STATUS_OK, [])
+            except plyvel.Error as e:
+                response = encode_response(STATUS_ERROR, [f"{type(e)}: {str(e)}".encode("utf-8")])
+            self.wfile.write(response)
+            self.wfile.flush()
+
+
+class RemoteWriteBatch:
+    """
+    the writes of a RemoteDB.write_batch(), sent in a single request
+    """
+    
+    def __init__(self, db: "RemoteDB") -> None:
+        self.db = db
+        self.items: List[Tuple[bytes, Optional[bytes]]] = []
+    
+    def put(self, key: bytes, value: bytes) -> None:
+        self.items.append((key, value))
+    
+    def delete(self, key: bytes) -> None:
+        self.items.append((key, None))
+    
+    def write(self) -> None:
+        self.db.write(self.items)
+        self.items = []
+    
+    def __enter__(self) -> "RemoteWriteBatch":
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.write()
+
+
+class RemoteDB:
+    """
+    a leveldb served by a CacheServer. it has the subset of plyvel.DB methods that
+    leveldb_cache uses, and get_many. every thread has its own connection
+    """
+    
+    def __init__(self, db_path: str, socket_path: str = DEFAULT_SOCKET_PATH) -> None:
+        self.db_path = db_path
+        self.socket_path = socket_path
+        self.closed = False
+        self.__local = threading.local()
+        # fail now if there is no server
+        self.__connection()
+    
+    def __connection(self) -> BinaryIO:
+        f = getattr(self.__local, "f", None)
+        if f is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            f = sock.makefile("rwb")
+            self.__local.sock = sock
+            self.__local.f = f
+        return f
+    
+    def __request(self, op: int, items: Sequence[bytes]) -> List[Optional[bytes]]:
+        f = self.__connection()
+        f.write(encode_request(op, self.db_path, items))
+        f.flush()
+        status = read_u8(f)
+        response = [read_bytes(f) for _ in range(read_u32(f))]
+        if status != STATUS_OK:
+            raise CacheServerError(response[0].decode("utf-8"))
+        return response
+    
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, bytes]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.__request(OP_GET, [encode_bytes(key) for key in keys])
+        return {key: value for key, value in zip(keys, values) if value is not None}
+    
+    def get(self, key: bytes) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+    
+    def write(self, items: Sequence[Tuple[bytes, Optional[bytes]]]) -> None:
+        if items:
+            self.__request(OP_WRITE, [encode_bytes(key) + encode_bytes(value) for key, value in items])
+    
+    def put(self, key: bytes, value: bytes) -> None:
+        self.write([(key, value)])
+    
+    def delete(self, key: bytes) -> None:
+        self.write([(key, None)])
+    
+    def write_batch(self) -> RemoteWriteBatch:
+        return RemoteWriteBatch(self)
+    
+    def close(self) -> None:
+        """
+        close the connection of the calling thread
+        """
+        f = getattr(self.__local, "f", None)
+        if f is not None:
+            f.close()
+            self.__local.sock.close()
+            self.__local.f = None
+        self.closed = True
+
+
+def connect_to_cache_server(db_path: str, socket_path: str = None) -> Optional[RemoteDB]:
+    """
+    return the db at db_path, served by the cache server, or None if no server is running
+    """
+    if socket_path is None:
+        socket_path = SOCKET_PATH
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        return RemoteDB(db_path, socket_path=socket_path)
+    except OSError:
+        # a socket left by a server that didn't stop cleanly
+        return None
@@ -0,0 +1,332 @@
+import json
+import os
+from logging import Logger
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from datatypes import BlockHeight, TXID, TxStats
+from paths import DATA
+
+"""
+An append-only columnar store of the stats of the txs of consecutive blocks, instead
+of a tsv file per block and metric.
+
+The store is a directory with a file per column, in which the rows of all txs are
+packed in block order, and an index of the end row of every block:
+    txid.bin      32 bytes per tx (the txid, as in its hex form)
+    feerate.bin   float32, sat/byte (fee / size)
+    weight.bin    uint32
+    size.bin      uint32, bytes
+    fee.bin       uint64, satoshi
+    ends.bin      uint64 per block, the number of rows up to and including it
+    meta.json     the height of the first block
+Columns are memory-mapped into numpy arrays, so the txs of any range of blocks are
+a slice of every column, without copying or parsing.
+
+A block is written to the columns first, and to the index last, so a block is in
+the store once its end is in the index and all of its rows are in the columns (the
+index may reach the files before the columns do, as writes are buffered). rows
+that are not in the index (of a block that was being written when the writer
+crashed) are dropped when the store is opened for writing.
+"""
+
+DEFAULT_COLUMNAR_STORE_PATH = os.path.join(DATA, "txs_columnar_store")
+
+TXID_SIZE = 32
+
+# column name -> (dtype, number of values per row)
+COLUMNS: Dict[str, Tuple[np.dtype, int]] = {
+    "txid": (np.dtype(np.uint8), TXID_SIZE),
+    "feerate": (np.dtype(np.float32), 1),
+    "weight": (np.dtype(np.uint32), 1),
+    "size": (np.dtype(np.uint32), 1),
+    "fee": (np.dtype(np.uint64), 1),
+}
+
+ENDS_DTYPE = np.dtype(np.uint64)
+
+META_FILENAME = "meta.json"
+ENDS_FILENAME = "ends.bin"
+
+TSV_SEPARATOR = "\t"
+
+
+class BlockColumns(NamedTuple):
+    """
+    the txs of a range of blocks. the txs of the i-th block of the range are
+    rows offsets[i]:offsets[i + 1] of the columns
+    """
+    first_height: BlockHeight
+    offsets: np.ndarray
+    txid: np.ndarray  # shape (rows, 32)
+    feerate: np.ndarray
+    weight: np.ndarray
+    size: np.ndarray
+    fee: np.ndarray
+
+
+def column_path(store_path: str, name: str) -> str:
+    return os.path.join(store_path, f"{name}.bin")
+
+
+def row_size(name: str) -> int:
+    dtype, width = COLUMNS[name]
+    return dtype.itemsize * width
+
+
+class ColumnarStore:
+    """
+    the columnar store at path. a single process may write it. readers see the
+    blocks that were in the store when it was opened (or refreshed)
+    """
+    
+    def __init__(self, path: str = DEFAULT_COLUMNAR_STORE_PATH, readonly: bool = False) -> None:
+        self.path = path
+        self.readonly = readonly
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self.first_height: Optional[BlockHeight] = None
+        self.__ends = np.empty(0, dtype=ENDS_DTYPE)
+        # column name -> file, opened for appending on the first write
+        self.__files: Dict[str, BinaryIO] = {}
+        # column name -> the memory-mapped column, of the rows that were in the store when it was mapped
+        self.__maps: Dict[str, np.ndarray] = {}
+        self.refresh()
+        if not readonly:
+            self.__recover()
+    
+    def __meta_path(self) -> str:
+        return os.path.join(self.path, META_FILENAME)
+    
+    def __ends_path(self) -> str:
+        return os.path.join(self.path, ENDS_FILENAME)
+    
+    def refresh(self) -> None:
+        """
+        re-read the index (e.g. to see blocks written by another process since this
+        store was opened)
+        """
+        self.__maps.clear()
+        self.first_height = None
+        if os.path.isfile(self.__meta_path()):
+            with open(self.__meta_path()) as f:
+                self.first_height = json.load(f)["first_height"]
+        ends_path = self.__ends_path()
+        if self.first_height is None or not os.path.isfile(ends_path):
+            self.__ends = np.empty(0, dtype=ENDS_DTYPE)
+            return
+        # a partially written end (of a crashed writer) is ignored
+        count = os.path.getsize(ends_path) // ENDS_DTYPE.itemsize
+        ends = np.fromfile(ends_path, dtype=ENDS_DTYPE, count=count)
+        # the index may be ahead of the columns, e.g. of a writer that crashed, or of a
+        # writer whose buffered column writes didn't reach the files yet. the blocks
+        # whose rows are not all in the columns are ignored
+        rows_in_columns = min(
+            (os.path.getsize(column_path(self.path, name)) if os.path.isfile(column_path(self.path, name)) else 0)
+            // row_size(name)
+            for name in COLUMNS
+        )
+        self.__ends = ends[:int(np.searchsorted(ends, rows_in_columns, side="right"))]
+    
+    def __recover(self) -> None:
+        """
+        drop the blocks whose rows are not all in the columns (see refresh), and the
+        rows that are not in any block
+        """
+        self.__truncate_files(self.num_blocks)
+    
+    def __truncate_files(self, num_blocks: int) -> None:
+        self.__close_files()
+        self.__maps.clear()
+        self.__ends = self.__ends[:num_blocks].copy()
+        rows = self.num_rows
+        for name in COLUMNS:
+            path = column_path(self.path, name)
+            if os.path.isfile(path):
+                os.truncate(path, rows * row_size(name))
+        if os.path.isfile(self.__ends_path()):
+            os.truncate(self.__ends_path(), num_blocks * ENDS_DTYPE.itemsize)
+        if num_blocks == 0 and os.path.isfile(self.__meta_path()):
+            # the next block written may have any height
+            os.remove(self.__meta_path())
+            self.first_height = None
+    
+    @property
+    def num_blocks(self) -> int:
+        return len(self.__ends)
+    
+    @property
+    def num_rows(self) -> int:
+        return int(self.__ends[-1]) if len(self.__ends) > 0 else 0
+    
+    @property
+    def last_height(self) -> Optional[BlockHeight]:
+        """
+        the height of the last block in the store, or None if it's empty
+        """
+        if self.first_height is None or self.num_blocks == 0:
+            return None
+        return self.first_height + self.num_blocks - 1
+    
+    def __contains__(self, h: BlockHeight) -> bool:
+        return self.last_height is not None and self.first_height <= h <= self.last_height
+    
+    def __file(self, name: str) -> BinaryIO:
+        f = self.__files.get(name)
+        if f is None:
+            path = self.__ends_path() if name == ENDS_FILENAME else column_path(self.path, name)
+            f = open(path, "ab")
+            self.__files[name] = f
+        return f
+    
+    def append_block(self, h: BlockHeight, stats: Dict[TXID, TxStats]) -> None:
+        """
+        add the stats of the txs of block h. h must be the height after the last
+        block in the store (any height, if it's empty)
+        """
+        if self.readonly:
+            raise ValueError(f"the columnar store at {self.path} is read-only")
+        if self.first_height is None:
+            with open(self.__meta_path(), "w") as f:
+                json.dump({"first_height": h}, f)
+            self.first_height = h
+        elif h != self.last_height + 1:
+            raise ValueError(
+                f"can't append block {h} to the columnar store of blocks {self.first_height}-{self.last_height}. "
+                f"blocks are appended in height order"
+            )
+        
+        txs = list(stats.values())
+        columns = {
+            "txid": np.frombuffer(b"".join(bytes.fromhex(tx.txid) for tx in txs), dtype=np.uint8),
+            "feerate": np.array([tx.feerate for tx in txs], dtype=np.float32),
+            "weight": np.array([tx.weight for tx in txs], dtype=np.uint32),
+            "size": np.array([tx.size for tx in txs], dtype=np.uint32),
+            "fee": np.array([tx.fee for tx in txs], dtype=np.uint64),
+        }
+        for name, values in columns.items():
+            self.__file(name).write(values.tobytes())
+        end = np.array([self.num_rows + len(txs)], dtype=ENDS_DTYPE)
+        # the index is written last, so the block is in the store only if all of its rows are
+        self.__file(ENDS_FILENAME).write(end.tobytes())
+        self.__ends = np.concatenate([self.__ends, end])
+    
+    def truncate(self, h: BlockHeight) -> None:
+        """
+        remove block h and all blocks after it (e.g. when h is disconnected by a reorg).
+        columns returned by get_blocks before must not be used afterwards
+        """
+        if self.first_height is None or h > self.last_height:
+            return
+        self.flush()
+        self.__truncate_files(max(h - self.first_height, 0))
+    
+    def flush(self) -> None:
+        """
+        make the blocks appended so far durable. the columns are synced before the
+        index, so the index never refers to rows that were lost
+        """
+        for name in list(COLUMNS) + [ENDS_FILENAME]:
+            f = self.__files.get(name)
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def __column(self, name: str) -> np.ndarray:
+        rows = self.num_rows
+        column = self.__maps.get(name)
+        if column is None or len(column) != rows:
+            dtype, width = COLUMNS[name]
+            shape = (rows, width) if width > 1 else (rows,)
+            if rows == 0:
+                column = np.empty(shape, dtype=dtype)
+            else:
+                f = self.__files.get(name)
+                if f is not None:
+                    f.flush()
+                column = np.memmap(column_path(self.path, name), dtype=dtype, mode="r", shape=shape)
+            self.__maps[name] = column
+        return column
+    
+    def get_blocks(self, first_height: BlockHeight, last_height: BlockHeight) -> BlockColumns:
+        """
+        return the txs of blocks first_height..last_height (inclusive), as views of the
+        memory-mapped columns (nothing is copied). raise KeyError if some block is not
+        in the store
+        """
+        if first_height not in self or last_height not in self or last_height < first_height:
+            raise KeyError(
+                f"blocks {first_height}-{last_height} are not in the columnar store "
+                f"(of blocks {self.first_height}-{self.last_height})"
+            )
+        i = first_height - self.first_height
+        j = last_height - self.first_height + 1
+        start = int(self.__ends[i - 1]) if i > 0 else 0
+        end = int(self.__ends[j - 1])
+        offsets = np.concatenate([[start], self.__ends[i:j]]).astype(np.int64) - start
+        return BlockColumns(
+            first_height=first_height,
+            offsets=offsets,
+            **{name: self.__column(name)[start:end] for name in COLUMNS},
+        )
+    
+    def get_block(self, h: BlockHeight) -> BlockColumns:
+        return self.get_blocks(h, h)
+    
+    def __close_files(self) -> None:
+        self.flush()
+        for f in self.__files.values():
+            f.close()
+        self.__files.clear()
+    
+    def close(self) -> None:
+        self.__close_files()
+        self.__maps.clear()
+
+
+def txids_to_hex(txids: np.ndarray) -> List[TXID]:
+    """
+    the hex txids of rows of the txid column
+    """
+    return [row.tobytes().hex() for row in txids]
+
+
+def export_to_tsv(
+    store: ColumnarStore,
+    metric: str,
+    folder: str,
+    filename_format: str,
+    first_height: BlockHeight = None,
+    last_height: BlockHeight = None,
+    logger: Logger = None,
+) -> int:
+    """
+    write a tsv file per block, with a `txid<TAB>value` line per tx, as TsvSink does
+    (see block_ingester), and return the number of files written.
+    metric: "feerate", "weight", "size" or "fee". feerates are recomputed from the
+            fee and size, so they are written exactly as TsvSink writes them
+    filename_format: formatted with the height as `h`, e.g. "block_{h}_feerates.tsv"
+    """
+    if store.last_height is None:
+        return 0
+    first_height = store.first_height if first_height is None else first_height
+    last_height = store.last_height if last_height is None else last_height
+    os.makedirs(folder, exist_ok=True)
+    written = 0
+    for h in range(first_height, last_height + 1):
+        block = store.get_block(h)
+        if metric == "feerate":
+            values = [int(fee) / int(size) for fee, size in zip(block.fee, block.size)]
+        else:
+            values = getattr(block, metric).tolist()
+        filepath = os.path.join(folder, filename_format.format(h=h))
+        filepath_tmp = f"{filepath}.tmp"
+        with open(filepath_tmp, mode="w") as f:
+            for txid, value in zip(txids_to_hex(block.txid), values):
+                f.write(f"{txid}{TSV_SEPARATOR}{value}\n")
+        os.rename(filepath_tmp, filepath)
+        written += 1
+        if logger is not None and written % 1000 == 0:
+            logger.info(f"exported {written} blocks")
+    return written
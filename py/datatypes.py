@@ -1,4 +1,5 @@
-from typing import Any, Dict
+from dataclasses import dataclass
+from typing import Any, Dict, Tuple
 
 Json = Dict[str, Any]
 Address = str
@@ -14,6 +15,26 @@ Satoshi = int
 Timestamp = int
 TXID = str
 TX = Json
+Outpoint = Tuple[TXID, int]  # txid and output index
+
+
+@dataclass
+class TxStats:
+    """
+    per-transaction metrics, as derived from a block with full transactions
+    """
+    txid: TXID
+    fee: Satoshi
+    size: int  # in bytes, including witness data
+    weight: int
+    
+    @property
+    def feerate(self) -> Feerate:
+        """
+        the fee per byte of the full size. the fee is exact (see btc_to_sat_exact), as
+        it is in get_tx_feerate
+        """
+        return self.fee / self.size
 
 
 def msat_to_sat(msat: MSatoshi) -> Satoshi:
@@ -24,5 +45,14 @@ def btc_to_sat(amount: BTC) -> Satoshi:
     return Satoshi(amount * (10 ** 8))
 
 
+def btc_to_sat_exact(amount: BTC) -> Satoshi:
+    """
+    like btc_to_sat, but round to the nearest satoshi instead of truncating.
+    amounts returned by bitcoind are parsed as floats, so for example 0.29 BTC
+    becomes 28999999.999999996 satoshi, which btc_to_sat truncates
+    """
+    return Satoshi(round(amount * (10 ** 8)))
+
+
 def sat_to_btc(amount: Satoshi) -> BTC:
     return amount * (10 * -8)
@@ -0,0 +1,202 @@
+import json
+import math
+import os
+import struct
+import time
+from logging import Logger
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from bitcoin_rpc import BitcoinRPC
+from datatypes import Timestamp
+from paths import FEE_ESTIMATIONS_DIR
+
+"""
+An append-only time-series of the estimations of bitcoind's estimatesmartfee, for
+several targets and modes, sampled at once.
+
+The series is a single binary file: a header, with the (target, mode) of every
+column, followed by a fixed-size record per sample:
+    timestamp   int64, unix time
+    feerates    float64 per column, BTC/kB as returned by estimatesmartfee (nan if
+                bitcoind had no estimation)
+Every record is written with a single write to the end of the file, and synced, so
+a crash leaves at most a partial last record, which is dropped when the series is
+opened for writing (and ignored by readers).
+"""
+
+DEFAULT_SERIES_PATH = os.path.join(FEE_ESTIMATIONS_DIR, "estimatesmartfee.bin")
+
+MAGIC = b"ESTFEE01"
+HEADER_LENGTH = struct.Struct("<I")  # the length of the json that follows it
+
+# the targets (in blocks) and modes sampled by sh/sample-estimatesmartfee
+TARGETS = [1, 2, 3, 4, 6, 12, 36, 100]
+MODES = ["ECONOMICAL", "CONSERVATIVE"]
+COLUMNS: List[Tuple[int, str]] = [(target, mode) for target in TARGETS for mode in MODES]
+
+# the name of the text file of a column, as written by sh/sample-estimatesmartfee
+TEXT_FILENAME_FORMAT = "estimatesmartfee_blocks={target}_mode={mode}"
+
+
+def record_dtype(num_columns: int) -> np.dtype:
+    return np.dtype([("timestamp", "<i8"), ("feerates", "<f8", (num_columns,))])
+
+
+class Samples(NamedTuple):
+    timestamps: np.ndarray
+    feerates: np.ndarray  # shape (samples, columns)
+
+
+class FeeEstimationSeries:
+    """
+    the series at path, created with the given columns if it doesn't exist (the
+    columns of an existing series are read from its header). a single process may
+    append to it
+    """
+    
+    def __init__(self, path: str = DEFAULT_SERIES_PATH, columns: Sequence[Tuple[int, str]] = COLUMNS, readonly: bool = False) -> None:
+        self.path = path
+        self.readonly = readonly
+        self.__fd: Optional[int] = None
+        if not os.path.isfile(path):
+            if readonly:
+                raise FileNotFoundError(f"no fee estimation series at {path}")
+            self.__create(columns)
+        self.__read_header()
+        if not readonly:
+            self.__recover()
+    
+    def __create(self, columns: Sequence[Tuple[int, str]]) -> None:
+        header = json.dumps({"columns": [[target, mode] for target, mode in columns]}).encode("utf-8")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # the header is written to a temporary file, so the series never exists without it
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+    
+    def __read_header(self) -> None:
+        with open(self.path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{self.path} is not a fee estimation series")
+            (length,) = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))
+            header = json.loads(f.read(length))
+        self.columns: List[Tuple[int, str]] = [(target, mode) for target, mode in header["columns"]]
+        self.dtype = record_dtype(len(self.columns))
+        self.data_offset = len(MAGIC) + HEADER_LENGTH.size + length
+    
+    @property
+    def num_samples(self) -> int:
+        return (os.path.getsize(self.path) - self.data_offset) // self.dtype.itemsize
+    
+    def __recover(self) -> None:
+        """
+        drop a partially written record (of a writer that crashed)
+        """
+        size = self.data_offset + self.num_samples * self.dtype.itemsize
+        if os.path.getsize(self.path) != size:
+            os.truncate(self.path, size)
+    
+    def column_index(self, target: int, mode: str) -> int:
+        return self.columns.index((target, mode))
+    
+    def append(self, timestamp: Timestamp, feerates: Sequence[float]) -> None:
+        """
+        append a sample, with a feerate per column (nan for a missing estimation),
+        and make it durable
+        """
+        if self.readonly:
+            raise ValueError(f"the fee estimation series at {self.path} is read-only")
+        if len(feerates) != len(self.columns):
+            raise ValueError(f"expected {len(self.columns)} feerates, got {len(feerates)}")
+        if self.__fd is None:
+            self.__fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        record = np.array([(timestamp, feerates)], dtype=self.dtype).tobytes()
+        # a single write, so a record is never interleaved with another
+        written = os.write(self.__fd, record)
+        if written != len(record):
+            raise OSError(f"short write to {self.path} ({written} of {len(record)} bytes)")
+        os.fsync(self.__fd)
+    
+    def read(self, start: Timestamp = None, end: Timestamp = None) -> Samples:
+        """
+        return the samples taken in [start, end] (all samples by default), as arrays
+        of the file's records (a memory map, not copied)
+        """
+        count = self.num_samples
+        if count == 0:
+            records = np.empty(0, dtype=self.dtype)
+        else:
+            records = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.data_offset, shape=(count,))
+        timestamps = records["timestamp"]
+        mask = np.ones(len(records), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= start
+        if end is not None:
+            mask &= timestamps <= end
+        if not mask.all():
+            records = records[mask]
+        return Samples(timestamps=records["timestamp"], feerates=records["feerates"])
+    
+    def close(self) -> None:
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+def sample_estimations(rpc: BitcoinRPC, columns: Sequence[Tuple[int, str]] = COLUMNS) -> List[float]:
+    """
+    query estimatesmartfee for all columns, in a single JSON-RPC batch, and return
+    the feerates (BTC/kB), with nan where bitcoind had no estimation
+    """
+    results = rpc.batch([("estimatesmartfee", [target, mode]) for target, mode in columns])
+    return [result.get("feerate", math.nan) for result in results]
+
+
+def run_sampler(rpc: BitcoinRPC, series: FeeEstimationSeries, interval: float = 60, logger: Logger = None) -> None:
+    """
+    sample the estimations every interval seconds, forever. the samples are taken
+    at fixed times, so the interval doesn't drift by the time a sample takes. a
+    sample that fails is logged and skipped
+    """
+    next_sample = time.time()
+    while True:
+        timestamp = int(time.time())
+        try:
+            series.append(timestamp, sample_estimations(rpc, series.columns))
+        except Exception as e:
+            if logger is not None:
+                logger.error(f"failed to sample the fee estimations: {type(e)}: {str(e)}")
+        next_sample += interval
+        time.sleep(max(next_sample - time.time(), 0))
+
+
+def export_to_text_files(
+    series: FeeEstimationSeries,
+    folder: str,
+    start: Timestamp = None,
+    end: Timestamp = None,
+) -> List[str]:
+    """
+    write a text file per column, with a `timestamp,feerate` line per sample, as
+    sh/sample-estimatesmartfee writes them (`null` for a missing estimation), and
+    return the paths of the files
+    """
+    samples = series.read(start=start, end=end)
+    os.makedirs(folder, exist_ok=True)
+    timestamps = samples.timestamps.tolist()
+    paths = []
+    for i, (target, mode) in enumerate(series.columns):
+        path = os.path.join(folder, TEXT_FILENAME_FORMAT.format(target=target, mode=mode))
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            for timestamp, feerate in zip(timestamps, samples.feerates[:, i].tolist()):
+                f.write(f"{timestamp},{'null' if math.isnan(feerate) else feerate}\n")
+        os.rename(tmp_path, path)
+        paths.append(path)
+    return paths
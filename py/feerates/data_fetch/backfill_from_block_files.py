@@ -0,0 +1,164 @@
+import argparse
+import os
+from typing import List
+
+from bitcoin_cli import set_bitcoin_rpc
+from bitcoin_rpc import BitcoinRPC
+from block_files import BlockFiles, NETWORK_MAGIC, read_block_index, scan_block_files
+from block_ingester import BlockFilesSource, BlockIngester, PIPELINE_DEPTH, Sink
+from datatypes import BlockHeight
+from feerates import logger
+from feerates.data_fetch.ingest_blocks import SINK_CACHES, SINK_TSV_FEERATES, SINK_TSV_WEIGHTS, get_sinks
+from outpoint_store import OutpointValueStore
+
+"""
+compute tx feerates and weights straight from bitcoind's block files (blk*.dat),
+instead of querying bitcoind, and write them to the same tsv files and caches as
+the sinks of ingest_blocks.
+
+fees are computed using the outpoint value store, so blocks are processed in height
+order. outputs that are not in the store (created before the first block that was
+added to it, or spent by blocks that were already added) are fetched from bitcoind
+(that's the only case in which bitcoind is queried), so it's best to start right
+after the height the store reached.
+
+parsing the blocks is CPU-bound, so it is done on a process pool (see --processes),
+for several blocks at once.
+"""
+
+
+def backfill(
+    block_files: BlockFiles,
+    chain: dict,
+    store: OutpointValueStore,
+    first_block: BlockHeight,
+    last_block: BlockHeight,
+    sinks: List[Sink],
+    depth: int = PIPELINE_DEPTH,
+    processes: int = 0,
+) -> None:
+    if store.last_height is not None and first_block > store.last_height + 1:
+        logger.warning(
+            f"the outpoint store reached height {store.last_height}. outputs created in "
+            f"blocks {store.last_height + 1}-{first_block - 1} will be fetched from bitcoind"
+        )
+    elif store.last_height is not None and first_block <= store.last_height:
+        logger.warning(
+            f"the outpoint store already reached height {store.last_height}. the outputs spent "
+            f"in blocks {first_block}-{min(last_block, store.last_height)} were removed from it, "
+            f"and will be fetched from bitcoind"
+        )
+    
+    for h in range(first_block, last_block + 1):
+        if h not in chain:
+            logger.error(f"block {h} is not in the block files. stopping at block {h - 1}")
+            last_block = h - 1
+            break
+    
+    ingester = BlockIngester(
+        sinks=sinks,
+        source=BlockFilesSource(block_files, chain, store),
+        depth=depth,
+        processes=processes,
+        logger=logger,
+    )
+    try:
+        failed = ingester.run(first_block=first_block, last_block=last_block)
+        if failed:
+            logger.error(f"failed to process blocks {failed}")
+    finally:
+        ingester.close()
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="compute tx feerates and weights from bitcoind's block files",
+    )
+    parser.add_argument(
+        "datadir", type=str, action="store",
+        help="bitcoind's datadir for the network (the directory that contains `blocks`)",
+    )
+    parser.add_argument(
+        "first_block", type=int, action="store",
+        help="the first block to process",
+    )
+    parser.add_argument(
+        "last_block", type=int, action="store",
+        help="the last block to process",
+    )
+    parser.add_argument(
+        "--network", choices=list(NETWORK_MAGIC.keys()), default="main",
+        help="the network of the block files",
+    )
+    parser.add_argument(
+        "--scan", action="store_true",
+        help="find the blocks by scanning all block files instead of reading the block index",
+    )
+    parser.add_argument(
+        "--tsv", action="store_true",
+        help="write the feerates and weights tsv files",
+    )
+    parser.add_argument(
+        "--caches", action="store_true",
+        help="populate the leveldb caches of tx feerates and weights",
+    )
+    parser.add_argument(
+        "--depth", action="store", type=int, default=PIPELINE_DEPTH,
+        help="number of blocks read and parsed at once. their stats are still computed in height order",
+    )
+    parser.add_argument(
+        "--processes", action="store", type=int, default=os.cpu_count(),
+        help="number of processes to parse blocks on (0 to parse them in this process)",
+    )
+    parser.add_argument(
+        "--rpcconf", action="store", type=str, default=None,
+        help=(
+            "bitcoin.conf of the node to query over JSON-RPC for outputs that are not in "
+            "the outpoint store. if not given, bitcoin-cli is used"
+        ),
+    )
+    
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.rpcconf:
+        set_bitcoin_rpc(BitcoinRPC.from_conf(args.rpcconf))
+    
+    blocks_dir = os.path.join(args.datadir, "blocks")
+    block_files = BlockFiles(blocks_dir=blocks_dir, network=args.network)
+    if args.scan:
+        chain = scan_block_files(block_files)
+    else:
+        chain = read_block_index(os.path.join(blocks_dir, "index"))
+    
+    sink_names = []
+    if args.tsv:
+        sink_names += [SINK_TSV_FEERATES, SINK_TSV_WEIGHTS]
+    if args.caches:
+        sink_names.append(SINK_CACHES)
+    sinks = get_sinks(sink_names)
+    
+    store = OutpointValueStore()
+    try:
+        backfill(
+            block_files=block_files,
+            chain=chain,
+            store=store,
+            first_block=args.first_block,
+            last_block=args.last_block,
+            sinks=sinks,
+            depth=args.depth,
+            processes=args.processes,
+        )
+    finally:
+        store.close()
+        block_files.close()
+
+
+if __name__ == "__main__":
+    main()
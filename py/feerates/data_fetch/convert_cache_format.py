@@ -0,0 +1,52 @@
+import argparse
+
+from cache_codecs import CONVERTIBLE_CACHES, convert_leveldb_format
+from feerates import logger
+from utils import get_leveldb_cache_fullpath
+
+"""
+convert the leveldb caches of functions to the compact binary format, or back to
+text format (e.g. before some other application reads them).
+
+the caches must not be in use while they are converted
+"""
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="convert leveldb caches between text and binary format")
+    parser.add_argument(
+        "functions", nargs="+", choices=sorted(CONVERTIBLE_CACHES.keys()), metavar="function",
+        help=f"the functions whose caches to convert. one of {', '.join(sorted(CONVERTIBLE_CACHES.keys()))}",
+    )
+    parser.add_argument(
+        "--to", choices=["binary", "text"], default="binary",
+        help="the format to convert to (default: binary)",
+    )
+    parser.add_argument(
+        "--batch-size", action="store", type=int, default=100_000,
+        help="number of entries written in a single batch",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    for func_name in args.functions:
+        value_to_str, str_to_value, binary_codec = CONVERTIBLE_CACHES[func_name]
+        db_path = get_leveldb_cache_fullpath(func_name)
+        logger.info(f"converting the cache of {func_name} to {args.to} format")
+        converted = convert_leveldb_format(
+            db_path=db_path,
+            value_to_str=value_to_str,
+            str_to_value=str_to_value,
+            binary_codec=binary_codec,
+            to_binary=args.to == "binary",
+            batch_size=args.batch_size,
+            logger=logger,
+        )
+        logger.info(f"converted {converted} entries of {func_name}")
@@ -1,80 +1,25 @@
 import argparse
 import os
-import time
-from concurrent.futures import ThreadPoolExecutor
 
-from bitcoin_cli import blockchain_height, get_block_by_height, get_tx_feerate, set_bitcoin_cli
-from datatypes import Block, BlockHeight
-from feerates import logger
+from bitcoin_cli import get_tx_feerate
+from block_ingester import CacheSink, TsvSink
+from feerates.data_fetch.ingest_blocks import (
+    FEERATES_FILENAME_FORMAT, FEERATES_FOLDER, add_ingest_arguments, ingest,
+)
 from paths import DATA
 
-MAX_WORKERS = None  # will be set by the executor according to number of CPUs
-
-TSV_SEPARATOR = "\t"
-
+"""
+Dump the feerates of the txs of blocks to a tsv file per block (and to the cache of
+get_tx_feerate). see ingest_blocks.py, which may write other sinks in the same pass
+"""
 
-def __dump_block_feerates_to_file(h: BlockHeight, filepath: str) -> bool:
-    """
-    helper for dump_block_feerates. write feerates of txs in block h to a file in the given path.
-    returns true only if ALL feerates were successfully written to the file.
-    """
-    try:
-        block: Block = get_block_by_height(h)
-    except Exception:
-        # TODO change this except. get_block_by_height should either declare
-        #  exactly what it raises, or return None if it fails
-        logger.error(f"Failed to retrieve block {h} from bitcoind")
-        return False
-    
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
-    # submit all jobs to the pool
-    txid_to_future = {
-        txid: executor.submit(get_tx_feerate, txid)
-        for txid in block["tx"]
-    }
-    
-    with open(filepath, mode="w") as f:
-        # iterate all futures, extract the computed result and dump to the file
-        for txid, future in txid_to_future.items():
-            try:
-                feerate = future.result()
-            except Exception:
-                # we give up on the entire block if we fail to get the feerate of
-                # at least one transaction
-                # cancel all remaining jobs
-                for f in txid_to_future.values():
-                    f.cancel()
-                executor.shutdown(wait=False)
-                return False
-            
-            f.write(f"{txid}{TSV_SEPARATOR}{feerate}\n")
-    
-    executor.shutdown(wait=True)
-    return True
+# the blocks that were ingested, or failed (see ingest_manifest)
+MANIFEST_PATH = os.path.join(DATA, "dump_feerates_manifest.json")
 
+# the high-water mark of the follower (when last_block is 0)
+FOLLOWER_STATE_PATH = os.path.join(DATA, "dump_feerates_follower_state.json")
 
-def dump_block_feerates(h: BlockHeight) -> None:
-    """
-    computes the feerate of all transactions in block at height h and dump them
-    to a text file in the DB_FOLDER directory
-    """
-    logger.info(f"Dumping feerates for block {h}")
-    filepath = os.path.join(DATA, "feerates_tsv_files", f"block_{h}_feerates.tsv")
-    if os.path.isfile(filepath):
-        return  # this block was already dumped
-    
-    # use tmp suffix until we finish with that block (in case we crash before we dumped all txs)
-    filepath_tmp = f"{filepath}.tmp"
-    success = __dump_block_feerates_to_file(h=h, filepath=filepath_tmp)
-    if success:
-        os.rename(filepath_tmp, filepath)
-    else:
-        logger.error(f"Failed to retrieve feerate for a transaction in block {h}")
-
-
-def dump_blocks_feerates(first_block: int, last_block: int) -> None:
-    for h in range(first_block, last_block + 1):
-        dump_block_feerates(h=h)
+FEERATES_SINK = TsvSink(FEERATES_FOLDER, FEERATES_FILENAME_FORMAT, attribute="feerate")
 
 
 def parse_args():
@@ -89,58 +34,30 @@ def parse_args():
     parser.add_argument(
         "last_block", type=int, action="store",
         help=(
-            "the last block to dump feerates for. if 0 is given, dump all "
-            "from first_block to the current blockchain height, indefinitely"
+            "the last block to dump feerates for. if 0 is given, follow the chain: dump all "
+            "from first_block to the current blockchain height, and then every new block"
         ),
     )
-    parser.add_argument(
-        "bitcoin_cli", choices=["master", "user"], metavar="bitcoin_cli",
-        help="the bitcoin-cli to use. must be one of `master` or `user`",
-    )
+    add_ingest_arguments(parser)
     
     return parser.parse_args()
 
 
 if __name__ == "__main__":
-    args = parse_args()
-    
-    set_bitcoin_cli(args.bitcoin_cli)
-    
-    if args.last_block != 0:
-        dump_blocks_feerates(first_block=args.first_block, last_block=args.last_block)
-    else:
-        # we dump all blocks from first_block to the current height, indefinitely
-        while True:
-            curr_height = blockchain_height()
-            logger.info(
-                f"Dumping all blocks from height {args.first_block} to current blockchain height ({curr_height})"
-            )
-            dump_blocks_feerates(first_block=args.first_block, last_block=curr_height)
-            logger.info("sleeping for 5 minutes")
-            time.sleep(60 * 5)
-            # we may change first_block to curr_height, but we're leaving this
-            # as it is in case some of the blocks failed in the last attempt
+    # also keep the get_tx_feerate cache populated, as when it was used to compute the feerates
+    ingest(
+        parse_args(),
+        sinks=[FEERATES_SINK, CacheSink({"feerate": get_tx_feerate})],
+        manifest_path=MANIFEST_PATH,
+        follower_state_path=FOLLOWER_STATE_PATH,
+    )
 
 # ----------
 
 
 """
-# After we dump all feerates, we wish to create DB with all, for quick access.
-
-# create tsv file with all of the data
-time sort --parallel=16 block_*_feerates.tsv > all_feerates_sorted.tsv
-
-
-# build SQLite:
-sqlite3 feerates.sqlite
-> CREATE TABLE IF NOT EXISTS "feerates" (txid TEXT PRIMARY KEY, feerate TEXT);
-> .mode tabs
-> .import all_feerates_sorted.tsv feerates
-> select count(*) from feerates; -- check table size
-
+# After we dump all feerates, we wish to load them all to a DB, for quick access:
 
-# build LevelDB:
-# to quickly build the db we use ldbsh: https://github.com/kanosaki/ldbsh
-ldbsh feerates_leveldb
-> load all_feerates_sorted.tsv
+python3 load_tsv_into_cache.py feerates --target leveldb
+python3 load_tsv_into_cache.py feerates --target sqlite --db feerates.sqlite
 """
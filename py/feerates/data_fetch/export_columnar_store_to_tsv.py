@@ -0,0 +1,72 @@
+import argparse
+
+from columnar_store import ColumnarStore, DEFAULT_COLUMNAR_STORE_PATH, export_to_tsv
+from feerates import logger
+from feerates.data_fetch.ingest_blocks import (
+    FEERATES_FILENAME_FORMAT, FEERATES_FOLDER, TX_WEIGHTS_FILENAME_FORMAT, TX_WEIGHTS_FOLDER,
+)
+
+"""
+write the feerates or weights in the columnar store (see columnar_store) to a tsv
+file per block, in the format (and by default, the folder) of the tsv files of
+ingest_blocks.py, e.g. for tools that read those files
+"""
+
+# metric -> (default folder, filename format)
+TSV_FILES = {
+    "feerate": (FEERATES_FOLDER, FEERATES_FILENAME_FORMAT),
+    "weight": (TX_WEIGHTS_FOLDER, TX_WEIGHTS_FILENAME_FORMAT),
+    "size": (None, "block_{h}_tx_sizes.tsv"),
+    "fee": (None, "block_{h}_tx_fees.tsv"),
+}
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="export the columnar store to tsv files")
+    parser.add_argument(
+        "metric", choices=list(TSV_FILES.keys()),
+        help="the stat of the txs to export",
+    )
+    parser.add_argument(
+        "--store", action="store", type=str, default=DEFAULT_COLUMNAR_STORE_PATH,
+        help="the directory of the columnar store",
+    )
+    parser.add_argument(
+        "--folder", action="store", type=str, default=None,
+        help="the directory to write the tsv files to (required for size and fee)",
+    )
+    parser.add_argument(
+        "--first-block", action="store", type=int, default=None,
+        help="the first block to export (default: the first block in the store)",
+    )
+    parser.add_argument(
+        "--last-block", action="store", type=int, default=None,
+        help="the last block to export (default: the last block in the store)",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    default_folder, filename_format = TSV_FILES[args.metric]
+    folder = args.folder or default_folder
+    if folder is None:
+        raise ValueError(f"--folder is required for {args.metric}")
+    store = ColumnarStore(args.store, readonly=True)
+    logger.info(f"exporting blocks {store.first_height}-{store.last_height} from {args.store} to {folder}")
+    written = export_to_tsv(
+        store,
+        metric=args.metric,
+        folder=folder,
+        filename_format=filename_format,
+        first_height=args.first_block,
+        last_height=args.last_block,
+        logger=logger,
+    )
+    logger.info(f"exported {written} blocks")
+    store.close()
@@ -0,0 +1,44 @@
+import argparse
+
+from fee_estimation_series import DEFAULT_SERIES_PATH, FeeEstimationSeries, export_to_text_files
+from feerates import logger
+from paths import FEE_ESTIMATIONS_DIR
+
+"""
+write the fee estimation series (see fee_estimation_series.py) to a text file per
+target and mode, in the format of sh/sample-estimatesmartfee, e.g. for
+estimated_feerates.py and find_continuous_estimation_times.py
+"""
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="export the fee estimation series to text files")
+    parser.add_argument(
+        "--series", action="store", type=str, default=DEFAULT_SERIES_PATH,
+        help="the file of the fee estimation series",
+    )
+    parser.add_argument(
+        "--folder", action="store", type=str, default=FEE_ESTIMATIONS_DIR,
+        help="the directory to write the text files to. existing files of the same targets and modes are replaced",
+    )
+    parser.add_argument(
+        "--start", action="store", type=int, default=None,
+        help="export only samples taken at or after this unix time",
+    )
+    parser.add_argument(
+        "--end", action="store", type=int, default=None,
+        help="export only samples taken at or before this unix time",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    series = FeeEstimationSeries(args.series, readonly=True)
+    paths = export_to_text_files(series, args.folder, start=args.start, end=args.end)
+    logger.info(f"exported the samples of {len(paths)} estimations to {args.folder}")
@@ -0,0 +1,316 @@
+import argparse
+import datetime
+import os
+from functools import lru_cache
+from typing import List, Optional
+
+import plyvel
+
+from adaptive_limiter import AdaptiveConcurrencyLimiter, DEFAULT_MAX_LIMIT
+from bitcoin_cli import (
+    get_tx_feerate, get_tx_weight, set_bitcoin_cli, set_bitcoin_rpc, set_height_index, set_outpoint_store,
+    set_rpc_limiter, sync_height_index,
+)
+from bitcoin_rpc import BitcoinRPC
+from block_follower import BlockFollower, get_notifications
+from block_ingester import (
+    BlockIngester, CacheSink, ColumnarSink, PIPELINE_DEPTH, Sink, TSV_SEPARATOR, TsvSink, migrate_legacy_marks,
+)
+from columnar_store import ColumnarStore
+from datatypes import BlockHeight
+from feerates import logger
+from height_index import BlockHeightIndex
+from ingest_manifest import IngestManifest
+from instrumentation import METRICS
+from outpoint_store import OutpointValueStore
+from paths import DATA
+from shared_store import Namespace, namespace_prefix
+from utils import BULK_MAX_PENDING, bulk_population, get_leveldb_cache_fullpath, open_shared_store
+
+"""
+Ingest blocks into any combination of sinks in a single pass: every block is
+fetched once, and the fee, size, weight and feerate of its txs are computed once.
+
+dump_feerates_to_tsv.py, dump_tx_weights_to_tsv.py and populate_leveldb_caches.py
+are this script with a fixed set of sinks.
+
+The blocks that were ingested, and the ones that failed, are recorded in a manifest,
+so a ranged run fetches only the blocks that are missing (use --list-missing to see them).
+"""
+
+FEERATES_FOLDER = os.path.join(DATA, "feerates_tsv_files")
+TX_WEIGHTS_FOLDER = os.path.join(DATA, "tx_weights_tsv_files")
+
+FEERATES_FILENAME_FORMAT = "block_{h}_feerates.tsv"
+TX_WEIGHTS_FILENAME_FORMAT = "block_{h}_tx_weights.tsv"
+
+SINK_TSV_FEERATES = "tsv-feerates"
+SINK_TSV_WEIGHTS = "tsv-weights"
+SINK_CACHES = "caches"
+SINK_COLUMNAR = "columnar"
+SINKS = [SINK_TSV_FEERATES, SINK_TSV_WEIGHTS, SINK_CACHES, SINK_COLUMNAR]
+
+
+# the namespace of the marks of the blocks whose txs were written to the caches (kept
+# from the time populate_leveldb_caches.py populated blocks by calling populate_block)
+POPULATED_BLOCKS_NAMESPACE = "populate_block"
+
+
+@lru_cache(maxsize=1)
+def get_populated_blocks_marks() -> Optional[Namespace]:
+    """
+    return the marks of the blocks whose txs were written to the caches, so they are
+    not populated twice (see CacheSink), or None if the shared store can't be opened.
+    the marks are tiny, so they are kept in the shared store rather than in a db of
+    their own. the store is opened on first use, not when this module is imported.
+    
+    the marks that populate_leveldb_caches.py kept in the db of populate_block are
+    copied into the store on first use, so their blocks aren't populated again
+    """
+    store = open_shared_store()
+    if store is None:
+        return None
+    marks = Namespace(store, namespace_prefix(POPULATED_BLOCKS_NAMESPACE))
+    legacy_path = get_leveldb_cache_fullpath(POPULATED_BLOCKS_NAMESPACE)
+    try:
+        migrate_legacy_marks(marks, legacy_path, logger=logger)
+    except plyvel.Error as e:
+        # e.g. the legacy db is open by an old populate_leveldb_caches.py
+        logger.warning(
+            f"failed to copy the marks of populated blocks from {legacy_path} ({type(e)}: {str(e)}). "
+            f"their blocks may be populated again"
+        )
+    return marks
+
+
+def get_sinks(names: List[str]) -> List[Sink]:
+    sinks = []
+    if SINK_TSV_FEERATES in names:
+        sinks.append(TsvSink(FEERATES_FOLDER, FEERATES_FILENAME_FORMAT, attribute="feerate"))
+    if SINK_TSV_WEIGHTS in names:
+        sinks.append(TsvSink(TX_WEIGHTS_FOLDER, TX_WEIGHTS_FILENAME_FORMAT, attribute="weight"))
+    if SINK_CACHES in names:
+        sinks.append(CacheSink(
+            {"feerate": get_tx_feerate, "weight": get_tx_weight},
+            marks=get_populated_blocks_marks(),
+        ))
+    if SINK_COLUMNAR in names:
+        sinks.append(ColumnarSink(ColumnarStore()))
+    return sinks
+
+
+def add_ingest_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    add the arguments that are common to all the scripts that ingest blocks (after
+    first_block and last_block)
+    """
+    parser.add_argument(
+        "bitcoin_cli", choices=["master", "user"], metavar="bitcoin_cli",
+        help="the bitcoin-cli to use. must be one of `master` or `user`",
+    )
+    parser.add_argument(
+        "-j", "--jobs", action="store", type=int, default=None,
+        help="number of jobs to use for querying bitcoind",
+    )
+    parser.add_argument(
+        "--max-pending", action="store", type=int, default=None,
+        help=(
+            "max number of queries to bitcoind that are queued for the jobs. blocks "
+            "are not fetched faster than the jobs process them (default: 4 per job)"
+        ),
+    )
+    parser.add_argument(
+        "--depth", action="store", type=int, default=PIPELINE_DEPTH,
+        help=(
+            "number of blocks fetched and processed at once, when last_block is not 0. "
+            "their stats are still written in height order (1 to process blocks one after another)"
+        ),
+    )
+    parser.add_argument(
+        "--rpcconf", action="store", type=str, default=None,
+        help=(
+            "bitcoin.conf of the node to query over JSON-RPC (with a pool of keep-alive "
+            "connections). if not given, bitcoin-cli is spawned for every query"
+        ),
+    )
+    parser.add_argument(
+        "--outpoint-index", action="store_true",
+        help=(
+            "keep the values of unspent outputs in a local index, so the parents of "
+            "txs in later blocks need not be fetched. useful when bitcoind doesn't "
+            "provide prevouts in getblock (< 22.0). blocks should be processed in height order"
+        ),
+    )
+    parser.add_argument(
+        "--height-index", action="store_true",
+        help=(
+            "look up block hashes in the local height index, which is synced with "
+            "bitcoind before every round. saves a getblockhash per block"
+        ),
+    )
+    parser.add_argument(
+        "--adaptive-jobs", action="store_true",
+        help=(
+            "adapt the number of concurrent queries to bitcoind's load (up to --jobs, or 16 if not given), "
+            "and retry queries that bitcoind rejected since its work queue was full"
+        ),
+    )
+    parser.add_argument(
+        "--zmq", action="store", type=str, default=None,
+        help=(
+            "when following the chain (last_block is 0), get new block notifications "
+            "from this bitcoind ZMQ endpoint (-zmqpubhashblock), instead of long-polling"
+        ),
+    )
+    parser.add_argument(
+        "--batch-size", action="store", type=int, default=BULK_MAX_PENDING,
+        help="write the caches in batches of up to that many entries",
+    )
+    parser.add_argument(
+        "--metrics-interval", action="store", type=float, default=300,
+        help=(
+            "log the latency and count of queries to bitcoind, and the cache hit ratios, "
+            "every that many seconds (0 to disable)"
+        ),
+    )
+    parser.add_argument(
+        "--max-retries", action="store", type=int, default=None,
+        help="skip blocks that already failed that many times (default: retry all failed blocks)",
+    )
+    parser.add_argument(
+        "--list-missing", action="store_true",
+        help=(
+            "list the ranges of blocks between first_block and last_block (or the last "
+            "block in the manifest, if last_block is 0) that were not ingested, and the "
+            "blocks that failed, and exit. a ranged run fetches these blocks only"
+        ),
+    )
+
+
+def list_missing(manifest: IngestManifest, first_block: BlockHeight, last_block: BlockHeight, max_retries: int = None) -> None:
+    """
+    print the ranges of blocks of first_block..last_block that the manifest doesn't
+    have, and the blocks that failed
+    """
+    ranges = manifest.missing_ranges(first_block, last_block, max_retries=max_retries)
+    print(f"{sum(last - first + 1 for first, last in ranges)} missing blocks in {first_block}-{last_block}")
+    for first, last in ranges:
+        print(f"{first}-{last}" if first != last else f"{first}")
+    failures = {h: record for h, record in manifest.failures.items() if first_block <= h <= last_block}
+    if failures:
+        print(f"{len(failures)} failed blocks:")
+    for h, record in sorted(failures.items()):
+        attempted = datetime.datetime.fromtimestamp(record.last_attempt).isoformat(sep=" ")
+        print(f"{h}{TSV_SEPARATOR}{record.retries} attempts (last at {attempted}){TSV_SEPARATOR}{record.reason}")
+
+
+def ingest(args: argparse.Namespace, sinks: List[Sink], manifest_path: str, follower_state_path: str) -> None:
+    """
+    ingest the blocks given in the program arguments into the sinks.
+    manifest_path: the blocks that were ingested, or failed (see ingest_manifest)
+    follower_state_path: the high-water mark of the follower (last_block is 0)
+    """
+    manifest = IngestManifest(manifest_path)
+    if args.list_missing:
+        last_block = args.last_block if args.last_block != 0 else manifest.last_height
+        list_missing(manifest, args.first_block, last_block, max_retries=args.max_retries)
+        return
+    
+    max_workers = args.jobs
+    if args.adaptive_jobs:
+        limiter = AdaptiveConcurrencyLimiter(max_limit=args.jobs or DEFAULT_MAX_LIMIT, logger=logger)
+        set_rpc_limiter(limiter)
+        # the workers wait for the limiter, which decides how many query bitcoind
+        max_workers = limiter.max_limit
+    
+    set_bitcoin_cli(args.bitcoin_cli)
+    if args.rpcconf:
+        set_bitcoin_rpc(BitcoinRPC.from_conf(args.rpcconf))
+    if args.outpoint_index:
+        set_outpoint_store(OutpointValueStore())
+    if args.metrics_interval > 0:
+        METRICS.start_periodic_log(logger, interval=args.metrics_interval)
+    height_index = None
+    if args.height_index:
+        height_index = BlockHeightIndex()
+        set_height_index(height_index)
+    
+    ingester = BlockIngester(
+        sinks=sinks,
+        manifest=manifest,
+        max_workers=max_workers,
+        max_pending=args.max_pending,
+        depth=args.depth,
+        logger=logger,
+    )
+    # the cache writes are batched. blocks are marked by the caches sink once they
+    # were flushed, so a block is never marked before its txs are on disk
+    cached_funcs = [func for sink in sinks if isinstance(sink, CacheSink) for func in sink.cached_funcs]
+    try:
+        with bulk_population(*cached_funcs, max_pending=args.batch_size):
+            if args.last_block != 0:
+                if height_index is not None:
+                    sync_height_index(height_index)
+                failed = ingester.run(
+                    first_block=args.first_block,
+                    last_block=args.last_block,
+                    max_retries=args.max_retries,
+                )
+                if failed:
+                    logger.error(f"failed to ingest blocks {failed}")
+                logger.info(f"metrics: {METRICS.summary()}")
+            else:
+                # we ingest all blocks from first_block (or from where we stopped last
+                # time) to the current height, and then every new block as soon as it
+                # arrives. a block that fails is retried on the next sync, before any later block
+                follower = BlockFollower(
+                    state_path=follower_state_path,
+                    first_block=args.first_block,
+                    on_block=ingester.ingest_block_and_flush,
+                    on_rollback=ingester.remove_block,
+                    notifications=get_notifications(args.zmq),
+                    before_sync=(lambda: sync_height_index(height_index)) if height_index is not None else None,
+                    logger=logger,
+                )
+                follower.follow()
+    finally:
+        ingester.close()
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="fetch blocks and write the stats of their txs to tsv files, caches and/or the columnar store",
+    )
+    parser.add_argument(
+        "first_block", type=int, action="store",
+        help="the first block to ingest",
+    )
+    parser.add_argument(
+        "last_block", type=int, action="store",
+        help=(
+            "the last block to ingest. if 0 is given, follow the chain: ingest all blocks "
+            "from first_block to the current blockchain height, and then every new block"
+        ),
+    )
+    parser.add_argument(
+        "--sinks", nargs="+", choices=SINKS, default=SINKS,
+        help="where to write the stats of the txs (default: all)",
+    )
+    add_ingest_arguments(parser)
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # runs with other sinks have their own progress
+    sinks_id = "_".join(sorted(set(args.sinks)))
+    ingest(
+        args,
+        sinks=get_sinks(args.sinks),
+        manifest_path=os.path.join(DATA, f"ingest_blocks_{sinks_id}_manifest.json"),
+        follower_state_path=os.path.join(DATA, f"ingest_blocks_{sinks_id}_follower_state.json"),
+    )
@@ -0,0 +1,92 @@
+import argparse
+import glob
+import os
+
+from cache_codecs import CONVERTIBLE_CACHES
+from feerates import logger
+from feerates.data_fetch.ingest_blocks import FEERATES_FOLDER, TX_WEIGHTS_FOLDER
+from tsv_bulk_load import (
+    LOAD_BATCH_SIZE, SORT_MAX_ROWS_IN_MEMORY, external_sort, load_into_leveldb, load_into_sqlite, read_tsv_rows,
+)
+from utils import get_leveldb_cache_fullpath, get_sqlite_cache_fullpath
+
+"""
+load the tsv files of ingest_blocks.py (or dump_feerates_to_tsv.py /
+dump_tx_weights_to_tsv.py) into the leveldb (or sqlite) cache of get_tx_feerate /
+get_tx_weight, so later runs find all the dumped txs in the cache. see tsv_bulk_load.
+
+the cache must not be in use while it is loaded
+"""
+
+# the tsv files and the cached function of every kind of data
+TSV_KINDS = {
+    "feerates": (FEERATES_FOLDER, "block_*_feerates.tsv", "get_tx_feerate"),
+    "weights": (TX_WEIGHTS_FOLDER, "block_*_tx_weights.tsv", "get_tx_weight"),
+}
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="bulk load tsv files into a function cache")
+    parser.add_argument(
+        "kind", choices=sorted(TSV_KINDS.keys()),
+        help="the kind of tsv files to load",
+    )
+    parser.add_argument(
+        "--target", choices=["leveldb", "sqlite"], default="leveldb",
+        help="the kind of cache to load into (default: leveldb)",
+    )
+    parser.add_argument(
+        "--db", action="store", type=str, default=None,
+        help="path of the db to load into. default: the cache of the function",
+    )
+    parser.add_argument(
+        "--tsv-dir", action="store", type=str, default=None,
+        help="the directory of the tsv files. default: the one they are dumped to",
+    )
+    parser.add_argument(
+        "--max-rows-in-memory", action="store", type=int, default=SORT_MAX_ROWS_IN_MEMORY,
+        help="the number of rows sorted in memory at once",
+    )
+    parser.add_argument(
+        "--tmpdir", action="store", type=str, default=None,
+        help="where to keep the sorted runs (about the total size of the tsv files)",
+    )
+    parser.add_argument(
+        "--batch-size", action="store", type=int, default=LOAD_BATCH_SIZE,
+        help="number of rows written in a single batch",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    folder, pattern, func_name = TSV_KINDS[args.kind]
+    paths = sorted(glob.glob(os.path.join(args.tsv_dir or folder, pattern)))
+    logger.info(f"loading {len(paths)} tsv files into the {args.target} cache of {func_name}")
+    sorted_rows = external_sort(
+        read_tsv_rows(paths), max_rows_in_memory=args.max_rows_in_memory, tmpdir=args.tmpdir,
+    )
+    if args.target == "leveldb":
+        _, str_to_value, binary_codec = CONVERTIBLE_CACHES[func_name]
+        loaded = load_into_leveldb(
+            sorted_rows,
+            db_path=args.db or get_leveldb_cache_fullpath(func_name),
+            str_to_value=str_to_value,
+            binary_codec=binary_codec,
+            batch_size=args.batch_size,
+            logger=logger,
+        )
+    else:
+        loaded = load_into_sqlite(
+            sorted_rows,
+            db_path=args.db or get_sqlite_cache_fullpath(func_name),
+            table=func_name,
+            batch_size=args.batch_size,
+            logger=logger,
+        )
+    logger.info(f"loaded {loaded} rows into the cache of {func_name}")
@@ -0,0 +1,70 @@
+import argparse
+import os
+import shutil
+
+import plyvel
+
+from feerates import logger
+from shared_store import DEFAULT_SHARED_STORE_PATH, Namespace, count_unmigrated, migrate_leveldb, namespace_prefix
+from utils import SHARED_STORE_OPTIONS, get_leveldb_cache_fullpath
+
+"""
+copy the caches of functions from their own leveldbs (see get_leveldb_cache_fullpath)
+into their namespaces in the shared store (see shared_store), for functions that
+were changed to leveldb_cache(..., shared=True).
+
+the caches must not be in use while they are migrated. the shared store is opened
+exclusively (not through a cache server or a snapshot of it, which would lose the
+migrated entries), so the migration fails if another process has it open. the db of
+a function is deleted (with --delete-old) only after all its entries are verified to
+be in the shared store
+"""
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="migrate leveldb caches to the shared store")
+    parser.add_argument(
+        "functions", nargs="+", metavar="function",
+        help="the names of the functions whose caches to migrate, e.g. populate_block",
+    )
+    parser.add_argument(
+        "--batch-size", action="store", type=int, default=100_000,
+        help="number of entries written in a single batch",
+    )
+    parser.add_argument(
+        "--delete-old", action="store_true",
+        help="delete the db of every function once it is migrated",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    try:
+        store = plyvel.DB(DEFAULT_SHARED_STORE_PATH, create_if_missing=True, **SHARED_STORE_OPTIONS)
+    except plyvel.IOError as e:
+        raise RuntimeError(
+            f"failed to open the shared store at {DEFAULT_SHARED_STORE_PATH} ({e}). it may be "
+            f"open by another process (e.g. a cache server), which must be stopped first"
+        )
+    for func_name in args.functions:
+        src_path = get_leveldb_cache_fullpath(func_name)
+        if not os.path.exists(src_path):
+            logger.warning(f"{func_name} has no cache at {src_path}. skipping")
+            continue
+        logger.info(f"migrating the cache of {func_name}")
+        dst = Namespace(store, namespace_prefix(func_name))
+        copied = migrate_leveldb(src_path=src_path, dst=dst, batch_size=args.batch_size, logger=logger)
+        logger.info(f"migrated {copied} entries of {func_name}")
+        if args.delete_old:
+            unmigrated = count_unmigrated(src_path, dst, batch_size=args.batch_size)
+            if unmigrated:
+                logger.error(f"{unmigrated} entries of {func_name} are not in the shared store. keeping {src_path}")
+                continue
+            shutil.rmtree(src_path)
+    store.close()
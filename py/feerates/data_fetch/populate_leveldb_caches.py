@@ -1,43 +1,19 @@
 import argparse
-import time
-from concurrent.futures import ThreadPoolExecutor
+import os
 
-from bitcoin_cli import blockchain_height, get_tx_feerate, get_tx_weight, get_txs_in_block, set_bitcoin_cli
-from datatypes import BlockHeight
-from feerates import logger
-from utils import leveldb_cache
+from feerates.data_fetch.ingest_blocks import SINK_CACHES, add_ingest_arguments, get_sinks, ingest
+from paths import DATA
 
-MAX_WORKERS = None
+"""
+Populate the caches of get_tx_feerate and get_tx_weight with the txs of blocks.
+see ingest_blocks.py, which may write other sinks in the same pass
+"""
 
+# the blocks that were ingested, or failed (see ingest_manifest)
+MANIFEST_PATH = os.path.join(DATA, "populate_caches_manifest.json")
 
-# we use leveldb_cache for this function not because we need its return value,
-# but to avoid populating txs of some block twice.
-@leveldb_cache(value_to_str=str, str_to_value=lambda s: None)
-def populate_block(h: BlockHeight) -> None:
-    """
-    populate the tx feerates and tx weights caches with txs in block h.
-    if this method returns, population is done successfully. if a problem occurred
-    an exception will be raised
-    """
-    # all we need to do to populate the feerates and weights DBs is to
-    # query get_tx_feerate and get_tx_weight
-    txids = get_txs_in_block(height=h)
-    
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = set()
-        futures.update(executor.submit(get_tx_feerate, txid) for txid in txids)
-        futures.update(executor.submit(get_tx_weight, txid) for txid in txids)
-        for future in futures:
-            future.result()  # this will raise if get_tx_feerate/get_tx_weight raised an exception
-
-
-def populate_blocks(first_block: BlockHeight, last_block: BlockHeight) -> None:
-    for h in range(first_block, last_block + 1):
-        try:
-            logger.info(f"Dumping tx weights+feerates for block {h}")
-            populate_block(h)
-        except Exception as e:
-            logger.error(f"Exception occurred when trying to populate with txs in block {h}: {type(e)}:{str(e)}")
+# the high-water mark of the follower (when last_block is 0)
+FOLLOWER_STATE_PATH = os.path.join(DATA, "populate_caches_follower_state.json")
 
 
 def parse_args():
@@ -52,44 +28,22 @@ def parse_args():
     parser.add_argument(
         "last_block", type=int, action="store",
         help=(
-            "the last block to populate txs of. if 0 is given, populate all "
-            "blocks from first_block to the current blockchain height, indefinitely"
+            "the last block to populate txs of. if 0 is given, follow the chain: populate all "
+            "blocks from first_block to the current blockchain height, and then every new block"
         ),
     )
-    parser.add_argument(
-        "bitcoin_cli", choices=["master", "user"], metavar="bitcoin_cli",
-        help="the bitcoin-cli to use. must be one of `master` or `user`",
-    )
-    parser.add_argument(
-        "-j", "--jobs", action="store", type=int, default=None,
-        help="number of jobs to use for querying bitcoind",
-    )
+    add_ingest_arguments(parser)
     
     return parser.parse_args()
 
 
 def main():
-    args = parse_args()
-    global MAX_WORKERS
-    MAX_WORKERS = args.jobs
-    
-    set_bitcoin_cli(args.bitcoin_cli)
-    
-    if args.last_block != 0:
-        populate_blocks(first_block=args.first_block, last_block=args.last_block)
-    else:
-        # we populate all blocks from first_block to the current height, indefinitely
-        first_block = args.first_block
-        while True:
-            curr_height = blockchain_height()
-            logger.info(
-                f"Populating txs of all blocks from height {args.first_block} to current blockchain height ({curr_height})"
-            )
-            populate_blocks(first_block=first_block, last_block=curr_height)
-            logger.info("sleeping for 5 minutes")
-            time.sleep(60 * 5)
-            # populating some of the blocks could fail. for that, we don't update
-            # first_block and we'll start all over again and re-try failed blocks
+    ingest(
+        parse_args(),
+        sinks=get_sinks([SINK_CACHES]),
+        manifest_path=MANIFEST_PATH,
+        follower_state_path=FOLLOWER_STATE_PATH,
+    )
 
 
 if __name__ == "__main__":
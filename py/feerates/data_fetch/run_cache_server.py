@@ -0,0 +1,40 @@
+import argparse
+
+from cache_server import CacheServer, DEFAULT_SOCKET_PATH
+from feerates import logger
+
+"""
+run a cache server, which owns the leveldb caches and serves them to any number
+of processes (e.g. populate_leveldb_caches.py and the scripts that read the caches
+while it runs).
+
+start it before the processes that use the caches: a process that opened a db
+directly keeps it locked, and the server can't serve that db until it exits
+"""
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="serve the leveldb caches to many processes")
+    parser.add_argument(
+        "--socket", action="store", default=DEFAULT_SOCKET_PATH,
+        help=f"path of the unix socket to listen on (default: {DEFAULT_SOCKET_PATH}). "
+             f"clients look for the server at the default one, unless told otherwise (see set_socket_path)",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    server = CacheServer(socket_path=args.socket, logger=logger)
+    logger.info(f"cache server listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
@@ -0,0 +1,47 @@
+import argparse
+
+from bitcoin_rpc import BitcoinRPC
+from fee_estimation_series import DEFAULT_SERIES_PATH, FeeEstimationSeries, run_sampler
+from feerates import logger
+
+"""
+sample bitcoind's estimatesmartfee for all targets and modes once a minute, with a
+single JSON-RPC batch per sample, and append the estimations to the fee estimation
+series (see fee_estimation_series.py). replaces sh/sample-estimatesmartfee, which
+spawned bitcoin-cli for every estimation and wrote a text file per target and mode
+(export_fee_estimations.py writes these files from the series)
+"""
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="sample estimatesmartfee into the fee estimation series")
+    parser.add_argument(
+        "rpcconf", action="store", type=str,
+        help="bitcoin.conf of the node to query over JSON-RPC",
+    )
+    parser.add_argument(
+        "--series", action="store", type=str, default=DEFAULT_SERIES_PATH,
+        help="the file of the fee estimation series",
+    )
+    parser.add_argument(
+        "--interval", action="store", type=float, default=60,
+        help="seconds between samples",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    rpc = BitcoinRPC.from_conf(args.rpcconf)
+    series = FeeEstimationSeries(args.series)
+    logger.info(f"sampling {len(series.columns)} estimations every {args.interval} seconds into {args.series}")
+    try:
+        run_sampler(rpc, series, interval=args.interval, logger=logger)
+    finally:
+        series.close()
+        rpc.close()
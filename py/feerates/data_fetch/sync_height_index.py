@@ -0,0 +1,51 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bitcoin_cli import set_bitcoin_cli, set_bitcoin_rpc, sync_height_index
+from bitcoin_rpc import BitcoinRPC
+from feerates import logger
+from height_index import BlockHeightIndex
+
+"""
+build the block height index (see height_index.py), or bring it up to date with
+the current tip. only blocks that are not in the index yet are fetched
+"""
+
+
+def parse_args():
+    """
+    parse and return the program arguments
+    """
+    parser = argparse.ArgumentParser(description="sync the block height index with bitcoind")
+    parser.add_argument(
+        "bitcoin_cli", choices=["master", "user"], metavar="bitcoin_cli",
+        help="the bitcoin-cli to use. must be one of `master` or `user`",
+    )
+    parser.add_argument(
+        "--rpcconf", action="store", type=str, default=None,
+        help="bitcoin.conf of the node to query over JSON-RPC. if not given, bitcoin-cli is used",
+    )
+    parser.add_argument(
+        "--follow", action="store_true",
+        help="keep syncing every few minutes, indefinitely",
+    )
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    set_bitcoin_cli(args.bitcoin_cli)
+    if args.rpcconf:
+        set_bitcoin_rpc(BitcoinRPC.from_conf(args.rpcconf))
+    
+    index = BlockHeightIndex()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        while True:
+            added = sync_height_index(index, executor=executor)
+            logger.info(f"added {added} blocks to the height index. indexed tip: {index.tip_height}")
+            if not args.follow:
+                break
+            time.sleep(60 * 5)
@@ -1,21 +1,38 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from functools import lru_cache
 from typing import List, Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-from bitcoin_cli import get_block_time, get_tx_feerate, get_tx_weight, get_txs_in_block, set_bitcoin_cli
+from bitcoin_cli import get_tx_feerate, get_tx_weight, get_txs_in_block, set_bitcoin_cli
+from columnar_store import ColumnarStore, DEFAULT_COLUMNAR_STORE_PATH
 from datatypes import BlockHeight, Feerate, Timestamp
 from feerates import logger
 from feerates.graphs.estimated_feerates import parse_estimation_files
-from feerates.graphs.graph_utils import get_first_block_after_time_t
-from utils import leveldb_cache, timeit
+from feerates.graphs.graph_utils import get_block_times, get_first_block_after_time_t
+from utils import leveldb_cache, timeit, two_tier_cache
 
 set_bitcoin_cli("user")
 
 BLOCK_MAX_WEIGHT = 4_000_000
 
+# the space caches are keyed by heights (or ranges) x feerates, so parameter sweeps
+# would grow them without bound. the least recently used entries are evicted
+SPACE_CACHE_MAX_ENTRIES = 1_000_000
+
+# the in-memory tier in front of every cache. the results are floats, so this is a
+# few tens of MB per function
+L1_MAX_ENTRIES = 200_000
+
+# computes the feerates and weights that aren't cached yet
+executor = ThreadPoolExecutor()
+
+# the txs of the blocks that were ingested into the columnar store (see ingest_blocks.py)
+# are read from it. other blocks are computed from the caches of the tx feerates and weights
+columnar_store = ColumnarStore(readonly=True) if os.path.isdir(DEFAULT_COLUMNAR_STORE_PATH) else None
+
 num_blocks = 1
 plot_data = parse_estimation_files()[num_blocks][1]
 assert plot_data.label == "estimatesmartfee(n=1,mode=CONSERVATIVE)"
@@ -33,9 +50,39 @@ def get_feerate_estimation_at_time_t(t: Timestamp) -> Feerate:
     return feerates[timestamp_idx_to_eval]
 
 
-@lru_cache()
+def get_blocks_space_for_feerate_from_columnar_store(
+    first_block: BlockHeight,
+    last_block: BlockHeight,
+    feerate: Feerate,
+) -> np.ndarray:
+    """
+    return the available space under the given feerate (see get_block_space_for_feerate)
+    of every block in the range [first_block, last_block), from the columnar store.
+    the feerates are recomputed from the fees and sizes (the stored ones are float32), so
+    txs are compared to the given feerate exactly as get_tx_feerate's feerates are, and the
+    results don't depend on which source computed them
+    """
+    blocks = columnar_store.get_blocks(first_block, last_block - 1)
+    txs_feerates = blocks.fee / blocks.size  # float64, as TxStats.feerate
+    occupied_weights = np.where(txs_feerates > feerate, blocks.weight, 0)
+    # occupied_weights_cumsum[i]: the occupied weight in the first i txs of the range
+    occupied_weights_cumsum = np.concatenate([[0], np.cumsum(occupied_weights, dtype=np.int64)])
+    occupied_part_weights = occupied_weights_cumsum[blocks.offsets[1:]] - occupied_weights_cumsum[blocks.offsets[:-1]]
+    return BLOCK_MAX_WEIGHT - occupied_part_weights
+
+
+def in_columnar_store(first_block: BlockHeight, last_block: BlockHeight) -> bool:
+    """
+    return True if all blocks in the range [first_block, last_block) are in the columnar store
+    """
+    return columnar_store is not None and first_block in columnar_store and last_block - 1 in columnar_store
+
+
+@two_tier_cache(
+    leveldb_cache(value_to_str=str, str_to_value=float, max_entries=SPACE_CACHE_MAX_ENTRIES),
+    l1_max_entries=L1_MAX_ENTRIES,
+)
 @timeit(logger=logger, print_args=True)
-@leveldb_cache(value_to_str=str, str_to_value=float)
 def get_block_space_for_feerate(height: BlockHeight, feerate: Feerate) -> int:
     """
     Return the part of block 'height' that may be filled with
@@ -44,19 +91,25 @@ def get_block_space_for_feerate(height: BlockHeight, feerate: Feerate) -> int:
     than 'feerate', or an empty part of the block (in case the block is less
     than 4M weight units)
     """
-    txids = get_txs_in_block(height=height)
+    if in_columnar_store(height, height + 1):
+        return int(get_blocks_space_for_feerate_from_columnar_store(height, height + 1, feerate)[0])
+    
+    args_list = [(txid,) for txid in get_txs_in_block(height=height)]
+    txs_feerates = get_tx_feerate.get_many(args_list, executor=executor)
+    txs_weights = get_tx_weight.get_many(args_list, executor=executor)
     
     # find transactions that pay MORE than 'feerate' and sum their weight
-    occupied_part_weight = sum(map(
-        lambda txid: get_tx_weight(txid),
-        filter(lambda txid: get_tx_feerate(txid) > feerate, txids)
-    ))
+    occupied_part_weight = sum(
+        weight for tx_feerate, weight in zip(txs_feerates, txs_weights) if tx_feerate > feerate
+    )
     
     return BLOCK_MAX_WEIGHT - occupied_part_weight
 
 
-@lru_cache()
-@leveldb_cache(value_to_str=str, str_to_value=float)
+@two_tier_cache(
+    leveldb_cache(value_to_str=str, str_to_value=float, max_entries=SPACE_CACHE_MAX_ENTRIES),
+    l1_max_entries=L1_MAX_ENTRIES,
+)
 def get_average_block_space_for_feerate(
     first_block: BlockHeight,
     last_block: BlockHeight,
@@ -67,14 +120,17 @@ def get_average_block_space_for_feerate(
     range [first_blocks, last_block) under the given feerate
     this includes first_blocks and excludes last_block
     """
+    if in_columnar_store(first_block, last_block):
+        # a slice of the store, without going through the cache of every block
+        return np.average(get_blocks_space_for_feerate_from_columnar_store(first_block, last_block, feerate))
+    
     return np.average([
         get_block_space_for_feerate(height=h, feerate=feerate)
         for h in range(first_block, last_block)
     ])
 
 
-@lru_cache()
-@leveldb_cache(value_to_str=str, str_to_value=float)
+@two_tier_cache(leveldb_cache(value_to_str=str, str_to_value=float), l1_max_entries=L1_MAX_ENTRIES)
 def how_much_space_victims_have(attack_start_timestamp: int) -> float:
     """
     Return the average available block space
@@ -100,8 +156,7 @@ def how_much_space_victims_have(attack_start_timestamp: int) -> float:
     )
 
 
-@lru_cache()
-@leveldb_cache(value_to_str=str, str_to_value=float)
+@two_tier_cache(leveldb_cache(value_to_str=str, str_to_value=float), l1_max_entries=L1_MAX_ENTRIES)
 def how_much_space_victims_have_improved_strategy(
     attack_start_timestamp: int,
     pre_payment_period_in_blocks: int,
@@ -118,7 +173,7 @@ def how_much_space_victims_have_improved_strategy(
     # between time t and t + pre_payment_period_in_blocks blocks
     channel_open_height = get_first_block_after_time_t(attack_start_timestamp)
     first_estimation_time = attack_start_timestamp
-    last_estimation_time = get_block_time(channel_open_height + pre_payment_period_in_blocks - 1)
+    last_estimation_time = get_block_times()[channel_open_height + pre_payment_period_in_blocks - 1]
     # all feerates that were estimated in that period
     feerates_estimated_in_period = feerates[
         np.where((timestamps >= first_estimation_time) & (timestamps <= last_estimation_time))
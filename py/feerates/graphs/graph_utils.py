@@ -1,13 +1,19 @@
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 from typing import List
 
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.figure import Figure
 
-from bitcoin_cli import blockchain_height, get_block_time
+from bitcoin_cli import sync_height_index
 from datatypes import BlockHeight, Feerate, Timestamp
+from height_index import BlockHeightIndex
+
+# whether get_block_times brings the height index up to date with bitcoind first.
+# otherwise the index is only read, and should be synced with sync_height_index.py
+SYNC_HEIGHT_INDEX = False
 
 
 @dataclass
@@ -48,21 +54,61 @@ def plot_figure(title: str, plot_data_list: List[PlotData], **fig_kw) -> Figure:
     return fig
 
 
+def set_sync_height_index(sync: bool) -> None:
+    """
+    if sync is True, bring the height index up to date with bitcoind (which must be
+    running) when the block times are first needed
+    """
+    global SYNC_HEIGHT_INDEX
+    SYNC_HEIGHT_INDEX = sync
+    get_block_times.cache_clear()
+    get_block_max_times.cache_clear()
+
+
+@lru_cache(maxsize=1)
+def get_block_times() -> np.ndarray:
+    """
+    return the times of all blocks, by height.
+    the times are taken from the height index, which is read once, when this is
+    first called (and synced with bitcoind first, if set_sync_height_index was set)
+    """
+    if SYNC_HEIGHT_INDEX:
+        index = BlockHeightIndex()
+        sync_height_index(index)
+    else:
+        index = BlockHeightIndex(readonly=True)
+        if len(index) == 0:
+            raise ValueError(
+                f"the block height index at {index.path} is empty. build it with "
+                f"feerates/data_fetch/sync_height_index.py"
+            )
+    return np.array(index.times(), dtype=np.int64)
+
+
+@lru_cache(maxsize=1)
+def get_block_max_times() -> np.ndarray:
+    """
+    return, for every height, the max time of all blocks up to that height.
+    block times are not monotonic, but this is, so it can be searched
+    """
+    return np.maximum.accumulate(get_block_times())
+
+
+def get_first_blocks_after_times(ts: np.ndarray) -> np.ndarray:
+    """
+    batched version of get_first_block_after_time_t.
+    return the heights of the first blocks with timestamp greater or equal to each
+    of the given timestamps. timestamps after the last block map to the last block
+    """
+    max_times = get_block_max_times()
+    # the first height in which the max time reaches t is the first block with time >= t
+    heights = np.searchsorted(max_times, np.asarray(ts), side="left")
+    return np.minimum(heights, len(max_times) - 1)
+
+
 def get_first_block_after_time_t(t: Timestamp) -> BlockHeight:
     """
     return the height of the first block with timestamp greater or equal to
     the given timestamp
     """
-    low: int = 0
-    high = blockchain_height()
-    
-    # simple binary search
-    while low < high:
-        m = (low + high) // 2
-        m_time = get_block_time(m)
-        if m_time < t:
-            low = m + 1
-        else:
-            high = m
-    
-    return low
+    return int(get_first_blocks_after_times(np.array([t]))[0])
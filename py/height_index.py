@@ -0,0 +1,150 @@
+import os
+import threading
+from typing import Iterable, Optional
+
+import numpy as np
+
+from datatypes import Block, BlockHash, BlockHeight, Json, Timestamp
+from paths import CACHES_DIR
+
+HEIGHT_INDEX_PATH = os.path.join(CACHES_DIR, "block_height_index.bin")
+
+# one fixed-size record per block, by height. the hash is kept as raw bytes (in
+# display order) and not as a numpy string, which would drop trailing zero bytes
+BLOCK_RECORD_DTYPE = np.dtype([
+    ("hash", np.uint8, (32,)),
+    ("time", "<u4"),
+    ("mediantime", "<u4"),
+    ("size", "<u4"),
+    ("weight", "<u4"),
+    ("nTx", "<u4"),
+])
+
+
+class BlockHeightIndex:
+    """
+    A persistent map from block height to the block's hash, time, median time,
+    size, weight and number of txs, for the blocks of the best chain.
+    
+    The records are kept in a flat file that is memory-mapped as a numpy array, so
+    opening the index is instant and a lookup doesn't query bitcoind or a db.
+    Blocks are appended in height order (see bitcoin_cli.sync_height_index), and
+    removed from the top when they are disconnected by a reorg.
+    
+    A read-only index is never created or modified, so it may be opened while
+    another process syncs it (it sees the blocks that were indexed when it was opened)
+    """
+    
+    def __init__(self, path: str = HEIGHT_INDEX_PATH, readonly: bool = False) -> None:
+        self.path = path
+        self.readonly = readonly
+        self.lock = threading.Lock()  # for writers
+        if not os.path.isfile(path):
+            if readonly:
+                raise FileNotFoundError(
+                    f"no block height index at {path}. build it with feerates/data_fetch/sync_height_index.py"
+                )
+            open(path, "wb").close()
+        # a crash while appending may leave a partial record at the end (which
+        # readers ignore)
+        size = os.path.getsize(path)
+        if size % BLOCK_RECORD_DTYPE.itemsize and not readonly:
+            os.truncate(path, size - size % BLOCK_RECORD_DTYPE.itemsize)
+        self.__load()
+    
+    def __load(self) -> None:
+        num_records = os.path.getsize(self.path) // BLOCK_RECORD_DTYPE.itemsize
+        if num_records == 0:
+            # an empty file can't be memory-mapped
+            self.records = np.zeros(0, dtype=BLOCK_RECORD_DTYPE)
+        else:
+            self.records = np.memmap(self.path, dtype=BLOCK_RECORD_DTYPE, mode="r", shape=(num_records,))
+    
+    def __len__(self) -> int:
+        return len(self.records)
+    
+    def __contains__(self, height: BlockHeight) -> bool:
+        return 0 <= height < len(self.records)
+    
+    @property
+    def tip_height(self) -> Optional[BlockHeight]:
+        """
+        the height of the last block in the index, or None if it is empty
+        """
+        return len(self.records) - 1 if len(self.records) else None
+    
+    def block_hash(self, height: BlockHeight) -> BlockHash:
+        return self.records["hash"][height].tobytes().hex()
+    
+    def block_time(self, height: BlockHeight) -> Timestamp:
+        return int(self.records["time"][height])
+    
+    def block_size(self, height: BlockHeight) -> int:
+        return int(self.records["size"][height])
+    
+    def get(self, height: BlockHeight) -> Json:
+        """
+        return the indexed fields of the block, keyed as in getblock's result
+        """
+        record = self.records[height]
+        return {
+            "hash": record["hash"].tobytes().hex(),
+            "height": height,
+            "time": int(record["time"]),
+            "mediantime": int(record["mediantime"]),
+            "size": int(record["size"]),
+            "weight": int(record["weight"]),
+            "nTx": int(record["nTx"]),
+        }
+    
+    def times(self) -> np.ndarray:
+        """
+        return the times of all blocks, by height, as a (read-only) array
+        """
+        return self.records["time"]
+    
+    def __check_writable(self) -> None:
+        if self.readonly:
+            raise ValueError(f"the block height index at {self.path} is read-only")
+    
+    def append(self, blocks: Iterable[Block]) -> None:
+        """
+        append the given blocks (as returned by getblock), which should be the next
+        blocks after the tip, in height order
+        """
+        self.__check_writable()
+        blocks = list(blocks)
+        with self.lock:
+            for i, block in enumerate(blocks):
+                if block["height"] != len(self.records) + i:
+                    raise ValueError(f"expected block {len(self.records) + i}, got block {block['height']}")
+            
+            new_records = np.zeros(len(blocks), dtype=BLOCK_RECORD_DTYPE)
+            for i, block in enumerate(blocks):
+                new_records[i]["hash"] = np.frombuffer(bytes.fromhex(block["hash"]), dtype=np.uint8)
+                new_records[i]["time"] = block["time"]
+                new_records[i]["mediantime"] = block["mediantime"]
+                new_records[i]["size"] = block["size"]
+                new_records[i]["weight"] = block["weight"]
+                new_records[i]["nTx"] = block["nTx"]
+            # the file only grows here, so existing mappings (and arrays returned
+            # by times()) stay valid
+            with open(self.path, "ab") as f:
+                f.write(new_records.tobytes())
+            self.__load()
+    
+    def truncate(self, height: BlockHeight) -> None:
+        """
+        remove the block at the given height and all blocks above it
+        """
+        self.__check_writable()
+        with self.lock:
+            if height >= len(self.records):
+                return
+            # the kept records are written to a new file, instead of truncating the
+            # existing one, which may still be mapped by arrays we returned
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(np.asarray(self.records[:height]).tobytes())
+            os.rename(tmp_path, self.path)
+            self.__load()
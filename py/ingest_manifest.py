@@ -0,0 +1,142 @@
+import base64
+import json
+import os
+import time
+import zlib
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+
+from datatypes import BlockHeight, Timestamp
+
+"""
+A manifest of the blocks that were ingested (see block_ingester): a bitmap of the
+heights that are done in all sinks, and a record of every height that failed, with
+the reason and the number of attempts.
+
+The manifest is a single json file, written atomically (to a temporary file that is
+renamed), with the bitmap compressed, so hundreds of thousands of heights are loaded
+and searched for gaps in milliseconds, instead of checking the sinks for every height.
+"""
+
+MANIFEST_VERSION = 1
+
+
+class FailureRecord(NamedTuple):
+    reason: str
+    retries: int  # the number of failed attempts
+    last_attempt: Timestamp
+
+
+class IngestManifest:
+    """
+    the manifest at path (empty if the file doesn't exist). changes are kept in
+    memory until save() is called
+    """
+    
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done = np.zeros(0, dtype=bool)  # by height
+        self.failures: Dict[BlockHeight, FailureRecord] = {}
+        self.dirty = False
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            bits = np.frombuffer(zlib.decompress(base64.b64decode(manifest["done"])), dtype=np.uint8)
+            self.done = np.unpackbits(bits, count=manifest["num_heights"]).astype(bool)
+            self.failures = {int(h): FailureRecord(*record) for h, record in manifest["failures"].items()}
+    
+    def is_done(self, h: BlockHeight) -> bool:
+        return h < len(self.done) and bool(self.done[h])
+    
+    def __set_done(self, h: BlockHeight, done: bool) -> None:
+        if h >= len(self.done):
+            if not done:
+                return
+            # grow by at least a half, so marking consecutive heights doesn't copy every time
+            grown = np.zeros(max(h + 1, len(self.done) * 3 // 2), dtype=bool)
+            grown[:len(self.done)] = self.done
+            self.done = grown
+        self.done[h] = done
+        self.dirty = True
+    
+    def mark_done(self, h: BlockHeight) -> None:
+        self.__set_done(h, True)
+        if self.failures.pop(h, None) is not None:
+            self.dirty = True
+    
+    def mark_failed(self, h: BlockHeight, reason: str) -> None:
+        self.__set_done(h, False)
+        previous = self.failures.get(h)
+        retries = previous.retries + 1 if previous is not None else 1
+        self.failures[h] = FailureRecord(reason=reason, retries=retries, last_attempt=int(time.time()))
+        self.dirty = True
+    
+    def unmark(self, h: BlockHeight) -> None:
+        """
+        forget block h (e.g. if it was disconnected by a reorg)
+        """
+        self.__set_done(h, False)
+        if self.failures.pop(h, None) is not None:
+            self.dirty = True
+    
+    @property
+    def last_height(self) -> BlockHeight:
+        """
+        the highest height that is done or failed (-1 if none)
+        """
+        done = np.flatnonzero(self.done)
+        return max([int(done[-1]) if len(done) > 0 else -1] + list(self.failures.keys()))
+    
+    def missing(self, first_block: BlockHeight, last_block: BlockHeight, max_retries: int = None) -> List[BlockHeight]:
+        """
+        return the heights in first_block..last_block (inclusive) that are not done,
+        in order. if max_retries is given, heights that failed that many times are left out
+        """
+        done = np.zeros(last_block - first_block + 1, dtype=bool)
+        known = self.done[first_block:last_block + 1]
+        done[:len(known)] = known
+        heights = (np.flatnonzero(~done) + first_block).tolist()
+        if max_retries is not None:
+            heights = [
+                h for h in heights
+                if h not in self.failures or self.failures[h].retries < max_retries
+            ]
+        return heights
+    
+    def missing_ranges(
+        self,
+        first_block: BlockHeight,
+        last_block: BlockHeight,
+        max_retries: int = None,
+    ) -> List[Tuple[BlockHeight, BlockHeight]]:
+        """
+        the heights returned by missing(), as (first, last) ranges (inclusive)
+        """
+        ranges = []
+        for h in self.missing(first_block, last_block, max_retries=max_retries):
+            if ranges and ranges[-1][1] == h - 1:
+                ranges[-1] = (ranges[-1][0], h)
+            else:
+                ranges.append((h, h))
+        return ranges
+    
+    def save(self) -> None:
+        """
+        write the manifest, if it changed, atomically
+        """
+        if not self.dirty:
+            return
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "num_heights": len(self.done),
+            "done": base64.b64encode(zlib.compress(np.packbits(self.done).tobytes())).decode("ascii"),
+            "failures": {h: list(record) for h, record in sorted(self.failures.items())},
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.dirty = False
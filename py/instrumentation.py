@@ -0,0 +1,243 @@
+import bisect
+import threading
+from collections import defaultdict
+from logging import Logger
+from typing import Any, Callable, Dict, List, Tuple
+
+"""
+Lightweight counters for the queries we make to bitcoind and for the function caches,
+so we can tell where a slow run spends its time: in bitcoind, in spawning bitcoin-cli
+processes, or in the caches.
+
+Everything is recorded in the global METRICS object. recording is a few dictionary
+updates under a lock, so it is on by default.
+"""
+
+# upper bounds of the latency histogram buckets, in seconds: 100us, 200us, ... ~52s.
+# the last bucket is unbounded
+HISTOGRAM_BOUNDS: List[float] = [0.0001 * 2 ** i for i in range(20)]
+
+
+class LatencyHistogram:
+    """
+    a histogram of latencies with exponential buckets (see HISTOGRAM_BOUNDS)
+    """
+    
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, p: float) -> float:
+        """
+        return an upper bound of the p-th percentile (0 < p <= 100): the upper bound of
+        the bucket it falls in (or the max latency, for the last bucket)
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        cumulative = 0
+        for i, n in enumerate(self.buckets):
+            cumulative += n
+            if cumulative >= rank:
+                return min(HISTOGRAM_BOUNDS[i], self.max) if i < len(HISTOGRAM_BOUNDS) else self.max
+        return self.max
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else 0.0,
+            "p50_seconds": self.percentile(50),
+            "p90_seconds": self.percentile(90),
+            "p99_seconds": self.percentile(99),
+            "max_seconds": self.max,
+            "buckets": dict(zip([str(b) for b in HISTOGRAM_BOUNDS] + ["inf"], self.buckets)),
+        }
+
+
+class QueryStats:
+    """
+    stats of the requests of a single RPC method over a single transport
+    """
+    
+    def __init__(self) -> None:
+        self.requests = 0
+        self.calls = 0  # a batch request has many calls
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = LatencyHistogram()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency": self.latency.snapshot(),
+        }
+
+
+class CacheStats:
+    """
+    stats of the lookups in the cache of a single function
+    """
+    
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.lookup_latency = LatencyHistogram()  # time spent in the db, for hits and misses
+    
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "lookup_latency": self.lookup_latency.snapshot(),
+        }
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.enabled = True
+        self.__lock = threading.Lock()
+        self.__queries: Dict[Tuple[str, str], QueryStats] = defaultdict(QueryStats)
+        self.__caches: Dict[str, CacheStats] = defaultdict(CacheStats)
+        self.__lru_caches: Dict[str, Callable] = {}
+        self.__coalesced: Dict[str, int] = defaultdict(int)
+    
+    def record_query(
+        self,
+        transport: str,
+        method: str,
+        seconds: float,
+        calls: int = 1,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+        error: bool = False,
+    ) -> None:
+        """
+        record a request to bitcoind.
+        transport is "rpc" (JSON-RPC) or "cli" (a bitcoin-cli process)
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            stats = self.__queries[(transport, method)]
+            stats.requests += 1
+            stats.calls += calls
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            if error:
+                stats.errors += 1
+            stats.latency.observe(seconds)
+    
+    def record_cache_lookup(self, name: str, hit: bool, seconds: float) -> None:
+        if not self.enabled:
+            return
+        with self.__lock:
+            stats = self.__caches[name]
+            if hit:
+                stats.hits += 1
+            else:
+                stats.misses += 1
+            stats.lookup_latency.observe(seconds)
+    
+    def record_coalesced(self, name: str) -> None:
+        """
+        record a call that waited for an identical call in flight (see single_flight)
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__coalesced[name] += 1
+    
+    def register_lru_cache(self, name: str, func: Callable) -> None:
+        """
+        include the stats of a functools.lru_cache decorated function (or anything
+        else with a cache_info() method, e.g. a MemoryCache) in snapshots.
+        lru_cache keeps its own counters, so nothing is recorded per call
+        """
+        self.__lru_caches[name] = func
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        return all stats recorded so far, as plain dictionaries:
+            queries: transport -> method -> stats (see QueryStats)
+            caches: function name -> stats (see CacheStats)
+            lru_caches: function name -> hits, misses and size
+            coalesced: function name -> number of coalesced calls
+        """
+        with self.__lock:
+            queries: Dict[str, Dict[str, Any]] = defaultdict(dict)
+            for (transport, method), stats in self.__queries.items():
+                queries[transport][method] = stats.snapshot()
+            caches = {name: stats.snapshot() for name, stats in self.__caches.items()}
+            coalesced = dict(self.__coalesced)
+        lru_caches = {}
+        for name, func in self.__lru_caches.items():
+            info = func.cache_info()
+            lookups = info.hits + info.misses
+            lru_caches[name] = {
+                "hits": info.hits,
+                "misses": info.misses,
+                "hit_ratio": info.hits / lookups if lookups else 0.0,
+                "size": info.currsize,
+            }
+        return {"queries": dict(queries), "caches": caches, "lru_caches": lru_caches, "coalesced": coalesced}
+    
+    def reset(self) -> None:
+        with self.__lock:
+            self.__queries.clear()
+            self.__caches.clear()
+            self.__coalesced.clear()
+    
+    def summary(self) -> str:
+        """
+        return a one-line summary of the snapshot, for logging
+        """
+        snapshot = self.snapshot()
+        parts = []
+        for transport, methods in snapshot["queries"].items():
+            for method, stats in sorted(methods.items()):
+                latency = stats["latency"]
+                parts.append(
+                    f"{transport}:{method} {stats['calls']} calls/{stats['requests']} reqs "
+                    f"{stats['errors']} errs p50={round(latency['p50_seconds'] * 1000, 1)}ms "
+                    f"p99={round(latency['p99_seconds'] * 1000, 1)}ms "
+                    f"total={round(latency['total_seconds'], 1)}s "
+                    f"recv={round(stats['bytes_received'] / 2 ** 20, 1)}MB"
+                )
+        for name, stats in sorted({**snapshot["caches"], **snapshot["lru_caches"]}.items()):
+            parts.append(f"cache:{name} {stats['hits']}/{stats['hits'] + stats['misses']} hits")
+        for name, coalesced in sorted(snapshot["coalesced"].items()):
+            parts.append(f"coalesced:{name} {coalesced}")
+        return " | ".join(parts) if parts else "nothing recorded"
+    
+    def start_periodic_log(self, logger: Logger, interval: float = 300) -> threading.Event:
+        """
+        log the summary every `interval` seconds, in a background thread.
+        return an event that stops the logging when set
+        """
+        stop = threading.Event()
+        
+        def log_loop():
+            while not stop.wait(interval):
+                logger.info(f"metrics: {self.summary()}")
+        
+        threading.Thread(target=log_loop, daemon=True).start()
+        return stop
+
+
+METRICS = Metrics()
@@ -0,0 +1,102 @@
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Any, Callable, Hashable
+
+"""
+A bounded in-memory cache, used as the first tier of two_tier_cache (see utils).
+
+Unlike functools.lru_cache, it may be bounded by the (estimated) size of its entries,
+and not only by their number, and its entries can be looked up and written directly.
+"""
+
+# same fields as the cache_info() of functools.lru_cache, so both are reported alike
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# returned by MemoryCache.get for keys that aren't cached (None may be a cached value)
+MISSING = object()
+
+
+class MemoryCache:
+    """
+    a thread-safe LRU cache of at most max_entries entries and max_bytes bytes (either
+    may be None, for no limit). the size of an entry is sizeof(key) + sizeof(value),
+    where sizeof is sys.getsizeof by default, which doesn't count referenced objects.
+    give a deeper sizeof for values that are containers
+    """
+    
+    def __init__(
+        self,
+        max_entries: int = None,
+        max_bytes: int = None,
+        sizeof: Callable[[Any], int] = sys.getsizeof,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        
+        self.__lock = threading.Lock()
+        # key -> (value, size). the least recently used entry is first
+        self.__entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.__bytes = 0
+    
+    def __len__(self) -> int:
+        return len(self.__entries)
+    
+    @property
+    def total_bytes(self) -> int:
+        return self.__bytes
+    
+    def is_full(self) -> bool:
+        return (
+            (self.max_entries is not None and len(self.__entries) >= self.max_entries)
+            or
+            (self.max_bytes is not None and self.__bytes >= self.max_bytes)
+        )
+    
+    def get(self, key: Hashable) -> Any:
+        """
+        return the value of key, or MISSING
+        """
+        with self.__lock:
+            entry = self.__entries.get(key, MISSING)
+            if entry is MISSING:
+                self.misses += 1
+                return MISSING
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(key) + self.sizeof(value)
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__bytes -= old[1]
+            self.__entries[key] = (value, size)
+            self.__bytes += size
+            while len(self.__entries) > 1 and (
+                (self.max_entries is not None and len(self.__entries) > self.max_entries)
+                or
+                (self.max_bytes is not None and self.__bytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.__bytes -= evicted_size
+                self.evicted += 1
+    
+    def delete(self, key: Hashable) -> None:
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__bytes -= old[1]
+    
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+    
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(hits=self.hits, misses=self.misses, maxsize=self.max_entries, currsize=len(self.__entries))
@@ -0,0 +1,110 @@
+import os
+import struct
+from typing import Dict, Iterable, Optional
+
+import plyvel
+
+from datatypes import Block, BlockHeight, Outpoint, Satoshi, btc_to_sat_exact
+from paths import CACHES_DIR
+
+OUTPOINT_VALUES_DB_PATH = os.path.join(CACHES_DIR, "outpoint_values_leveldb")
+
+OUTPUT_KEY_PREFIX = b"o"
+HEIGHT_KEY = b"m:height"
+
+VALUE_FORMAT = struct.Struct("<Q")
+
+
+def outpoint_to_key(outpoint: Outpoint) -> bytes:
+    txid, n = outpoint
+    # all outputs of a tx are adjacent in the db
+    return OUTPUT_KEY_PREFIX + bytes.fromhex(txid) + n.to_bytes(4, "big")
+
+
+class OutpointValueStore:
+    """
+    A persistent map from an outpoint (txid, output index) to the value of that
+    output, in satoshi.
+    
+    The store is filled by adding blocks with full transactions, in height order.
+    The outputs of every block are added, and the outputs its inputs spend are
+    removed (unless prune_spent is False), so the store holds (at most) the
+    unspent outputs created since the first block that was added.
+    This way, the fee of a tx in a later block can be computed from local lookups,
+    instead of fetching its parents from bitcoind.
+    
+    Unlike the function caches, keys and values are binary (the raw txid followed
+    by the 4-byte output index, and a 8-byte little-endian value), as this store
+    is only used internally and may contain tens of millions of outputs.
+    """
+    
+    def __init__(self, db_path: str = OUTPOINT_VALUES_DB_PATH, prune_spent: bool = True) -> None:
+        self.db_path = db_path
+        self.prune_spent = prune_spent
+        self.db = plyvel.DB(db_path, create_if_missing=True)
+    
+    @property
+    def last_height(self) -> Optional[BlockHeight]:
+        """
+        the height of the last block that was added, or None if none was added
+        """
+        value = self.db.get(HEIGHT_KEY)
+        return int(value) if value is not None else None
+    
+    def get(self, outpoint: Outpoint) -> Optional[Satoshi]:
+        value = self.db.get(outpoint_to_key(outpoint))
+        return VALUE_FORMAT.unpack(value)[0] if value is not None else None
+    
+    def get_many(self, outpoints: Iterable[Outpoint]) -> Dict[Outpoint, Optional[Satoshi]]:
+        """
+        return the values of all given outpoints. outpoints that are not in the
+        store are mapped to None
+        """
+        # looking up the keys in sorted order is friendlier to leveldb's block cache
+        keys = sorted((outpoint_to_key(outpoint), outpoint) for outpoint in outpoints)
+        values = {}
+        for key, outpoint in keys:
+            value = self.db.get(key)
+            values[outpoint] = VALUE_FORMAT.unpack(value)[0] if value is not None else None
+        return values
+    
+    def put_many(self, values: Dict[Outpoint, Satoshi]) -> None:
+        with self.db.write_batch() as wb:
+            for outpoint, value in values.items():
+                wb.put(outpoint_to_key(outpoint), VALUE_FORMAT.pack(value))
+    
+    def apply(self, created: Dict[Outpoint, Satoshi], spent: Iterable[Outpoint], height: BlockHeight) -> None:
+        """
+        add the outputs created by the block at the given height, and remove the
+        outputs it spends. all changes are written atomically
+        """
+        with self.db.write_batch() as wb:
+            for outpoint, value in created.items():
+                wb.put(outpoint_to_key(outpoint), VALUE_FORMAT.pack(value))
+            if self.prune_spent:
+                # an output may be spent in the block that created it, so deletions
+                # come after the additions
+                for outpoint in spent:
+                    wb.delete(outpoint_to_key(outpoint))
+            wb.put(HEIGHT_KEY, str(height).encode("utf-8"))
+    
+    def add_block(self, block: Block) -> None:
+        """
+        apply a block with full transactions (getblock verbosity >= 2)
+        """
+        self.apply(
+            created={
+                (tx["txid"], out["n"]): btc_to_sat_exact(out["value"])
+                for tx in block["tx"]
+                for out in tx["vout"]
+            },
+            spent=[
+                (src_entry["txid"], src_entry["vout"])
+                for tx in block["tx"]
+                for src_entry in tx["vin"] if "coinbase" not in src_entry
+            ],
+            height=block["height"],
+        )
+    
+    def close(self) -> None:
+        self.db.close()
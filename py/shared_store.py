@@ -0,0 +1,171 @@
+import os
+import time
+from logging import Logger
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import plyvel
+
+from cache_server import RemoteDB, leveldb_get_many
+from paths import CACHES_DIR
+
+"""
+A single leveldb shared by many leveldb_cache decorated functions (see the `shared`
+argument of leveldb_cache), instead of a leveldb per function.
+
+Every function has a namespace in the shared db: its keys are prefixed by the
+function name and a zero byte. the shared db has a single block cache, write buffer
+and set of open files, whose sizes are set once for all the functions (see
+set_shared_store_options in utils), and writes to the caches of many functions may
+be written in a single atomic batch (see LevelDBWriteBuffer).
+
+The caches of functions that were kept in per-function dbs are copied into the
+shared db by migrate_caches_to_shared_store.py.
+"""
+
+DEFAULT_SHARED_STORE_PATH = os.path.join(CACHES_DIR, "shared_py_function_leveldb")
+
+# defaults of the shared db (the defaults of leveldb are 8MB and 4MB, for a single function)
+SHARED_LRU_CACHE_SIZE = 256 * 2 ** 20
+SHARED_WRITE_BUFFER_SIZE = 64 * 2 ** 20
+
+RootDB = Union[plyvel.DB, RemoteDB]
+
+
+def namespace_prefix(name: str) -> bytes:
+    """
+    the prefix of the keys of the function `name`. function names don't contain zero
+    bytes, so no prefix is a prefix of another
+    """
+    return name.encode("utf-8") + b"\x00"
+
+
+class NamespaceWriteBatch:
+    """
+    a write batch of the root db, whose keys are prefixed by the namespace prefix
+    """
+    
+    def __init__(self, namespace: "Namespace") -> None:
+        self.prefix = namespace.prefix
+        self.batch = namespace.root.write_batch()
+    
+    def put(self, key: bytes, value: bytes) -> None:
+        self.batch.put(self.prefix + key, value)
+    
+    def delete(self, key: bytes) -> None:
+        self.batch.delete(self.prefix + key)
+    
+    def write(self) -> None:
+        self.batch.write()
+    
+    def __enter__(self) -> "NamespaceWriteBatch":
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.write()
+
+
+class Namespace:
+    """
+    the keys of a db (plyvel.DB or RemoteDB) that start with `prefix`, with the
+    subset of plyvel.DB methods that leveldb_cache uses, and get_many.
+    
+    closing a namespace doesn't close the db, which other namespaces may use
+    """
+    
+    def __init__(self, root: RootDB, prefix: bytes) -> None:
+        self.root = root
+        self.prefix = prefix
+        self.__closed = False
+    
+    @property
+    def closed(self) -> bool:
+        return self.__closed or self.root.closed
+    
+    def close(self) -> None:
+        self.__closed = True
+    
+    def get(self, key: bytes) -> Optional[bytes]:
+        return self.root.get(self.prefix + key)
+    
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, bytes]:
+        prefixed = [self.prefix + key for key in keys]
+        if isinstance(self.root, RemoteDB):
+            values = self.root.get_many(prefixed)
+        else:
+            values = leveldb_get_many(self.root, prefixed)
+        n = len(self.prefix)
+        return {key[n:]: value for key, value in values.items()}
+    
+    def put(self, key: bytes, value: bytes) -> None:
+        self.root.put(self.prefix + key, value)
+    
+    def delete(self, key: bytes) -> None:
+        self.root.delete(self.prefix + key)
+    
+    def write_batch(self) -> NamespaceWriteBatch:
+        return NamespaceWriteBatch(self)
+    
+    def iterator(self, include_value: bool = True) -> Iterator[Union[bytes, Tuple[bytes, bytes]]]:
+        n = len(self.prefix)
+        if not include_value:
+            return (key[n:] for key in self.root.iterator(prefix=self.prefix, include_value=False))
+        return ((key[n:], value) for key, value in self.root.iterator(prefix=self.prefix))
+    
+    def prefixed_db(self, prefix: bytes) -> "Namespace":
+        return Namespace(self.root, self.prefix + prefix)
+    
+    def is_empty(self) -> bool:
+        return next(self.iterator(include_value=False), None) is None
+
+
+def migrate_leveldb(src_path: str, dst: Namespace, batch_size: int = 100_000, logger: Logger = None) -> int:
+    """
+    copy all entries of the leveldb at src_path (of a single function) into the
+    namespace dst, and return the number of copied entries. the format key and the
+    access metadata of the cache are copied as is, so they keep their meaning.
+    
+    copying is idempotent, so a migration that stopped may simply be run again
+    """
+    src = plyvel.DB(src_path)
+    t0 = time.time()
+    copied = 0
+    wb = dst.write_batch()
+    try:
+        for key, value in src.iterator():
+            wb.put(key, value)
+            copied += 1
+            if copied % batch_size == 0:
+                wb.write()
+                wb = dst.write_batch()
+                if logger is not None:
+                    logger.info(f"copied {copied} entries ({round(copied / (time.time() - t0))} entries/sec)")
+        wb.write()
+    finally:
+        src.close()
+    return copied
+
+
+def count_unmigrated(src_path: str, dst: Namespace, batch_size: int = 100_000) -> int:
+    """
+    return the number of entries of the leveldb at src_path that are not in the
+    namespace dst with the same value (0 once migrate_leveldb copied all of them)
+    """
+    src = plyvel.DB(src_path)
+    unmigrated = 0
+    try:
+        batch = []
+        for entry in src.iterator():
+            batch.append(entry)
+            if len(batch) == batch_size:
+                unmigrated += __count_unmigrated(batch, dst)
+                batch = []
+        unmigrated += __count_unmigrated(batch, dst)
+    finally:
+        src.close()
+    return unmigrated
+
+
+def __count_unmigrated(entries: Sequence[Tuple[bytes, bytes]], dst: Namespace) -> int:
+    values = dst.get_many([key for key, _ in entries])
+    return sum(values.get(key) != value for key, value in entries)
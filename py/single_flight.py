@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import Future
+from functools import wraps
+from typing import Any, Callable, Dict, Hashable
+
+from instrumentation import METRICS
+
+"""
+Single-flight de-duplication of concurrent calls: while the result of some key is
+being computed, other callers of the same key wait for that computation instead of
+starting their own (e.g. many threads that miss the cache on the same txid make a
+single RPC call).
+
+Only concurrent calls are coalesced. a result isn't kept after its computation ends:
+that is the job of the cache in front of it.
+"""
+
+
+class SingleFlight:
+    """
+    coalesce concurrent calls of do() with equal keys.
+    coalesced calls are counted, and recorded in METRICS under `name` (if given)
+    """
+    
+    def __init__(self, name: str = None) -> None:
+        self.name = name
+        self.coalesced = 0
+        self.__lock = threading.Lock()
+        self.__in_flight: Dict[Hashable, Future] = {}
+    
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        return fn(), or, if a call with the same key is in flight, wait for it and
+        return its result (or raise its exception)
+        """
+        with self.__lock:
+            future = self.__in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.__in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            if self.name is not None:
+                METRICS.record_coalesced(self.name)
+            return future.result()
+        
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+
+
+def single_flight(func: Callable) -> Callable:
+    """
+    a decorator that coalesces concurrent calls of func with equal arguments (see
+    SingleFlight). the arguments must be hashable.
+    the decorated function has a `single_flight` attribute, with the coalesced counter
+    """
+    flight = SingleFlight(name=func.__name__)
+    
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+        return flight.do(key, lambda: func(*args, **kwargs))
+    
+    wrapper.single_flight = flight
+    return wrapper
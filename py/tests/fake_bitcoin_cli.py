@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+
+from bitcoin_rpc import BitcoinRPC, BitcoinRPCError, BitcoinRPCTransportError
+
+"""
+A minimal bitcoin-cli replacement that talks to a FakeBitcoind.
+usage: fake_bitcoin_cli.py -rpcport=<port> -rpcuser=<user> -rpcpassword=<password> <method> [params...]
+
+Like bitcoin-cli, every invocation is a new process with a new connection,
+so it is used to benchmark the cost of spawning bitcoin-cli per call
+"""
+
+
+def fake_bitcoin_cli_command(server) -> str:
+    """
+    the command (to set as bitcoin_cli.BITCOIN_CLI) that runs this script against
+    the given FakeBitcoind
+    """
+    py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return (
+        f"env PYTHONPATH={py_dir} {sys.executable} {os.path.abspath(__file__)} -rpcport={server.port} "
+        f"-rpcuser={server.user} -rpcpassword={server.password} "
+    )
+
+
+def main() -> int:
+    options = {}
+    args = sys.argv[1:]
+    while args and args[0].startswith("-"):
+        key, value = args.pop(0)[1:].split("=", 1)
+        options[key] = value
+    
+    method, params = args[0], []
+    for arg in args[1:]:
+        try:
+            params.append(json.loads(arg))
+        except ValueError:
+            params.append(arg)
+    
+    rpc = BitcoinRPC(
+        port=int(options["rpcport"]),
+        user=options.get("rpcuser"),
+        password=options.get("rpcpassword"),
+        pool_size=1,
+    )
+    try:
+        result = rpc.call(method, *params)
+    except BitcoinRPCError as e:
+        print(f"error code: {e.code}\nerror message:\n{e.message}", file=sys.stderr)
+        return abs(e.code)
+    except BitcoinRPCTransportError as e:
+        if e.status != 503:
+            raise
+        # as bitcoin-cli reports an exceeded work queue
+        print(f"error: Server response: {e.body}", file=sys.stderr)
+        return 1
+    
+    print(result if isinstance(result, str) else json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
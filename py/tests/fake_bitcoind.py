@@ -0,0 +1,397 @@
+import base64
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+
+from datatypes import Block, BlockHash, TX, TXID
+
+"""
+A stand-in for bitcoind's JSON-RPC interface, serving a synthetic chain.
+
+It is used by the tests, and by benchmarks that need a local RPC server
+(e.g. to compare the JSON-RPC transport with spawning bitcoin-cli)
+"""
+
+GENESIS_TIME = 1583317269
+BLOCK_INTERVAL = 600  # seconds
+
+
+class FakeRPCError(Exception):
+    def __init__(self, code: int, message: str, http_status: int = 500) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.http_status = http_status
+
+
+def fake_hash(*parts) -> str:
+    return hashlib.sha256(":".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class FakeChain:
+    """
+    A synthetic chain. Every block has a coinbase and some transactions that spend
+    outputs of previous transactions (possibly in the same block).
+    Transactions and blocks are kept in the JSON format returned by bitcoind
+    """
+    
+    def __init__(self, num_blocks: int = 10, txs_per_block: int = 5, seed: int = 0) -> None:
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.txs_per_block = txs_per_block
+        self.blocks: List[Block] = []  # by height
+        self.blocks_by_hash: Dict[BlockHash, Block] = {}
+        self.txs: Dict[TXID, TX] = {}
+        self.utxos: List[tuple] = []  # (txid, n, value in satoshi)
+        self.lock = threading.Condition()
+        self.supports_prevouts = True  # getblock verbosity 3
+        for _ in range(num_blocks):
+            self.add_block()
+    
+    def height(self) -> int:
+        return len(self.blocks) - 1
+    
+    def __make_tx(self, height: int, idx: int, block_hash: str, coinbase: bool) -> TX:
+        txid = fake_hash("tx", self.seed, height, idx, block_hash)
+        if coinbase:
+            vin = [{"coinbase": fake_hash("coinbase", height)[:16], "sequence": 4294967295}]
+            in_value = 625_000_000
+            fee = 0
+        else:
+            num_inputs = min(len(self.utxos), self.random.randint(1, 2))
+            spent = [self.utxos.pop(self.random.randrange(len(self.utxos))) for _ in range(num_inputs)]
+            vin = [{"txid": s_txid, "vout": n, "sequence": 4294967295} for s_txid, n, _ in spent]
+            in_value = sum(value for _, _, value in spent)
+            fee = min(in_value // 2, self.random.randint(200, 20_000))
+        
+        out_value = in_value - fee
+        num_outputs = self.random.randint(1, 3)
+        values = [out_value // num_outputs] * num_outputs
+        values[0] += out_value - sum(values)
+        vout = [
+            {"value": round(value / 10 ** 8, 8), "n": n, "scriptPubKey": {"type": "witness_v0_keyhash"}}
+            for n, value in enumerate(values)
+        ]
+        
+        base_size = self.random.randint(150, 400)
+        witness_size = 0 if coinbase else self.random.randint(0, 250)
+        weight = base_size * 4 + witness_size
+        tx = {
+            "txid": txid,
+            "hash": fake_hash("wtx", txid) if witness_size else txid,
+            "version": 2,
+            "size": base_size + witness_size,
+            "vsize": (weight + 3) // 4,
+            "weight": weight,
+            "locktime": 0,
+            "vin": vin,
+            "vout": vout,
+            "blockhash": block_hash,
+        }
+        if not coinbase:
+            tx["fee_sat"] = fee  # not part of bitcoind's format. used for testing
+        return tx
+    
+    def add_block(self, num_txs: int = None) -> Block:
+        """
+        mine a new block on top of the current tip
+        """
+        with self.lock:
+            if num_txs is None:
+                num_txs = self.txs_per_block
+            height = len(self.blocks)
+            prev_hash = self.blocks[-1]["hash"] if self.blocks else "00" * 32
+            block_hash = "0000" + fake_hash("block", self.seed, height, prev_hash, self.random.random())[4:]
+            txs = [self.__make_tx(height, 0, block_hash, coinbase=True)]
+            for idx in range(1, num_txs + 1):
+                if not self.utxos:
+                    break
+                txs.append(self.__make_tx(height, idx, block_hash, coinbase=False))
+            
+            for tx in txs:
+                self.txs[tx["txid"]] = tx
+                # the new outputs are spendable by the next transactions
+                for out in tx["vout"]:
+                    self.utxos.append((tx["txid"], out["n"], round(out["value"] * 10 ** 8)))
+            
+            block_time = GENESIS_TIME + height * BLOCK_INTERVAL + self.random.randint(-300, 300)
+            block = {
+                "hash": block_hash,
+                "confirmations": 1,
+                "height": height,
+                "version": 0x20000000,
+                "time": block_time,
+                "mediantime": self.__median_time(block_time),
+                "nTx": len(txs),
+                "size": 80 + sum(tx["size"] for tx in txs),
+                "strippedsize": 80 + sum(tx["weight"] // 4 for tx in txs),
+                "weight": 320 + sum(tx["weight"] for tx in txs),
+                "tx": [tx["txid"] for tx in txs],
+            }
+            if self.blocks:
+                block["previousblockhash"] = prev_hash
+                self.blocks[-1]["nextblockhash"] = block_hash
+            self.blocks.append(block)
+            self.blocks_by_hash[block_hash] = block
+            for b in self.blocks:
+                b["confirmations"] = height - b["height"] + 1
+            self.lock.notify_all()
+            return block
+    
+    def __median_time(self, block_time: int) -> int:
+        times = sorted([b["time"] for b in self.blocks[-10:]] + [block_time])
+        return times[len(times) // 2]
+    
+    def reorg(self, depth: int, num_new_blocks: int = None) -> None:
+        """
+        disconnect the last `depth` blocks and mine `num_new_blocks` new ones instead
+        (by default, one more than disconnected)
+        """
+        with self.lock:
+            for _ in range(depth):
+                block = self.blocks.pop()
+                block["confirmations"] = -1
+                self.blocks_by_hash.pop(block["hash"])
+                self.blocks[-1].pop("nextblockhash", None)
+                # transactions of disconnected blocks are gone, and so are their outputs
+                removed = set(block["tx"])
+                for txid in removed:
+                    self.txs.pop(txid)
+                self.utxos = [u for u in self.utxos if u[0] not in removed]
+        
+        if num_new_blocks is None:
+            num_new_blocks = depth + 1
+        for _ in range(num_new_blocks):
+            self.add_block()
+    
+    # ----- RPC methods -----
+    
+    def getblockcount(self) -> int:
+        return self.height()
+    
+    def getbestblockhash(self) -> str:
+        return self.blocks[-1]["hash"]
+    
+    def getblockhash(self, height: int) -> str:
+        if not 0 <= height < len(self.blocks):
+            raise FakeRPCError(-8, "Block height out of range")
+        return self.blocks[height]["hash"]
+    
+    def __get_block(self, block_hash: str) -> Block:
+        block = self.blocks_by_hash.get(block_hash)
+        if block is None:
+            raise FakeRPCError(-5, "Block not found")
+        return block
+    
+    def __tx_json(self, tx: TX, prevouts: bool) -> TX:
+        tx = {k: v for k, v in tx.items() if k != "fee_sat"}
+        if prevouts:
+            tx["vin"] = [
+                dict(src_entry, prevout={
+                    "generated": "coinbase" in self.txs[src_entry["txid"]]["vin"][0],
+                    "height": self.blocks_by_hash[self.txs[src_entry["txid"]]["blockhash"]]["height"],
+                    "value": self.txs[src_entry["txid"]]["vout"][src_entry["vout"]]["value"],
+                })
+                if "coinbase" not in src_entry else src_entry
+                for src_entry in tx["vin"]
+            ]
+        return tx
+    
+    def getblock(self, block_hash: str, verbosity: int = 1) -> Any:
+        block = self.__get_block(block_hash)
+        if verbosity == 1:
+            return block
+        if verbosity >= 2:
+            # like bitcoind < 22.0, treat verbosity 3 as 2 if prevouts are not supported
+            prevouts = verbosity >= 3 and self.supports_prevouts
+            return dict(block, tx=[self.__tx_json(self.txs[txid], prevouts) for txid in block["tx"]])
+        raise FakeRPCError(-8, "Verbosity not supported")
+    
+    def getblockheader(self, block_hash: str, verbose: bool = True) -> Any:
+        block = self.__get_block(block_hash)
+        return {k: v for k, v in block.items() if k not in ("tx", "size", "strippedsize", "weight")}
+    
+    def getrawtransaction(self, txid: str, verbose: Any = False, block_hash: str = None) -> Any:
+        tx = self.txs.get(txid)
+        if tx is None:
+            raise FakeRPCError(-5, "No such mempool or blockchain transaction")
+        tx = self.__tx_json(tx, prevouts=False)
+        tx["confirmations"] = self.height() - self.blocks_by_hash[tx["blockhash"]]["height"] + 1
+        return tx
+    
+    def getrawmempool(self) -> List[TXID]:
+        return []
+    
+    def waitfornewblock(self, timeout: int = 0) -> Dict[str, Any]:
+        """
+        wait until the tip changes, or until timeout milliseconds passed (0 means
+        no timeout), and return the tip
+        """
+        with self.lock:
+            tip = self.blocks[-1]["hash"]
+            self.lock.wait_for(lambda: self.blocks[-1]["hash"] != tip, timeout=timeout / 1000 if timeout else None)
+            return {"hash": self.blocks[-1]["hash"], "height": self.height()}
+    
+    def waitforblockheight(self, height: int, timeout: int = 0) -> Dict[str, Any]:
+        """
+        wait until the tip is at least at the given height, or until timeout
+        milliseconds passed (0 means no timeout), and return the tip
+        """
+        with self.lock:
+            self.lock.wait_for(lambda: self.height() >= height, timeout=timeout / 1000 if timeout else None)
+            return {"hash": self.blocks[-1]["hash"], "height": self.height()}
+    
+    def echo(self, *args) -> List[Any]:
+        return list(args)
+
+    def estimatesmartfee(self, conf_target: int, estimate_mode: str = "CONSERVATIVE") -> Dict[str, Any]:
+        """
+        a feerate (BTC/kB) that decreases with the target, and no estimation for
+        targets above 50, as bitcoind answers when it doesn't have enough data
+        """
+        if conf_target > 50:
+            return {"errors": ["Insufficient data or no feerate found"], "blocks": conf_target}
+        feerate = 0.001 / conf_target * (2 if estimate_mode == "CONSERVATIVE" else 1)
+        return {"feerate": feerate, "blocks": conf_target}
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog (5) makes many concurrent clients wait for SYN retransmits
+    request_queue_size = 128
+
+
+class FakeBitcoind:
+    """
+    serve a FakeChain over HTTP JSON-RPC, on a local port, in a background thread.
+    like bitcoind, connections are kept alive between requests
+    """
+    
+    def __init__(
+        self,
+        chain: FakeChain,
+        user: str = "user",
+        password: str = "password",
+        latency: float = 0,
+        work_queue_depth: int = None,
+    ) -> None:
+        """
+        latency: seconds to wait before handling every request
+        work_queue_depth: if given, requests that arrive while that many requests are
+                          being handled are rejected with HTTP 503, like bitcoind does
+                          when its work queue (rpcworkqueue) is full
+        """
+        self.chain = chain
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.work_queue_depth = work_queue_depth
+        self.connections_count = 0
+        self.requests_count = 0
+        self.calls_count = 0
+        self.rejected_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.methods: Dict[str, Callable] = {
+            name: getattr(chain, name)
+            for name in dir(chain)
+            if not name.startswith("_") and name.islower() and callable(getattr(chain, name))
+        }
+        self._stats_lock = threading.Lock()
+        self.__server: Optional[ThreadingHTTPServer] = None
+        self.__thread: Optional[threading.Thread] = None
+    
+    @property
+    def port(self) -> int:
+        return self.__server.server_address[1]
+    
+    def start(self) -> "FakeBitcoind":
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            
+            def setup(self) -> None:
+                super().setup()
+                # responses are written in a few chunks. without this, Nagle's algorithm
+                # delays each response by the client's delayed ACK
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with fake._stats_lock:
+                    fake.connections_count += 1
+            
+            def log_message(self, format, *args) -> None:
+                pass  # keep the test output clean
+            
+            def do_POST(self) -> None:
+                expected = base64.b64encode(f"{fake.user}:{fake.password}".encode()).decode()
+                if self.headers.get("Authorization") != f"Basic {expected}":
+                    self.__respond(401, b"")
+                    return
+                
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                request = json.loads(body)
+                with fake._stats_lock:
+                    if fake.work_queue_depth is not None and fake.in_flight >= fake.work_queue_depth:
+                        fake.rejected_count += 1
+                        rejected = True
+                    else:
+                        fake.requests_count += 1
+                        fake.calls_count += len(request) if isinstance(request, list) else 1
+                        fake.in_flight += 1
+                        fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                        rejected = False
+                if rejected:
+                    self.__respond(503, b"Work queue depth exceeded", content_type="text/plain")
+                    return
+                
+                try:
+                    if fake.latency:
+                        time.sleep(fake.latency)
+                    
+                    if isinstance(request, list):
+                        response = [fake.handle(r)[1] for r in request]
+                        status = 200
+                    else:
+                        status, response = fake.handle(request)
+                finally:
+                    with fake._stats_lock:
+                        fake.in_flight -= 1
+                self.__respond(status, json.dumps(response).encode("utf-8"))
+            
+            def __respond(self, status: int, data: bytes, content_type: str = "application/json") -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        
+        self.__server = Server(("127.0.0.1", 0), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+    
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+    
+    def handle(self, request: Dict[str, Any]) -> tuple:
+        """
+        handle a single JSON-RPC request object. return the http status and the response object
+        """
+        method = self.methods.get(request.get("method"))
+        try:
+            if method is None:
+                raise FakeRPCError(-32601, "Method not found", http_status=404)
+            result = method(*request.get("params", []))
+        except FakeRPCError as e:
+            return e.http_status, {
+                "result": None,
+                "error": {"code": e.code, "message": e.message},
+                "id": request.get("id"),
+            }
+        return 200, {"result": result, "error": None, "id": request.get("id")}
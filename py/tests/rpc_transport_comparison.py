@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import bitcoin_cli
+from bitcoin_cli import rpc_call, set_bitcoin_rpc
+from bitcoin_rpc import BitcoinRPC
+from fake_bitcoin_cli import fake_bitcoin_cli_command
+from fake_bitcoind import FakeBitcoind, FakeChain
+
+"""
+compare the throughput of the two ways to talk to bitcoind: spawning a bitcoin-cli
+process per call, and the pooled JSON-RPC client.
+both run against a local FakeBitcoind, so the numbers reflect the client-side cost
+"""
+
+NUM_WORKERS = 8
+
+
+def time_calls(txids) -> float:
+    t0 = time()
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        # call rpc_call directly, so the lru_cache of get_transaction doesn't interfere
+        list(executor.map(lambda txid: rpc_call("getrawtransaction", txid, 1), txids))
+    t1 = time()
+    return round(t1 - t0, 3)
+
+
+def test():
+    chain = FakeChain(num_blocks=200, txs_per_block=10)
+    server = FakeBitcoind(chain).start()
+    bitcoin_cli.BITCOIN_CLI = fake_bitcoin_cli_command(server)
+    rpc = BitcoinRPC(port=server.port, user=server.user, password=server.password)
+    
+    txids = list(chain.txs.keys())
+    for num_calls in [50, 200]:
+        print(f"Testing for {num_calls} calls:")
+        set_bitcoin_rpc(None)
+        cli_total_time = time_calls(txids[:num_calls])
+        set_bitcoin_rpc(rpc)
+        rpc_total_time = time_calls(txids[:num_calls])
+        print(f"bitcoin-cli: {cli_total_time} sec ({round(num_calls / cli_total_time)} calls/sec)")
+        print(f"json-rpc:    {rpc_total_time} sec ({round(num_calls / rpc_total_time)} calls/sec)")
+        print(f"json-rpc is {round(cli_total_time / rpc_total_time, 2)} times faster")
+    
+    rpc.close()
+    server.stop()
+
+
+if __name__ == "__main__":
+    test()
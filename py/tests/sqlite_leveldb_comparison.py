@@ -1,10 +1,13 @@
 import random
 import string
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 from typing import Callable, List
 
 from utils import leveldb_cache, sqlite_cache
 
+THREADS = 8
+
 
 @leveldb_cache(value_to_str=str, str_to_value=str)
 def test_method_with_leveldb_cache(x: str) -> str:
@@ -16,18 +19,45 @@ def test_method_with_sqlite_cache(x: str) -> str:
     return x
 
 
-def time_method(method: Callable, inputs: List[str]) -> float:
+def time_method(method: Callable, inputs: List[str], executor: ThreadPoolExecutor = None) -> float:
+    """
+    return the time it takes to call method on all inputs, once they are cached.
+    the calls are made concurrently if an executor is given
+    """
+    
+    def call_all():
+        if executor is None:
+            for input in inputs:
+                method(input)
+        else:
+            list(executor.map(method, inputs))
+    
     # make calls that will populate the caches
-    for input in inputs:
-        method(input)
+    call_all()
+    method.flush()
     
     t0 = time()
-    for input in inputs:
-        method(input)
+    call_all()
     t1 = time()
     return round(t1 - t0, 3)
 
 
+def compare(inputs: List[str], executor: ThreadPoolExecutor = None) -> None:
+    leveldb_total_time = time_method(test_method_with_leveldb_cache, inputs, executor=executor)
+    sqlite_total_time = time_method(test_method_with_sqlite_cache, inputs, executor=executor)
+    print(f"leveldb cache: {leveldb_total_time} sec")
+    print(f"sqlite cache:  {sqlite_total_time} sec")
+    
+    if leveldb_total_time < sqlite_total_time:
+        winner = "leveldb"
+        ratio = sqlite_total_time / leveldb_total_time
+    else:
+        winner = "sqlite"
+        ratio = leveldb_total_time / sqlite_total_time
+    
+    print(f"{winner} is {round(ratio, 2)} times faster")
+
+
 def test():
     for num_inputs in [1000, 5000, 10000]:
         print(f"Testing for {num_inputs} inputs:")
@@ -37,19 +67,12 @@ def test():
             for _ in range(num_inputs)
         ]
         
-        leveldb_total_time = time_method(test_method_with_leveldb_cache, inputs)
-        sqlite_total_time = time_method(test_method_with_sqlite_cache, inputs)
-        print(f"leveldb cache: {leveldb_total_time} sec")
-        print(f"sqlite cache:  {sqlite_total_time} sec")
-        
-        if leveldb_total_time < sqlite_total_time:
-            winner = "leveldb"
-            ratio = sqlite_total_time / leveldb_total_time
-        else:
-            winner = "sqlite"
-            ratio = leveldb_total_time / sqlite_total_time
+        compare(inputs)
         
-        print(f"{winner} is {round(ratio, 2)} times faster")
+        # both caches may be used from many threads (sqlite_cache has a connection per thread)
+        print(f"with {THREADS} threads:")
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            compare(inputs, executor=executor)
 
 
 if __name__ == "__main__":
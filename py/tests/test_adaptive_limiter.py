@@ -0,0 +1,150 @@
+import random
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import bitcoin_cli
+from adaptive_limiter import AdaptiveConcurrencyLimiter, is_overload_error
+from bitcoin_rpc import BitcoinRPC, BitcoinRPCError, BitcoinRPCTransportError
+from fake_bitcoin_cli import fake_bitcoin_cli_command
+from fake_bitcoind import FakeBitcoind, FakeChain
+
+
+class AdaptiveConcurrencyLimiterTest(unittest.TestCase):
+    
+    def test_additive_increase(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=10)
+        for _ in range(200):
+            limiter.acquire()
+            limiter.release(latency=0.01)
+        self.assertEqual(limiter.limit, 10)
+        self.assertEqual(limiter.completed, 200)
+    
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=16)
+        limiter.acquire()
+        limiter.release(overloaded=True)
+        self.assertEqual(limiter.limit, 4)
+        
+        # a latency much higher than the baseline is a sign of overload too
+        for latency in [0.01, 0.01, 0.2]:
+            limiter.acquire()
+            limiter.release(kind="getblock", latency=latency)
+        self.assertLess(limiter.limit, 4)
+        
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(overloaded=True)
+        self.assertEqual(limiter.limit, limiter.min_limit)
+    
+    def test_latency_is_per_kind_and_per_call(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=4)
+        limiter.acquire()
+        limiter.release(kind="getblockhash", latency=0.001)
+        limiter.acquire()
+        limiter.release(kind="getblock", latency=0.1)
+        limiter.acquire()
+        limiter.release(kind="getblockhash", latency=0.1, cost=100)
+        self.assertGreater(limiter.limit, 4)
+    
+    def test_in_flight_is_limited(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=3, max_limit=3)
+        lock = threading.Lock()
+        in_flight = [0]
+        max_in_flight = [0]
+        
+        def request(_):
+            with lock:
+                in_flight[0] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            time.sleep(0.002)
+            with lock:
+                in_flight[0] -= 1
+        
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda i: limiter.run(request, i), range(100)))
+        self.assertEqual(max_in_flight[0], 3)
+    
+    def test_overload_errors(self):
+        self.assertTrue(is_overload_error(BitcoinRPCTransportError(503, "Service Unavailable", "")))
+        self.assertFalse(is_overload_error(BitcoinRPCTransportError(401, "Unauthorized", "")))
+        self.assertFalse(is_overload_error(BitcoinRPCError(-5, "No such mempool or blockchain transaction")))
+        
+        attempts = [0]
+        
+        def flaky():
+            attempts[0] += 1
+            if attempts[0] < 3:
+                raise BitcoinRPCTransportError(503, "Service Unavailable", "Work queue depth exceeded")
+            return "ok"
+        
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8, overload_sleep=0)
+        self.assertEqual(limiter.run(flaky), "ok")
+        self.assertEqual(limiter.overloads, 2)
+        self.assertLess(limiter.limit, 8)
+        
+        # other errors are not retried
+        def missing_tx():
+            attempts[0] += 1
+            raise BitcoinRPCError(-5, "No such mempool or blockchain transaction")
+        
+        attempts[0] = 0
+        with self.assertRaises(BitcoinRPCError):
+            limiter.run(missing_tx)
+        self.assertEqual(attempts[0], 1)
+    
+    def test_reports(self):
+        limiter = AdaptiveConcurrencyLimiter(report_interval=0)
+        for _ in range(3):
+            limiter.run(lambda: None)
+        self.assertEqual(len(limiter.history), 3)
+        self.assertEqual(set(limiter.history[-1].keys()), {"time", "limit", "throughput", "overloads"})
+    
+    def test_fake_bitcoind_work_queue(self):
+        chain = FakeChain(num_blocks=30, txs_per_block=5, seed=random.getrandbits(64))
+        server = FakeBitcoind(chain, latency=0.005, work_queue_depth=4).start()
+        bitcoin_cli.set_bitcoin_rpc(BitcoinRPC(port=server.port, user=server.user, password=server.password))
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=16, overload_sleep=0.01)
+        bitcoin_cli.set_rpc_limiter(limiter)
+        try:
+            txids = list(chain.txs.keys())
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                txs = bitcoin_cli.rpc_batch(
+                    "getrawtransaction", [(txid, 1) for txid in txids], batch_size=2, executor=executor,
+                )
+            # some requests were rejected, but all were eventually made
+            self.assertEqual([tx["txid"] for tx in txs], txids)
+            self.assertGreater(server.rejected_count, 0)
+            self.assertLessEqual(server.max_in_flight, 4)
+            self.assertLess(limiter.limit, 16)
+        finally:
+            bitcoin_cli.set_rpc_limiter(None)
+            bitcoin_cli.set_bitcoin_rpc(None)
+            server.stop()
+
+
+    def test_fake_bitcoin_cli_work_queue(self):
+        chain = FakeChain(num_blocks=12, txs_per_block=1, seed=random.getrandbits(64))
+        # slow enough that the bitcoin-cli processes overlap
+        server = FakeBitcoind(chain, latency=0.3, work_queue_depth=2).start()
+        bitcoin_cli_before = bitcoin_cli.BITCOIN_CLI
+        bitcoin_cli.BITCOIN_CLI = fake_bitcoin_cli_command(server)
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8, overload_sleep=0.05)
+        bitcoin_cli.set_rpc_limiter(limiter)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                hashes = list(executor.map(lambda h: bitcoin_cli.rpc_call("getblockhash", h), range(12)))
+            # the rejected calls were recognized as overload errors, and retried
+            self.assertEqual(hashes, [block["hash"] for block in chain.blocks[:12]])
+            self.assertGreater(server.rejected_count, 0)
+            self.assertGreater(limiter.overloads, 0)
+            self.assertLess(limiter.limit, 8)
+        finally:
+            bitcoin_cli.set_rpc_limiter(None)
+            bitcoin_cli.BITCOIN_CLI = bitcoin_cli_before
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import random
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import bitcoin_cli
+from bitcoin_rpc import BitcoinRPC, BitcoinRPCError, BitcoinRPCTransportError
+from fake_bitcoin_cli import fake_bitcoin_cli_command
+from fake_bitcoind import FakeBitcoind, FakeChain
+
+
+class BitcoinRPCTest(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        # get_tx_feerate/get_tx_weight results are cached on disk, so every run uses new txids
+        cls.chain = FakeChain(num_blocks=20, txs_per_block=5, seed=random.getrandbits(64))
+        cls.server = FakeBitcoind(cls.chain).start()
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+    
+    def get_rpc(self, **kwargs) -> BitcoinRPC:
+        return BitcoinRPC(port=self.server.port, user=self.server.user, password=self.server.password, **kwargs)
+    
+    def test_call(self):
+        rpc = self.get_rpc()
+        self.assertEqual(rpc.call("getblockcount"), self.chain.height())
+        self.assertEqual(rpc.call("getblockhash", 3), self.chain.blocks[3]["hash"])
+        self.assertEqual(rpc.call("echo", "a", 1), ["a", 1])
+    
+    def test_batch(self):
+        rpc = self.get_rpc()
+        requests_before = self.server.requests_count
+        heights = [7, 2, 11, 0]
+        results = rpc.batch([("getblockhash", (h,)) for h in heights])
+        self.assertEqual(results, [self.chain.blocks[h]["hash"] for h in heights])
+        self.assertEqual(self.server.requests_count - requests_before, 1)
+        self.assertEqual(rpc.batch([]), [])
+        
+        with self.assertRaises(BitcoinRPCError):
+            rpc.batch([("getblockhash", (1,)), ("getblockhash", (10 ** 6,))])
+    
+    def test_block_txs_stats(self):
+        bitcoin_cli.set_bitcoin_rpc(self.get_rpc())
+        try:
+            for supports_prevouts, expected_requests in [(True, 2), (False, 3)]:
+                self.chain.supports_prevouts = supports_prevouts
+                requests_before = self.server.requests_count
+                stats = bitcoin_cli.get_block_txs_stats(12)
+                # getblockhash, getblock, and a batch of parents if there are no prevouts
+                self.assertEqual(self.server.requests_count - requests_before, expected_requests)
+                
+                self.assertEqual(list(stats.keys()), self.chain.blocks[12]["tx"])
+                for txid, tx_stats in stats.items():
+                    tx = self.chain.txs[txid]
+                    self.assertEqual(tx_stats.fee, tx.get("fee_sat", 0))
+                    self.assertEqual(tx_stats.weight, tx["weight"])
+                    self.assertEqual(tx_stats.feerate, tx.get("fee_sat", 0) / tx["size"])
+            
+            self.assertEqual(
+                bitcoin_cli.get_txs_in_block(12, include_coinbase=False),
+                self.chain.blocks[12]["tx"][1:],
+            )
+        finally:
+            self.chain.supports_prevouts = True
+            bitcoin_cli.set_bitcoin_rpc(None)
+    
+    def test_rpc_error(self):
+        rpc = self.get_rpc()
+        with self.assertRaises(BitcoinRPCError) as cm:
+            rpc.call("getblockhash", 10 ** 6)
+        self.assertEqual(cm.exception.code, -8)
+        with self.assertRaises(BitcoinRPCError) as cm:
+            rpc.call("nosuchmethod")
+        self.assertEqual(cm.exception.code, -32601)
+        # the connection is still usable after an error
+        self.assertEqual(rpc.call("getblockcount"), self.chain.height())
+    
+    def test_bitcoin_cli_error(self):
+        bitcoin_cli_before = bitcoin_cli.BITCOIN_CLI
+        bitcoin_cli.BITCOIN_CLI = fake_bitcoin_cli_command(self.server)
+        try:
+            self.assertEqual(bitcoin_cli.rpc_call("getblockcount"), self.chain.height())
+            with self.assertRaises(BitcoinRPCError) as cm:
+                bitcoin_cli.rpc_call("getblockhash", 10 ** 6)
+            # the message bitcoin-cli printed to stderr
+            self.assertEqual(cm.exception.code, 8)
+            self.assertIn("error code: -8", cm.exception.message)
+            self.assertIn("Block height out of range", cm.exception.message)
+        finally:
+            bitcoin_cli.BITCOIN_CLI = bitcoin_cli_before
+    
+    def test_wrong_credentials(self):
+        rpc = BitcoinRPC(port=self.server.port, user="user", password="wrong")
+        with self.assertRaises(BitcoinRPCTransportError) as cm:
+            rpc.call("getblockcount")
+        self.assertEqual(cm.exception.status, 401)
+    
+    def test_connections_are_reused(self):
+        rpc = self.get_rpc(pool_size=4)
+        connections_before = self.server.connections_count
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            heights = list(executor.map(lambda _: rpc.call("getblockcount"), range(200)))
+        self.assertEqual(set(heights), {self.chain.height()})
+        self.assertLessEqual(self.server.connections_count - connections_before, 4)
+    
+    def test_call_after_close(self):
+        rpc = self.get_rpc(pool_size=1)
+        rpc.call("getblockcount")
+        rpc.close()
+        self.assertEqual(rpc.call("getblockcount"), self.chain.height())
+    
+    def test_from_conf(self):
+        with tempfile.TemporaryDirectory() as datadir:
+            conf_path = os.path.join(datadir, "bitcoin.conf")
+            with open(conf_path, "w") as f:
+                f.write(f"regtest=1\n[regtest]\nrpcport={self.server.port}\n")
+            os.mkdir(os.path.join(datadir, "regtest"))
+            with open(os.path.join(datadir, "regtest", ".cookie"), "w") as f:
+                f.write(f"{self.server.user}:{self.server.password}")
+            
+            rpc = BitcoinRPC.from_conf(conf_path)
+            self.assertEqual(rpc.call("getblockcount"), self.chain.height())
+    
+    def test_bitcoin_cli_functions_over_rpc(self):
+        bitcoin_cli.set_bitcoin_rpc(self.get_rpc())
+        try:
+            self.assertEqual(bitcoin_cli.blockchain_height(), self.chain.height())
+            block = bitcoin_cli.get_block_by_height(5)
+            self.assertEqual(block["hash"], self.chain.blocks[5]["hash"])
+            txid = block["tx"][1]
+            self.assertEqual(bitcoin_cli.get_transaction(txid)["txid"], txid)
+            self.assertTrue(bitcoin_cli.coinbase_tx(block["tx"][0]))
+        finally:
+            bitcoin_cli.set_bitcoin_rpc(None)
+
+    def test_batched_bitcoin_cli_functions(self):
+        bitcoin_cli.set_bitcoin_rpc(self.get_rpc())
+        try:
+            requests_before = self.server.requests_count
+            block_hashes = bitcoin_cli.get_block_hashes(range(10, 15))
+            self.assertEqual(list(block_hashes.values()), [self.chain.blocks[h]["hash"] for h in range(10, 15)])
+            txids = [txid for h in range(10, 15) for txid in self.chain.blocks[h]["tx"]]
+            txs = bitcoin_cli.get_transactions(txids)
+            self.assertEqual(list(txs.keys()), txids)
+            self.assertEqual(self.server.requests_count - requests_before, 2)
+            
+            # get_tx_feerate and the stats of the block agree, so the cache of get_tx_feerate
+            # holds the same feerates whichever of them filled it
+            stats = bitcoin_cli.get_block_txs_stats(10)
+            for txid, tx_stats in stats.items():
+                self.assertEqual(bitcoin_cli.get_tx_feerate(txid), tx_stats.feerate)
+        finally:
+            bitcoin_cli.set_bitcoin_rpc(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
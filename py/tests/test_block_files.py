@@ -0,0 +1,299 @@
+import os
+import tempfile
+import unittest
+from typing import List, Tuple
+
+import plyvel
+
+from block_files import (
+    BLOCK_HAVE_DATA, BLOCK_VALID_TRANSACTIONS, BlockFiles, BlockLocation, NETWORK_MAGIC, block_work,
+    compute_parsed_block_stats, double_sha256, hash_to_hex, parse_block, read_block_index,
+    scan_block_files,
+)
+from block_ingester import BlockFilesSource, BlockIngester, Sink
+from outpoint_store import OutpointValueStore
+
+MAINNET_GENESIS = bytes.fromhex(
+    "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b2"
+    "7ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c01010000000100"
+    "00000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104"
+    "455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b20"
+    "6f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104"
+    "678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504"
+    "e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000"
+)
+
+
+def compact_size(n: int) -> bytes:
+    if n < 0xfd:
+        return bytes([n])
+    return b"\xfd" + n.to_bytes(2, "little")
+
+
+def varint(n: int) -> bytes:
+    out = [n & 0x7f]
+    while n > 0x7f:
+        n = (n >> 7) - 1
+        out.append((n & 0x7f) | 0x80)
+    return bytes(reversed(out))
+
+
+def serialize_tx(inputs: List[Tuple[str, int]], outputs: List[int], witness: bool) -> Tuple[bytes, bytes]:
+    """
+    return the full serialization of a tx and its serialization without witness data.
+    an empty inputs list makes a coinbase
+    """
+    if not inputs:
+        inputs = [("00" * 32, 0xffffffff)]
+    body = compact_size(len(inputs))
+    for txid, n in inputs:
+        body += bytes.fromhex(txid)[::-1] + n.to_bytes(4, "little") + compact_size(3) + b"\x51\x52\x53"
+        body += b"\xff\xff\xff\xff"
+    body += compact_size(len(outputs))
+    for value in outputs:
+        body += value.to_bytes(8, "little") + compact_size(22) + b"\x00\x14" + bytes(20)
+    version = (2).to_bytes(4, "little")
+    locktime = bytes(4)
+    stripped = version + body + locktime
+    if not witness:
+        return stripped, stripped
+    witness_data = b"".join(compact_size(2) + compact_size(71) + bytes(71) + compact_size(33) + bytes(33) for _ in inputs)
+    return version + b"\x00\x01" + body + witness_data + locktime, stripped
+
+
+def txid_of(stripped: bytes) -> str:
+    return hash_to_hex(double_sha256(stripped))
+
+
+def serialize_block(prev_hash: str, time: int, txs: List[bytes], bits: int = 0x207fffff) -> bytes:
+    header = (
+        (0x20000000).to_bytes(4, "little")
+        + bytes.fromhex(prev_hash)[::-1]
+        + bytes(32)  # merkle root. not validated
+        + time.to_bytes(4, "little")
+        + bits.to_bytes(4, "little")
+        + bytes(4)
+    )
+    return header + compact_size(len(txs)) + b"".join(txs)
+
+
+class SyntheticChain:
+    """
+    a few regtest blocks, written to blk*.dat files with a block index, like bitcoind does
+    """
+    
+    def __init__(self, blocks_dir: str, xor_key: bytes = None) -> None:
+        self.blocks_dir = blocks_dir
+        self.xor_key = xor_key
+        self.blocks: List[bytes] = []  # best chain, by height
+        self.fees: dict = {}  # txid -> fee
+        
+        coinbase0, _ = serialize_tx([], [50_0000_0000], witness=False)
+        self.add_block([coinbase0])
+        cb0 = txid_of(coinbase0)
+        
+        # coinbases differ in their outputs, so they don't have the same txid
+        coinbase1, _ = serialize_tx([], [50_0000_0001], witness=False)
+        spend, spend_stripped = serialize_tx([(cb0, 0)], [20_0000_0000, 29_9999_0000], witness=True)
+        self.fees[txid_of(spend_stripped)] = 10_000
+        self.add_block([coinbase1, spend])
+        spend_txid = txid_of(spend_stripped)
+        
+        coinbase2, _ = serialize_tx([], [50_0000_0002], witness=True)
+        # spends an output of the previous block and an output of the same block
+        child, child_stripped = serialize_tx([(spend_txid, 0)], [19_9999_0000], witness=False)
+        grandchild, grandchild_stripped = serialize_tx(
+            [(txid_of(child_stripped), 0), (spend_txid, 1)], [49_9990_0000], witness=True,
+        )
+        self.fees[txid_of(child_stripped)] = 10_000
+        self.fees[txid_of(grandchild_stripped)] = 80_000
+        self.add_block([coinbase2, child, grandchild])
+        
+        # a stale block at height 1, in another file
+        stale_coinbase, _ = serialize_tx([], [1], witness=False)
+        self.stale_block = serialize_block(self.hash(0), 1600000700, [stale_coinbase])
+        
+        self.locations = self.write_files()
+    
+    def hash(self, height: int) -> str:
+        return hash_to_hex(double_sha256(self.blocks[height][:80]))
+    
+    def add_block(self, txs: List[bytes]) -> None:
+        prev_hash = self.hash(len(self.blocks) - 1) if self.blocks else "00" * 32
+        self.blocks.append(serialize_block(prev_hash, 1600000000 + 600 * len(self.blocks), txs))
+    
+    def write_files(self) -> List[BlockLocation]:
+        magic = NETWORK_MAGIC["regtest"]
+        files = [[self.blocks[0], self.blocks[1]], [self.stale_block, self.blocks[2]]]
+        locations = []
+        for file_num, blocks in enumerate(files):
+            data = b""
+            for block in blocks:
+                locations.append(BlockLocation(file_num=file_num, data_pos=len(data) + 8))
+                data += magic + len(block).to_bytes(4, "little") + block
+            data += bytes(1000)  # pre-allocated space
+            if self.xor_key:
+                data = bytes(b ^ self.xor_key[i % len(self.xor_key)] for i, b in enumerate(data))
+            with open(os.path.join(self.blocks_dir, f"blk{file_num:05d}.dat"), "wb") as f:
+                f.write(data)
+        if self.xor_key:
+            with open(os.path.join(self.blocks_dir, "xor.dat"), "wb") as f:
+                f.write(self.xor_key)
+        
+        # the stale block is the third one written
+        self.stale_location = locations.pop(2)
+        self.write_index(locations)
+        return locations
+    
+    def write_index(self, locations: List[BlockLocation], extra: List[Tuple[bytes, int, BlockLocation]] = ()) -> None:
+        status = BLOCK_HAVE_DATA | BLOCK_VALID_TRANSACTIONS
+        entries = [(block, height, loc) for height, (block, loc) in enumerate(zip(self.blocks, locations))]
+        entries.append((self.stale_block, 1, self.stale_location))
+        entries.extend(extra)
+        db = plyvel.DB(os.path.join(self.blocks_dir, "index"), create_if_missing=True)
+        for block, height, loc in entries:
+            value = (
+                varint(259900) + varint(height) + varint(status) + varint(1)
+                + varint(loc.file_num) + varint(loc.data_pos) + block[:80]
+            )
+            db.put(b"b" + double_sha256(block[:80]), value)
+        db.close()
+
+
+class BlockFilesTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.blocks_dir = self.tmpdir.name
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_parse_genesis_block(self):
+        block = parse_block(MAINNET_GENESIS)
+        self.assertEqual(block.hash, "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f")
+        self.assertEqual(block.prev_hash, "00" * 32)
+        self.assertEqual(block.size, 285)
+        self.assertEqual(block.weight, 1140)
+        self.assertEqual(len(block.txs), 1)
+        tx = block.txs[0]
+        self.assertEqual(tx.txid, "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b")
+        self.assertTrue(tx.coinbase)
+        self.assertEqual(tx.outputs, [50_0000_0000])
+    
+    def test_segwit_tx_size_and_weight(self):
+        chain = SyntheticChain(self.blocks_dir)
+        block = parse_block(chain.blocks[2])
+        self.assertEqual(block.hash, chain.hash(2))
+        self.assertEqual(block.size, len(chain.blocks[2]))
+        for tx in block.txs:
+            self.assertIn(tx.txid, chain.fees.keys() | {block.txs[0].txid})
+        
+        tx, stripped = serialize_tx([("ab" * 32, 3)], [1000], witness=True)
+        parsed = parse_block(serialize_block("00" * 32, 0, [tx])).txs[0]
+        # the txid doesn't commit to the witness
+        self.assertEqual(parsed.txid, txid_of(stripped))
+        self.assertEqual(parsed.inputs, [("ab" * 32, 3)])
+        self.assertEqual(parsed.size, len(tx))
+        self.assertEqual(parsed.weight, 3 * len(stripped) + len(tx))
+    
+    def test_scan_and_index(self):
+        chain = SyntheticChain(self.blocks_dir)
+        block_files = BlockFiles(self.blocks_dir, network="regtest")
+        try:
+            expected = dict(enumerate(chain.locations))
+            self.assertEqual(scan_block_files(block_files), expected)
+            self.assertEqual(read_block_index(os.path.join(self.blocks_dir, "index")), expected)
+            for height, location in expected.items():
+                self.assertEqual(block_files.read_block(location).hash, chain.hash(height))
+        finally:
+            block_files.close()
+    
+    def test_best_chain_has_the_most_work(self):
+        chain = SyntheticChain(self.blocks_dir)
+        index_path = os.path.join(self.blocks_dir, "index")
+        later_location = BlockLocation(file_num=1, data_pos=10_000)
+        
+        # a competing block at the tip height, with the same work, that was received
+        # after the tip. its hash is higher, so it isn't picked by its hash either
+        time = 1600001000
+        while True:
+            competing = serialize_block(chain.hash(1), time, [serialize_tx([], [2], witness=False)[0]])
+            if hash_to_hex(double_sha256(competing[:80])) > chain.hash(2):
+                break
+            time += 1
+        chain.write_index(chain.locations, extra=[(competing, 2, later_location)])
+        self.assertEqual(read_block_index(index_path), dict(enumerate(chain.locations)))
+        
+        # a block with a harder target has more work than the tip, even at a lower height
+        harder = serialize_block(chain.hash(0), 1600002000, [serialize_tx([], [3], witness=False)[0]], bits=0x1f7fffff)
+        self.assertGreater(block_work(0x1f7fffff), 2 * block_work(0x207fffff))
+        chain.write_index(chain.locations, extra=[(harder, 1, later_location)])
+        self.assertEqual(read_block_index(index_path), {0: chain.locations[0], 1: later_location})
+    
+    def test_locked_index_is_copied(self):
+        SyntheticChain(self.blocks_dir)
+        index_path = os.path.join(self.blocks_dir, "index")
+        db = plyvel.DB(index_path)  # like a running bitcoind
+        try:
+            self.assertEqual(len(read_block_index(index_path)), 3)
+        finally:
+            db.close()
+    
+    def test_obfuscated_files(self):
+        chain = SyntheticChain(self.blocks_dir, xor_key=bytes.fromhex("0123456789abcdef"))
+        block_files = BlockFiles(self.blocks_dir, network="regtest")
+        try:
+            self.assertEqual(scan_block_files(block_files), dict(enumerate(chain.locations)))
+            for height, location in enumerate(chain.locations):
+                self.assertEqual(block_files.read_block(location).hash, chain.hash(height))
+                self.assertEqual(parse_block(block_files.read_block_bytes(location)).hash, chain.hash(height))
+        finally:
+            block_files.close()
+    
+    def test_fees_from_store(self):
+        chain = SyntheticChain(self.blocks_dir)
+        block_files = BlockFiles(self.blocks_dir, network="regtest")
+        store = OutpointValueStore(db_path=os.path.join(self.blocks_dir, "outpoints"))
+        try:
+            for height, location in enumerate(chain.locations):
+                block = block_files.read_block(location)
+                stats = compute_parsed_block_stats(block, height=height, store=store)
+                self.assertEqual(list(stats.keys()), [tx.txid for tx in block.txs])
+                self.assertEqual(stats[block.txs[0].txid].fee, 0)
+                for tx in block.txs[1:]:
+                    self.assertEqual(stats[tx.txid].fee, chain.fees[tx.txid])
+                    self.assertEqual(stats[tx.txid].weight, tx.weight)
+            self.assertEqual(store.last_height, 2)
+        finally:
+            store.close()
+            block_files.close()
+
+    def test_pipelined_ingestion(self):
+        chain = SyntheticChain(self.blocks_dir)
+        block_files = BlockFiles(self.blocks_dir, network="regtest")
+        store = OutpointValueStore(db_path=os.path.join(self.blocks_dir, "outpoints"))
+        written = []
+        
+        class ListSink(Sink):
+            def write_block(self, h, stats):
+                written.append((h, stats))
+        
+        # the blocks are parsed on a process pool, and the fees are computed in height order
+        source = BlockFilesSource(block_files, dict(enumerate(chain.locations)), store)
+        ingester = BlockIngester([ListSink()], source=source, depth=3, processes=2)
+        try:
+            self.assertEqual(ingester.run(0, 2), [])
+            self.assertEqual([h for h, _ in written], [0, 1, 2])
+            for h, stats in written[1:]:
+                for txid, tx_stats in list(stats.items())[1:]:
+                    self.assertEqual(tx_stats.fee, chain.fees[txid])
+            self.assertEqual(store.last_height, 2)
+        finally:
+            ingester.close()
+            store.close()
+            block_files.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+import bitcoin_cli
+from bitcoin_rpc import BitcoinRPC
+from block_follower import BlockFollower, LongPollNotifications, ZMQNotifications, zmq
+from fake_bitcoind import FakeBitcoind, FakeChain
+
+
+class BlockFollowerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.tmpdir.name, "follower_state.json")
+        self.chain = FakeChain(num_blocks=10, txs_per_block=2, seed=random.getrandbits(64))
+        self.server = FakeBitcoind(self.chain).start()
+        bitcoin_cli.set_bitcoin_rpc(BitcoinRPC(port=self.server.port, user=self.server.user, password=self.server.password))
+        # height -> hash of the block that was ingested at that height
+        self.ingested = {}
+        self.ingest_log = []
+    
+    def tearDown(self):
+        bitcoin_cli.set_bitcoin_rpc(None)
+        self.server.stop()
+        self.tmpdir.cleanup()
+    
+    def on_block(self, h):
+        self.ingested[h] = self.chain.blocks[h]["hash"]
+        self.ingest_log.append(("block", h))
+    
+    def on_rollback(self, h):
+        del self.ingested[h]
+        self.ingest_log.append(("rollback", h))
+    
+    def get_follower(self, **kwargs) -> BlockFollower:
+        return BlockFollower(
+            state_path=self.state_path,
+            first_block=3,
+            on_block=self.on_block,
+            on_rollback=self.on_rollback,
+            **kwargs,
+        )
+    
+    def assert_ingested_best_chain(self, first_block: int = 3):
+        self.assertEqual(self.ingested, {
+            h: self.chain.blocks[h]["hash"] for h in range(first_block, self.chain.height() + 1)
+        })
+    
+    def test_only_new_blocks_are_ingested(self):
+        follower = self.get_follower()
+        self.assertEqual(follower.sync(), 7)
+        self.assert_ingested_best_chain()
+        self.assertEqual(follower.sync(), 0)
+        
+        self.chain.add_block()
+        self.ingest_log.clear()
+        # the high-water mark is durable, so a new follower continues from it
+        self.assertEqual(self.get_follower().sync(), 1)
+        self.assertEqual(self.ingest_log, [("block", 10)])
+    
+    def test_reorg(self):
+        follower = self.get_follower()
+        follower.sync()
+        self.ingest_log.clear()
+        self.chain.reorg(depth=2)
+        follower.sync()
+        self.assertEqual(self.ingest_log, [
+            ("rollback", 9), ("rollback", 8), ("block", 8), ("block", 9), ("block", 10),
+        ])
+        self.assert_ingested_best_chain()
+        
+        # a reorg to a shorter chain
+        self.chain.reorg(depth=3, num_new_blocks=1)
+        follower.sync()
+        self.assert_ingested_best_chain()
+        self.assertEqual(self.get_follower().height, self.chain.height())
+    
+    def test_lagging_tip(self):
+        follower = self.get_follower()
+        follower.sync()
+        self.ingest_log.clear()
+        # e.g. bitcoind is reindexing. the blocks up to its tip are the same
+        blocks = self.chain.blocks
+        self.chain.blocks = blocks[:7]
+        self.assertEqual(follower.sync(), 0)
+        self.assertEqual(follower.height, 9)
+        self.assertEqual(self.ingest_log, [])
+        
+        self.chain.blocks = blocks
+        self.chain.add_block()
+        follower.sync()
+        self.assertEqual(self.ingest_log, [("block", 10)])
+        self.assert_ingested_best_chain()
+    
+    def test_failed_block_is_retried(self):
+        failures = {5}
+        
+        def on_block(h):
+            if h in failures:
+                failures.remove(h)
+                return False
+            self.on_block(h)
+        
+        follower = self.get_follower()
+        follower.on_block = on_block
+        self.assertEqual(follower.sync(), 2)
+        self.assertEqual(follower.height, 4)
+        follower.sync()
+        self.assert_ingested_best_chain()
+    
+    def test_follow_with_long_poll(self):
+        follower = self.get_follower(notifications=LongPollNotifications(), poll_timeout=5)
+        stop = threading.Event()
+        thread = threading.Thread(target=follower.follow, args=(stop,))
+        thread.start()
+        try:
+            self.wait_for(lambda: follower.height == 9)
+            t0 = time.time()
+            self.chain.add_block()
+            self.wait_for(lambda: follower.height == 10)
+            # the block was ingested when it arrived, not when the poll timed out
+            self.assertLess(time.time() - t0, 2)
+            self.assert_ingested_best_chain()
+        finally:
+            stop.set()
+            self.chain.add_block()  # wake up the long poll
+            thread.join()
+    
+    @unittest.skipIf(zmq is None, "pyzmq is not installed")
+    def test_follow_with_zmq(self):
+        publisher = zmq.Context.instance().socket(zmq.PUB)
+        port = publisher.bind_to_random_port("tcp://127.0.0.1")
+        notifications = ZMQNotifications(f"tcp://127.0.0.1:{port}")
+        follower = self.get_follower(notifications=notifications, poll_timeout=30)
+        stop = threading.Event()
+        thread = threading.Thread(target=follower.follow, args=(stop,))
+        thread.start()
+        try:
+            self.wait_for(lambda: follower.height == 9)
+            block = self.chain.add_block()
+            # publish until the subscription is established
+            self.wait_for(lambda: follower.height == 10, on_retry=lambda: publisher.send_multipart([
+                b"hashblock", bytes.fromhex(block["hash"]), (0).to_bytes(4, "little"),
+            ]))
+            self.assert_ingested_best_chain()
+        finally:
+            stop.set()
+            publisher.send_multipart([b"hashblock", bytes(32), (1).to_bytes(4, "little")])
+            thread.join()
+            notifications.close()
+            publisher.close()
+    
+    def wait_for(self, condition, timeout: float = 10, on_retry=None):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("condition was not met in time")
+            if on_retry is not None:
+                on_retry()
+            time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+import plyvel
+
+import bitcoin_cli
+from bitcoin_rpc import BitcoinRPC
+from block_ingester import (
+    BlockIngester, BoundedExecutor, CacheSink, RpcBlockSource, Sink, TsvSink, migrate_legacy_marks,
+)
+from fake_bitcoind import FakeBitcoind, FakeChain
+from ingest_manifest import IngestManifest
+from shared_store import Namespace, namespace_prefix
+from utils import leveldb_cache
+
+
+class BlockIngesterTest(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.chain = FakeChain(num_blocks=15, txs_per_block=5, seed=random.getrandbits(64))
+        cls.server = FakeBitcoind(cls.chain).start()
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.manifest_path = os.path.join(self.tmpdir.name, "manifest.json")
+        bitcoin_cli.set_bitcoin_rpc(BitcoinRPC(port=self.server.port, user=self.server.user, password=self.server.password))
+        self.funcs = []
+    
+    def tearDown(self):
+        bitcoin_cli.set_bitcoin_rpc(None)
+        for func in self.funcs:
+            func.cache_db.close()
+        self.tmpdir.cleanup()
+    
+    def get_cached_function(self, name, str_to_value):
+        @leveldb_cache(value_to_str=str, str_to_value=str_to_value, db_path=os.path.join(self.tmpdir.name, name))
+        def func(key):
+            raise AssertionError("not cached")
+        
+        self.funcs.append(func)
+        return func
+    
+    def read_tsv(self, path):
+        with open(path) as f:
+            return dict(line.rstrip("\n").split("\t") for line in f)
+    
+    def test_sinks(self):
+        feerates_sink = TsvSink(self.tmpdir.name, "block_{h}_feerates.tsv", attribute="feerate")
+        weights_sink = TsvSink(self.tmpdir.name, "block_{h}_tx_weights.tsv", attribute="weight")
+        feerate_func = self.get_cached_function("feerate", float)
+        weight_func = self.get_cached_function("weight", int)
+        marks_db = plyvel.DB(os.path.join(self.tmpdir.name, "marks"), create_if_missing=True)
+        marks = Namespace(marks_db, namespace_prefix("populate_block"))
+        caches_sink = CacheSink({"feerate": feerate_func, "weight": weight_func}, marks=marks)
+        
+        ingester = BlockIngester([feerates_sink, weights_sink, caches_sink], max_workers=2, max_pending=2)
+        requests_before = self.server.requests_count
+        self.assertEqual(ingester.run(3, 5), [])
+        # getblockhash and getblock per block, for all sinks
+        self.assertEqual(self.server.requests_count - requests_before, 6)
+        
+        for h in range(3, 6):
+            txids = self.chain.blocks[h]["tx"]
+            feerates = self.read_tsv(feerates_sink.get_filepath(h))
+            weights = self.read_tsv(weights_sink.get_filepath(h))
+            self.assertEqual(list(feerates.keys()), txids)
+            self.assertEqual(marks.get(str(h).encode("utf-8")), b"True")
+            for txid in txids:
+                tx = self.chain.txs[txid]
+                expected_feerate = tx.get("fee_sat", 0) / tx["size"]
+                self.assertEqual(float(feerates[txid]), expected_feerate)
+                self.assertEqual(int(weights[txid]), tx["weight"])
+                self.assertEqual(feerate_func.cache_get(txid), expected_feerate)
+                self.assertEqual(weight_func.cache_get(txid), tx["weight"])
+        
+        # a block that all sinks have is not fetched again
+        requests_before = self.server.requests_count
+        self.assertTrue(ingester.ingest_block(4))
+        self.assertEqual(self.server.requests_count, requests_before)
+        
+        # a block that was removed is fetched again
+        ingester.remove_block(4)
+        self.assertFalse(os.path.exists(feerates_sink.get_filepath(4)))
+        self.assertIsNone(marks.get(b"4"))
+        self.assertTrue(ingester.ingest_block(4))
+        # the block is marked on flush, after its txs
+        self.assertTrue(caches_sink.has_block(4))
+        self.assertIsNone(marks.get(b"4"))
+        ingester.flush()
+        self.assertTrue(os.path.exists(feerates_sink.get_filepath(4)))
+        self.assertEqual(marks.get(b"4"), b"True")
+        ingester.close()
+        marks_db.close()
+    
+    def test_legacy_marks_are_migrated(self):
+        # as populate_leveldb_caches.py marked blocks, with a leveldb_cache of populate_block
+        legacy_path = os.path.join(self.tmpdir.name, "populate_block_py_function_leveldb")
+        legacy = plyvel.DB(legacy_path, create_if_missing=True)
+        for h in [3, 4]:
+            legacy.put(str(h).encode("utf-8"), b"None")
+        legacy.close()
+        marks_db = plyvel.DB(os.path.join(self.tmpdir.name, "marks"), create_if_missing=True)
+        marks = Namespace(marks_db, namespace_prefix("populate_block"))
+        
+        migrate_legacy_marks(marks, legacy_path)
+        caches_sink = CacheSink({}, marks=marks)
+        self.assertTrue(caches_sink.has_block(3))
+        self.assertTrue(caches_sink.has_block(4))
+        self.assertFalse(caches_sink.has_block(5))
+        
+        # marks are migrated once, so a block that was removed since stays removed
+        caches_sink.remove_block(4)
+        caches_sink.flush()
+        migrate_legacy_marks(marks, legacy_path)
+        self.assertFalse(caches_sink.has_block(4))
+        marks_db.close()
+    
+    def test_resume_from_manifest(self):
+        for depth in [1, 4]:
+            with self.subTest(depth=depth):
+                self.check_resume_from_manifest(depth)
+                os.remove(self.manifest_path)
+        
+    def check_resume_from_manifest(self, depth):
+        sink = TsvSink(self.tmpdir.name, f"block_{{h}}_{depth}.tsv", attribute="weight")
+        source = FlakySource(failing={7})
+        manifest = IngestManifest(self.manifest_path)
+        ingester = BlockIngester([sink], manifest=manifest, checkpoint_every=2, source=source, depth=depth)
+        self.assertEqual(ingester.run(3, 10), [7])
+        self.assertEqual(sorted(source.fetched), list(range(3, 11)))
+        manifest = IngestManifest(self.manifest_path)
+        self.assertEqual(manifest.missing_ranges(0, 12), [(0, 2), (7, 7), (11, 12)])
+        self.assertEqual(manifest.failures[7].retries, 1)
+        self.assertIn("block not found", manifest.failures[7].reason)
+        
+        # the next run fetches the failed block only, without checking the sink for the others
+        source.fetched.clear()
+        os.remove(sink.get_filepath(9))
+        self.assertEqual(ingester.run(3, 10), [7])
+        self.assertEqual(source.fetched, [7])
+        self.assertEqual(IngestManifest(self.manifest_path).failures[7].retries, 2)
+        # a block that failed too many times is skipped
+        source.fetched.clear()
+        self.assertEqual(ingester.run(3, 10, max_retries=2), [])
+        self.assertEqual(source.fetched, [])
+        
+        source.failing.clear()
+        self.assertEqual(ingester.run(3, 11), [])
+        self.assertEqual(sorted(source.fetched), [7, 11])
+        manifest = IngestManifest(self.manifest_path)
+        self.assertEqual(manifest.missing_ranges(3, 11), [])
+        self.assertEqual(manifest.failures, {})
+        
+        # a removed block is fetched again
+        source.fetched.clear()
+        ingester.remove_block(11)
+        self.assertEqual(ingester.run(3, 11), [])
+        self.assertEqual(source.fetched, [11])
+        ingester.close()
+    
+    def test_pipelined_blocks_are_written_in_order(self):
+        sink = RecordingSink()
+        # later blocks are fetched faster, so they are ready before earlier ones
+        source = FlakySource(delays={h: (15 - h) * 0.01 for h in range(15)})
+        ingester = BlockIngester([sink], source=source, depth=5, max_workers=4)
+        self.assertEqual(ingester.run(0, 14), [])
+        self.assertEqual([h for h, _ in sink.written], list(range(15)))
+        for h, stats in sink.written:
+            self.assertEqual(list(stats.keys()), self.chain.blocks[h]["tx"])
+        # blocks were fetched concurrently
+        self.assertGreater(source.max_concurrent_fetches, 1)
+        ingester.close()
+
+
+class FlakySource(RpcBlockSource):
+    """
+    blocks from bitcoind, where fetching a block may be slow or fail
+    """
+    
+    def __init__(self, failing=(), delays=None):
+        self.failing = set(failing)
+        self.delays = delays or {}
+        self.fetched = []
+        self.concurrent_fetches = 0
+        self.max_concurrent_fetches = 0
+        self.lock = threading.Lock()
+    
+    def fetch(self, h):
+        with self.lock:
+            self.fetched.append(h)
+            self.concurrent_fetches += 1
+            self.max_concurrent_fetches = max(self.max_concurrent_fetches, self.concurrent_fetches)
+        try:
+            time.sleep(self.delays.get(h, 0))
+            if h in self.failing:
+                raise ValueError("block not found")
+            return super().fetch(h)
+        finally:
+            with self.lock:
+                self.concurrent_fetches -= 1
+
+
+class RecordingSink(Sink):
+    
+    def __init__(self):
+        self.written = []
+    
+    def write_block(self, h, stats):
+        self.written.append((h, stats))
+
+
+class BoundedExecutorTest(unittest.TestCase):
+    
+    def test_submit_blocks_while_max_pending(self):
+        release = threading.Event()
+        executor = BoundedExecutor(max_workers=1, max_pending=2)
+        futures = [executor.submit(release.wait) for _ in range(2)]
+        
+        submitted = threading.Event()
+        
+        def submit_third():
+            futures.append(executor.submit(lambda: 3))
+            submitted.set()
+        
+        threading.Thread(target=submit_third, daemon=True).start()
+        time.sleep(0.2)
+        self.assertFalse(submitted.is_set())
+        
+        release.set()
+        self.assertTrue(submitted.wait(timeout=5))
+        self.assertEqual(futures[2].result(timeout=5), 3)
+        # map works as with a ThreadPoolExecutor, while never more than max_pending are pending
+        self.assertEqual(list(executor.map(lambda x: x * 2, range(20))), [x * 2 for x in range(20)])
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+
+from cache_codecs import (
+    BINARY_FORMAT, FORMAT_KEY, TXID_FLOAT64_CODEC, TXID_VARINT_CODEC, convert_leveldb_format,
+    decode_float64, decode_varint, encode_float64, encode_varint,
+)
+from utils import leveldb_cache
+
+TXIDS = [f"{i:064x}" for i in range(1, 101)]
+
+
+class CacheCodecsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "tx_feerate_leveldb")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def get_cached_function(self):
+        @leveldb_cache(value_to_str=str, str_to_value=float, db_path=self.db_path, binary_codec=TXID_FLOAT64_CODEC)
+        def tx_feerate(txid: str) -> float:
+            tx_feerate.calls_counter += 1
+            return int(txid, 16) / 3
+        
+        tx_feerate.calls_counter = 0
+        return tx_feerate
+    
+    def test_varint_and_float64(self):
+        for n in [0, 1, 127, 128, 300, 4_000_000, 2 ** 63]:
+            self.assertEqual(decode_varint(encode_varint(n)), n)
+        self.assertEqual(len(encode_varint(127)), 1)
+        self.assertEqual(len(encode_varint(4_000_000)), 4)
+        with self.assertRaises(ValueError):
+            encode_varint(-1)
+        for x in [0.0, 1 / 3, 123456.789]:
+            self.assertEqual(decode_float64(encode_float64(x)), x)
+        self.assertEqual(TXID_VARINT_CODEC.key_to_bytes(TXIDS[0]), bytes(31) + b"\x01")
+    
+    def test_convert_to_binary_and_back(self):
+        tx_feerate = self.get_cached_function()
+        expected = tx_feerate.get_many([(txid,) for txid in TXIDS])
+        text_entries = dict(tx_feerate.cache_db.iterator())
+        tx_feerate.cache_db.close()
+        
+        converted = convert_leveldb_format(
+            self.db_path, value_to_str=str, str_to_value=float, binary_codec=TXID_FLOAT64_CODEC, to_binary=True,
+            batch_size=30,
+        )
+        self.assertEqual(converted, len(TXIDS))
+        # converting again does nothing
+        self.assertEqual(convert_leveldb_format(
+            self.db_path, value_to_str=str, str_to_value=float, binary_codec=TXID_FLOAT64_CODEC, to_binary=True,
+        ), 0)
+        
+        tx_feerate = self.get_cached_function()
+        db = tx_feerate.cache_db
+        self.assertEqual(db.get(FORMAT_KEY), BINARY_FORMAT)
+        self.assertEqual(db.get(bytes.fromhex(TXIDS[2])), encode_float64(expected[2]))
+        self.assertEqual(tx_feerate.get_many([(txid,) for txid in TXIDS]), expected)
+        self.assertEqual(tx_feerate(TXIDS[5]), expected[5])
+        self.assertEqual(tx_feerate.calls_counter, 0)
+        
+        # new entries are written in binary too
+        new_txid = f"{1000:064x}"
+        self.assertEqual(tx_feerate(new_txid), 1000 / 3)
+        self.assertEqual(db.get(bytes.fromhex(new_txid)), encode_float64(1000 / 3))
+        db.close()
+        
+        convert_leveldb_format(
+            self.db_path, value_to_str=str, str_to_value=float, binary_codec=TXID_FLOAT64_CODEC, to_binary=False,
+        )
+        tx_feerate = self.get_cached_function()
+        text_entries[new_txid.encode("utf-8")] = str(1000 / 3).encode("utf-8")
+        self.assertEqual(dict(tx_feerate.cache_db.iterator()), text_entries)
+        tx_feerate.cache_db.close()
+    
+    def test_binary_db_without_codec_is_not_used(self):
+        convert_leveldb_format(
+            self.db_path, value_to_str=str, str_to_value=float, binary_codec=TXID_FLOAT64_CODEC, to_binary=True,
+        )
+        
+        @leveldb_cache(value_to_str=str, str_to_value=float, db_path=self.db_path)
+        def tx_feerate(txid: str) -> float:
+            return 1.0
+        
+        self.assertFalse(hasattr(tx_feerate, "cache_db"))
+        self.assertEqual(tx_feerate(TXIDS[0]), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
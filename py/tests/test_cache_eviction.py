@@ -0,0 +1,166 @@
+import os
+import tempfile
+import time
+import unittest
+
+from cache_eviction import EvictionPolicy, LFU, METADATA_PREFIX
+from utils import leveldb_cache, sqlite_cache
+
+
+class EvictionPolicyTest(unittest.TestCase):
+    
+    def test_lru(self):
+        policy = EvictionPolicy(max_entries=10)
+        for i in range(10):
+            self.assertEqual(policy.on_put(f"k{i}", size=10), [])
+            time.sleep(0.001)
+        policy.on_hit("k0")
+        # the cache is trimmed to 90% of its capacity, least recently used first
+        self.assertEqual(policy.on_put("k10", size=10), ["k1", "k2"])
+        self.assertEqual(len(policy), 9)
+        self.assertEqual(policy.evicted, 2)
+    
+    def test_lfu_and_max_bytes(self):
+        policy = EvictionPolicy(max_bytes=100, eviction=LFU)
+        for i in range(5):
+            policy.on_put(f"k{i}", size=20)
+        for i in range(5):
+            for _ in range(5 - i):
+                policy.on_hit(f"k{i}")
+        self.assertEqual(policy.on_put("k5", size=30), ["k4", "k3"])
+        self.assertEqual(policy.total_bytes, 90)
+        # a rewrite replaces the size of the entry
+        policy.on_put("k5", size=10)
+        self.assertEqual(policy.total_bytes, 70)
+    
+    def test_ttl(self):
+        policy = EvictionPolicy(max_entries=3, ttl=0.05)
+        policy.on_put("old", size=1)
+        time.sleep(0.1)
+        self.assertFalse(policy.on_hit("old"))
+        self.assertEqual(policy.expired, 1)
+        policy.on_put("a", size=1)
+        policy.on_put("b", size=1)
+        policy.on_hit("b")
+        # expired entries are evicted first
+        self.assertEqual(policy.on_put("c", size=1), ["old", "a"])
+    
+    def test_metadata_is_saved_and_loaded(self):
+        policy = EvictionPolicy(max_entries=3)
+        policy.on_put("a", size=1)
+        policy.on_put("b", size=1)
+        policy.on_hit("a")
+        policy.on_delete("b")
+        dirty = policy.take_dirty()
+        self.assertIsNone(dirty["b"])
+        self.assertEqual(policy.take_dirty(), {})
+        
+        loaded = EvictionPolicy(max_entries=3)
+        loaded.load([("a", 1, dirty["a"]), ("c", 1, None)])
+        loaded.on_put("d", size=1)
+        # "a" was accessed before "c" was loaded
+        self.assertEqual(loaded.on_put("e", size=1), ["a", "c"])
+
+
+class BoundedCachesTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sqlite_functions = []
+    
+    def tearDown(self):
+        for square in self.sqlite_functions:
+            square.close()
+        self.tmpdir.cleanup()
+    
+    def get_leveldb_function(self, **kwargs):
+        @leveldb_cache(value_to_str=str, str_to_value=int, db_path=os.path.join(self.tmpdir.name, "leveldb"), **kwargs)
+        def square(x: int) -> int:
+            square.calls_counter += 1
+            return x * x
+        
+        square.calls_counter = 0
+        return square
+    
+    def get_sqlite_function(self, **kwargs):
+        @sqlite_cache(value_to_str=str, str_to_value=int, db_path=os.path.join(self.tmpdir.name, "sqlite"), **kwargs)
+        def square(x: int) -> int:
+            square.calls_counter += 1
+            return x * x
+        
+        square.calls_counter = 0
+        self.sqlite_functions.append(square)
+        return square
+    
+    def assert_bounded(self, get_function, num_entries):
+        square = get_function(max_entries=10)
+        for x in range(10):
+            square(x)
+        square(0)  # 0 is now the most recently used
+        square(10)
+        self.assertEqual(square.calls_counter, 11)
+        self.assertEqual(num_entries(square), 9)
+        self.assertEqual(square(0), 0)
+        self.assertEqual(square.calls_counter, 11)
+        self.assertIsNone(square.cache_get(1))
+        square.get_many([(x,) for x in range(20, 30)])
+        self.assertLessEqual(num_entries(square), 10)
+    
+    def test_leveldb(self):
+        def num_entries(square):
+            return sum(1 for key in square.cache_db.iterator(include_value=False) if not key.startswith(METADATA_PREFIX))
+        
+        self.assert_bounded(self.get_leveldb_function, num_entries)
+    
+    def test_sqlite(self):
+        def num_entries(square):
+            return sum(value is not None for value in square.cache_get_many([(x,) for x in range(30)]))
+        
+        self.assert_bounded(self.get_sqlite_function, num_entries)
+    
+    def test_ttl(self):
+        for get_function in [self.get_leveldb_function, self.get_sqlite_function]:
+            square = get_function(ttl=0.05)
+            square(2)
+            square(2)
+            self.assertEqual(square.calls_counter, 1)
+            time.sleep(0.1)
+            self.assertEqual(square(2), 4)
+            self.assertEqual(square.calls_counter, 2)
+    
+    def test_metadata_survives_reopening(self):
+        square = self.get_leveldb_function(max_entries=5)
+        for x in range(5):
+            square(x)
+            time.sleep(0.001)
+        square(0)
+        square.eviction_policy.should_save = lambda: True
+        square(5)  # evicts 1
+        square.cache_db.close()
+        
+        square = self.get_leveldb_function(max_entries=5)
+        self.assertEqual(len(square.eviction_policy), 4)
+        square(6)
+        square(7)  # evicts the least recently used of 2, 3
+        self.assertIsNone(square.cache_get(2))
+        self.assertIsNotNone(square.cache_get(0))
+        square.cache_db.close()
+
+    def test_entries_are_loaded_on_first_use(self):
+        # the cache isn't scanned when it's opened, so entries written after it was
+        # opened (e.g. by another process) are loaded on its first use
+        square = self.get_sqlite_function(max_entries=5)
+        reopened = self.get_sqlite_function(max_entries=5)
+        for x in range(3):
+            square(x)
+        square.flush()
+        self.assertEqual(reopened(0), 0)
+        self.assertEqual(len(reopened.eviction_policy), 3)
+        
+        square = self.get_leveldb_function(max_entries=5)
+        square.cache_db.put(b"written by another process", b"1")
+        self.assertEqual(len(square.eviction_policy), 1)
+        square.cache_db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import plyvel
+
+from cache_server import CacheServer, CacheServerError, DEFAULT_SOCKET_PATH, RemoteDB, set_socket_path
+from utils import leveldb_cache
+
+
+class CacheServerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "leveldb")
+        self.socket_path = os.path.join(self.tmpdir.name, "cache_server.sock")
+    
+    def tearDown(self):
+        set_socket_path(DEFAULT_SOCKET_PATH)
+        self.tmpdir.cleanup()
+    
+    def get_cached_function(self):
+        @leveldb_cache(value_to_str=str, str_to_value=int, db_path=self.db_path)
+        def square(x: int) -> int:
+            square.calls_counter += 1
+            return x * x
+        
+        square.calls_counter = 0
+        return square
+    
+    def test_locked_db_is_read_from_a_snapshot(self):
+        square = self.get_cached_function()
+        for x in range(100):
+            square(x)
+        
+        # the db is locked by `square`, as if by another process
+        other = self.get_cached_function()
+        self.assertNotIsInstance(other.cache_db, RemoteDB)
+        self.assertEqual(other.get_many([(x,) for x in range(100)]), [x * x for x in range(100)])
+        self.assertEqual(other.calls_counter, 0)
+        # writes go to the snapshot only
+        self.assertEqual(other(100), 10000)
+        self.assertIsNone(square.cache_get(100))
+        other.cache_db.close()
+        square.cache_db.close()
+    
+    def test_server(self):
+        server = CacheServer(socket_path=self.socket_path).start()
+        set_socket_path(self.socket_path)
+        try:
+            square = self.get_cached_function()
+            other = self.get_cached_function()
+            self.assertIsInstance(square.cache_db, RemoteDB)
+            
+            self.assertEqual(square(3), 9)
+            self.assertEqual(other(3), 9)
+            self.assertEqual(other.calls_counter, 0)
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                self.assertEqual(square.get_many([(x,) for x in range(200)], executor=executor), [x * x for x in range(200)])
+            self.assertEqual(other.cache_get_many([(x,) for x in range(200)]), [x * x for x in range(200)])
+            other.cache_delete(3)
+            self.assertIsNone(square.cache_get(3))
+            
+            with other.bulk_population(max_pending=1000):
+                other.cache_put_many([1, 2], [(1000,), (1001,)])
+                self.assertIsNone(square.cache_get(1000))
+            self.assertEqual(square.cache_get(1001), 2)
+        finally:
+            server.stop()
+        
+        # the server wrote to the db itself
+        db = plyvel.DB(self.db_path)
+        self.assertEqual(db.get(b"4"), b"16")
+        db.close()
+
+
+    def test_db_that_cant_be_opened(self):
+        server = CacheServer(socket_path=self.socket_path).start()
+        try:
+            # the db is locked by a process that opened it directly
+            locked = plyvel.DB(self.db_path, create_if_missing=True)
+            remote = RemoteDB(self.db_path, socket_path=self.socket_path)
+            with self.assertRaises(CacheServerError):
+                remote.get_many([b"1", b"2"])
+            with self.assertRaises(CacheServerError):
+                remote.write([(b"1", b"1"), (b"2", None)])
+            locked.close()
+            
+            # the connection is still in sync
+            remote.put(b"3", b"9")
+            self.assertEqual(remote.get_many([b"1", b"3"]), {b"3": b"9"})
+            remote.close()
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
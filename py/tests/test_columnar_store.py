@@ -0,0 +1,173 @@
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from block_ingester import BlockIngester, BlockSource, ColumnarSink, TsvSink
+from columnar_store import ColumnarStore, column_path, export_to_tsv, txids_to_hex
+from datatypes import TxStats
+
+
+def random_block_stats(num_txs: int):
+    stats = {}
+    for i in range(num_txs):
+        txid = f"{random.getrandbits(256):064x}"
+        size = random.randint(100, 100_000)
+        stats[txid] = TxStats(
+            txid=txid,
+            fee=0 if i == 0 else random.randint(0, 10 ** 8),
+            size=size,
+            weight=size * random.randint(1, 4),
+        )
+    return stats
+
+
+class StatsSource(BlockSource):
+    """
+    blocks of given stats
+    """
+    
+    def __init__(self, blocks, failing=()):
+        self.blocks = blocks
+        self.failing = set(failing)
+    
+    def fetch(self, h):
+        if h in self.failing:
+            raise ValueError("block not found")
+        return self.blocks[h]
+    
+    def compute_stats(self, h, block, executor):
+        return block
+
+
+class ColumnarStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "store")
+        # an empty block has only a coinbase
+        self.blocks = {h: random_block_stats(1 if h == 12 else random.randint(1, 50)) for h in range(10, 20)}
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def fill(self, store, first=10, last=19):
+        for h in range(first, last + 1):
+            store.append_block(h, self.blocks[h])
+    
+    def assert_block(self, block, offset_index, h):
+        stats = list(self.blocks[h].values())
+        rows = slice(block.offsets[offset_index], block.offsets[offset_index + 1])
+        self.assertEqual(txids_to_hex(block.txid[rows]), [tx.txid for tx in stats])
+        self.assertEqual(block.fee[rows].tolist(), [tx.fee for tx in stats])
+        self.assertEqual(block.size[rows].tolist(), [tx.size for tx in stats])
+        self.assertEqual(block.weight[rows].tolist(), [tx.weight for tx in stats])
+        np.testing.assert_array_equal(block.feerate[rows], np.array([tx.feerate for tx in stats], dtype=np.float32))
+    
+    def test_append_and_slice(self):
+        store = ColumnarStore(self.path)
+        self.assertIsNone(store.last_height)
+        self.fill(store)
+        self.assertEqual((store.first_height, store.last_height), (10, 19))
+        with self.assertRaises(ValueError):
+            store.append_block(21, self.blocks[10])
+        store.flush()
+        
+        # a reader sees the flushed blocks
+        reader = ColumnarStore(self.path, readonly=True)
+        for s in [store, reader]:
+            block = s.get_blocks(12, 15)
+            self.assertEqual(len(block.offsets), 5)
+            for i, h in enumerate(range(12, 16)):
+                self.assert_block(block, i, h)
+            # the columns are views of the mapped files
+            self.assertIsInstance(block.weight.base, np.memmap)
+        with self.assertRaises(KeyError):
+            reader.get_blocks(15, 20)
+        with self.assertRaises(ValueError):
+            reader.append_block(20, self.blocks[10])
+        reader.close()
+        store.close()
+    
+    def test_truncate(self):
+        store = ColumnarStore(self.path)
+        self.fill(store)
+        store.truncate(17)
+        self.assertEqual(store.last_height, 16)
+        # a block that replaces a disconnected one
+        store.append_block(17, self.blocks[19])
+        self.assert_block(store.get_block(17), 0, 19)
+        store.truncate(5)
+        self.assertIsNone(store.last_height)
+        # an empty store may start at any height
+        self.fill(store, first=15)
+        self.assertEqual((store.first_height, store.last_height), (15, 19))
+        store.close()
+    
+    def test_partially_written_block_is_dropped(self):
+        store = ColumnarStore(self.path)
+        self.fill(store, last=14)
+        store.close()
+        # a crash after some columns of block 15 were written, and half of its end
+        with open(column_path(self.path, "fee"), "ab") as f:
+            f.write(b"\x01" * 8 * 3)
+        with open(os.path.join(self.path, "ends.bin"), "ab") as f:
+            f.write(b"\x01" * 4)
+        
+        store = ColumnarStore(self.path)
+        self.assertEqual(store.last_height, 14)
+        self.fill(store, first=15)
+        self.assert_block(store.get_blocks(14, 16), 1, 15)
+        store.close()
+        
+        # a crash after the end of block 20 was written, but not all of its rows
+        with open(os.path.join(self.path, "ends.bin"), "ab") as f:
+            f.write(np.array([10 ** 6], dtype=np.uint64).tobytes())
+        # a reader doesn't map rows that aren't in the columns
+        reader = ColumnarStore(self.path, readonly=True)
+        self.assertEqual(reader.last_height, 19)
+        self.assert_block(reader.get_block(19), 0, 19)
+        reader.close()
+        store = ColumnarStore(self.path)
+        self.assertEqual(store.last_height, 19)
+        store.close()
+    
+    def test_export_to_tsv(self):
+        store = ColumnarStore(self.path)
+        self.fill(store)
+        folder = os.path.join(self.tmpdir.name, "tsv")
+        os.makedirs(folder)
+        for metric, filename_format in [("feerate", "block_{h}_feerates.tsv"), ("weight", "block_{h}_tx_weights.tsv")]:
+            self.assertEqual(export_to_tsv(store, metric, folder, f"exported_{filename_format}", 11, 13), 3)
+            sink = TsvSink(folder, filename_format, attribute=metric)
+            for h in range(11, 14):
+                sink.write_block(h, self.blocks[h])
+                # exactly as the tsv sink writes them
+                with open(sink.get_filepath(h)) as f1, open(os.path.join(folder, f"exported_{filename_format.format(h=h)}")) as f2:
+                    self.assertEqual(f1.read(), f2.read())
+        store.close()
+    
+    def test_sink(self):
+        store = ColumnarStore(self.path)
+        sink = ColumnarSink(store)
+        ingester = BlockIngester([sink], source=StatsSource(self.blocks, failing={15}), depth=3)
+        self.assertEqual(ingester.run(10, 19), [15])
+        # no later block is appended after a block that failed
+        self.assertEqual(store.last_height, 14)
+        
+        ingester.source.failing.clear()
+        self.assertEqual(ingester.run(10, 19), [])
+        self.assertEqual(store.last_height, 19)
+        for i, h in enumerate(range(10, 20)):
+            self.assert_block(store.get_blocks(10, 19), i, h)
+        
+        ingester.remove_block(19)
+        self.assertEqual(store.last_height, 18)
+        ingester.close()
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
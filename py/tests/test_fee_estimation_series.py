@@ -0,0 +1,81 @@
+import math
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from bitcoin_rpc import BitcoinRPC
+from fake_bitcoind import FakeBitcoind, FakeChain
+from fee_estimation_series import COLUMNS, FeeEstimationSeries, export_to_text_files, sample_estimations
+
+
+class FeeEstimationSeriesTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "estimatesmartfee.bin")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_append_and_read(self):
+        series = FeeEstimationSeries(self.path)
+        self.assertEqual(series.num_samples, 0)
+        self.assertEqual(len(series.read().timestamps), 0)
+        for i in range(10):
+            series.append(1000 + 60 * i, [i + j / 100 for j in range(len(COLUMNS))])
+        with self.assertRaises(ValueError):
+            series.append(2000, [1.0])
+        series.close()
+        
+        reader = FeeEstimationSeries(self.path, readonly=True)
+        self.assertEqual(reader.columns, COLUMNS)
+        samples = reader.read(start=1060, end=1180)
+        self.assertEqual(samples.timestamps.tolist(), [1060, 1120, 1180])
+        self.assertEqual(samples.feerates.shape, (3, len(COLUMNS)))
+        self.assertEqual(samples.feerates[2, reader.column_index(1, "CONSERVATIVE")], 3.01)
+    
+    def test_partial_record_is_dropped(self):
+        series = FeeEstimationSeries(self.path, columns=[(1, "ECONOMICAL"), (2, "ECONOMICAL")])
+        series.append(1000, [1.0, 2.0])
+        series.close()
+        # a crash in the middle of appending a record
+        with open(self.path, "ab") as f:
+            f.write(b"\x01" * 10)
+        
+        self.assertEqual(FeeEstimationSeries(self.path, readonly=True).num_samples, 1)
+        series = FeeEstimationSeries(self.path)
+        series.append(1060, [3.0, math.nan])
+        series.close()
+        samples = FeeEstimationSeries(self.path, readonly=True).read()
+        self.assertEqual(samples.timestamps.tolist(), [1000, 1060])
+        np.testing.assert_array_equal(samples.feerates, [[1.0, 2.0], [3.0, math.nan]])
+    
+    def test_sample_and_export(self):
+        server = FakeBitcoind(FakeChain(num_blocks=1)).start()
+        rpc = BitcoinRPC(port=server.port, user=server.user, password=server.password)
+        try:
+            series = FeeEstimationSeries(self.path)
+            requests_before = server.requests_count
+            for timestamp in [1000, 1060]:
+                series.append(timestamp, sample_estimations(rpc, series.columns))
+            # all estimations of a sample in a single request
+            self.assertEqual(server.requests_count - requests_before, 2)
+        finally:
+            rpc.close()
+            server.stop()
+        
+        folder = os.path.join(self.tmpdir.name, "fee-estimations")
+        paths = export_to_text_files(series, folder, start=1050)
+        self.assertEqual(len(paths), len(COLUMNS))
+        with open(os.path.join(folder, "estimatesmartfee_blocks=2_mode=CONSERVATIVE")) as f:
+            self.assertEqual(f.read(), "1060,0.001\n")
+        # as jq prints a missing estimation
+        with open(os.path.join(folder, "estimatesmartfee_blocks=100_mode=ECONOMICAL")) as f:
+            self.assertEqual(f.read(), "1060,null\n")
+        series.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import random
+import tempfile
+import unittest
+
+import bitcoin_cli
+from bitcoin_rpc import BitcoinRPC
+from fake_bitcoind import FakeBitcoind, FakeChain
+from height_index import BLOCK_RECORD_DTYPE, BlockHeightIndex
+
+
+class BlockHeightIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "height_index.bin")
+        self.chain = FakeChain(num_blocks=250, txs_per_block=2, seed=random.getrandbits(64))
+        self.server = FakeBitcoind(self.chain).start()
+        bitcoin_cli.set_bitcoin_rpc(BitcoinRPC(port=self.server.port, user=self.server.user, password=self.server.password))
+    
+    def tearDown(self):
+        bitcoin_cli.set_height_index(None)
+        bitcoin_cli.set_bitcoin_rpc(None)
+        self.server.stop()
+        self.tmpdir.cleanup()
+    
+    def assert_index_matches_chain(self, index: BlockHeightIndex):
+        self.assertEqual(len(index), len(self.chain.blocks))
+        for h, block in enumerate(self.chain.blocks):
+            self.assertEqual(index.get(h), {
+                k: block[k] for k in ["hash", "height", "time", "mediantime", "size", "weight", "nTx"]
+            })
+    
+    def test_sync(self):
+        index = BlockHeightIndex(self.path)
+        self.assertIsNone(index.tip_height)
+        self.assertEqual(bitcoin_cli.sync_height_index(index), 250)
+        self.assert_index_matches_chain(index)
+        self.assertEqual(list(index.times()), [b["time"] for b in self.chain.blocks])
+        
+        # only the new blocks are fetched
+        for _ in range(3):
+            self.chain.add_block()
+        requests_before = self.server.requests_count
+        self.assertEqual(bitcoin_cli.sync_height_index(index), 3)
+        # getblockcount, getblockhash of the indexed tip, and a batch of each
+        self.assertEqual(self.server.requests_count - requests_before, 4)
+        self.assert_index_matches_chain(index)
+        
+        # the index is persistent
+        self.assert_index_matches_chain(BlockHeightIndex(self.path))
+    
+    def test_reorg(self):
+        index = BlockHeightIndex(self.path)
+        bitcoin_cli.sync_height_index(index)
+        times = index.times()
+        self.chain.reorg(depth=3)
+        self.assertEqual(bitcoin_cli.sync_height_index(index), 4)
+        self.assert_index_matches_chain(index)
+        # arrays returned before the reorg are still usable
+        self.assertEqual(len(times), 250)
+        
+        self.chain.reorg(depth=5, num_new_blocks=2)
+        bitcoin_cli.sync_height_index(index)
+        self.assert_index_matches_chain(index)
+    
+    def test_partial_record_is_dropped(self):
+        index = BlockHeightIndex(self.path)
+        bitcoin_cli.sync_height_index(index)
+        with open(self.path, "ab") as f:
+            f.write(b"\x01\x02\x03")
+        self.assert_index_matches_chain(BlockHeightIndex(self.path))
+    
+    def test_readonly(self):
+        with self.assertRaises(FileNotFoundError):
+            BlockHeightIndex(self.path, readonly=True)
+        self.assertFalse(os.path.exists(self.path))
+        bitcoin_cli.sync_height_index(BlockHeightIndex(self.path))
+        with open(self.path, "ab") as f:
+            f.write(b"\x01\x02\x03")
+        
+        index = BlockHeightIndex(self.path, readonly=True)
+        self.assert_index_matches_chain(index)
+        # the partial record is left for the writer to drop
+        self.assertEqual(os.path.getsize(self.path) % BLOCK_RECORD_DTYPE.itemsize, 3)
+        with self.assertRaises(ValueError):
+            index.truncate(0)
+    
+    def test_lookups_use_the_index(self):
+        index = BlockHeightIndex(self.path)
+        bitcoin_cli.sync_height_index(index)
+        bitcoin_cli.set_height_index(index)
+        
+        requests_before = self.server.requests_count
+        self.assertEqual(bitcoin_cli.get_block_time(17), self.chain.blocks[17]["time"])
+        self.assertEqual(bitcoin_cli.get_block_size(17), self.chain.blocks[17]["size"])
+        self.assertEqual(self.server.requests_count - requests_before, 0)
+        
+        self.assertEqual(bitcoin_cli.get_block_by_height(17)["hash"], self.chain.blocks[17]["hash"])
+        self.assertEqual(self.server.requests_count - requests_before, 1)
+        
+        # heights that are not indexed yet are looked up in bitcoind
+        new_block = self.chain.add_block()
+        self.assertEqual(bitcoin_cli.get_block_hash(new_block["height"]), new_block["hash"])
+        block_hashes = bitcoin_cli.get_block_hashes([new_block["height"], 3])
+        self.assertEqual(block_hashes, {new_block["height"]: new_block["hash"], 3: self.chain.blocks[3]["hash"]})
+
+
+if __name__ == '__main__':
+    unittest.main()
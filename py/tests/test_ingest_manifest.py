@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from ingest_manifest import IngestManifest
+
+
+class IngestManifestTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "manifest.json")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_missing_ranges(self):
+        manifest = IngestManifest(self.path)
+        self.assertEqual(manifest.last_height, -1)
+        self.assertEqual(manifest.missing_ranges(5, 9), [(5, 9)])
+        for h in list(range(0, 100)) + list(range(150, 700_000)):
+            manifest.mark_done(h)
+        manifest.unmark(120)
+        manifest.mark_failed(7, reason="timeout")
+        manifest.mark_failed(7, reason="block not found")
+        manifest.mark_failed(800_000, reason="block not found")
+        
+        self.assertEqual(manifest.missing_ranges(0, 700_002), [(7, 7), (100, 149), (700_000, 700_002)])
+        self.assertEqual(manifest.missing_ranges(0, 200, max_retries=2), [(100, 149)])
+        self.assertFalse(manifest.is_done(7))
+        self.assertTrue(manifest.is_done(699_999))
+        self.assertFalse(manifest.is_done(10 ** 7))
+        self.assertEqual(manifest.last_height, 800_000)
+    
+    def test_save_and_load(self):
+        manifest = IngestManifest(self.path)
+        manifest.save()
+        # nothing is written until something changes
+        self.assertFalse(os.path.exists(self.path))
+        for h in range(10, 600_010):
+            manifest.mark_done(h)
+        manifest.mark_failed(20, reason="block not found")
+        manifest.mark_failed(30, reason="timeout")
+        manifest.mark_done(30)
+        manifest.save()
+        # the bitmap is compressed
+        self.assertLess(os.path.getsize(self.path), 10_000)
+        
+        loaded = IngestManifest(self.path)
+        self.assertEqual(loaded.missing_ranges(0, 600_010), [(0, 9), (20, 20), (600_010, 600_010)])
+        self.assertEqual(list(loaded.failures.keys()), [20])
+        self.assertEqual(loaded.failures[20].reason, "block not found")
+        self.assertEqual(loaded.failures[20].retries, 1)
+        self.assertFalse(os.path.exists(f"{self.path}.tmp"))
+
+
+if __name__ == '__main__':
+    unittest.main()
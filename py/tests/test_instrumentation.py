@@ -0,0 +1,129 @@
+import random
+import tempfile
+import unittest
+from functools import lru_cache
+
+import bitcoin_cli
+from bitcoin_rpc import BitcoinRPC, BitcoinRPCError
+from fake_bitcoind import FakeBitcoind, FakeChain
+from instrumentation import LatencyHistogram, METRICS, Metrics
+from utils import leveldb_cache, sqlite_cache
+
+
+class InstrumentationTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        METRICS.reset()
+    
+    def tearDown(self):
+        METRICS.reset()
+        self.tmpdir.cleanup()
+    
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(50), 0)
+        for _ in range(90):
+            histogram.observe(0.00015)
+        for _ in range(10):
+            histogram.observe(0.5)
+        self.assertEqual(histogram.percentile(50), 0.0002)
+        self.assertEqual(histogram.percentile(90), 0.0002)
+        self.assertGreaterEqual(histogram.percentile(99), 0.5)
+        self.assertLessEqual(histogram.percentile(99), 1)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 100)
+        self.assertEqual(snapshot["max_seconds"], 0.5)
+        self.assertEqual(sum(snapshot["buckets"].values()), 100)
+        
+        # latencies beyond the last bound are reported as the max
+        histogram.observe(1000)
+        self.assertEqual(histogram.percentile(100), 1000)
+    
+    def test_rpc_queries(self):
+        chain = FakeChain(num_blocks=10, txs_per_block=2, seed=random.getrandbits(64))
+        server = FakeBitcoind(chain).start()
+        rpc = BitcoinRPC(port=server.port, user=server.user, password=server.password)
+        try:
+            for h in range(5):
+                rpc.call("getblockhash", h)
+            rpc.batch([("getblockhash", [h]) for h in range(10)])
+            rpc.batch([("getblockhash", [0]), ("getblockcount", [])])
+            with self.assertRaises(BitcoinRPCError):
+                rpc.call("getblockhash", 1000)
+        finally:
+            rpc.close()
+            server.stop()
+        
+        queries = METRICS.snapshot()["queries"]["rpc"]
+        self.assertEqual(set(queries.keys()), {"getblockhash", "batch"})
+        getblockhash = queries["getblockhash"]
+        self.assertEqual(getblockhash["requests"], 7)
+        self.assertEqual(getblockhash["calls"], 16)
+        self.assertEqual(getblockhash["errors"], 1)
+        self.assertEqual(getblockhash["latency"]["count"], 7)
+        self.assertGreater(getblockhash["bytes_sent"], 0)
+        # every hash is 64 hex chars
+        self.assertGreater(getblockhash["bytes_received"], 15 * 64)
+        self.assertEqual(queries["batch"]["calls"], 2)
+    
+    def test_cache_lookups(self):
+        @leveldb_cache(value_to_str=str, str_to_value=int, db_path=f"{self.tmpdir.name}/square_in_leveldb")
+        def square_in_leveldb(x: int) -> int:
+            return x * x
+        
+        @sqlite_cache(value_to_str=str, str_to_value=int, db_path=f"{self.tmpdir.name}/square_in_sqlite")
+        def square_in_sqlite(x: int) -> int:
+            return x * x
+        
+        for square in [square_in_leveldb, square_in_sqlite]:
+            for x in [1, 2, 1, 1, 3]:
+                square(x)
+            square.cache_get(4)
+        
+        caches = METRICS.snapshot()["caches"]
+        for name in ["square_in_leveldb", "square_in_sqlite"]:
+            self.assertEqual(caches[name]["hits"], 2)
+            self.assertEqual(caches[name]["misses"], 4)
+            self.assertAlmostEqual(caches[name]["hit_ratio"], 2 / 6)
+            self.assertEqual(caches[name]["lookup_latency"]["count"], 6)
+        square_in_leveldb.cache_db.close()
+        square_in_sqlite.close()
+    
+    def test_lru_caches_and_summary(self):
+        @lru_cache(maxsize=None)
+        def double(x: int) -> int:
+            return 2 * x
+        
+        metrics = Metrics()
+        self.assertEqual(metrics.summary(), "nothing recorded")
+        metrics.register_lru_cache("double", double)
+        for x in [1, 1, 2]:
+            double(x)
+        metrics.record_query(transport="cli", method="getblock", seconds=0.01, bytes_received=2 ** 20)
+        
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["lru_caches"]["double"], {"hits": 1, "misses": 2, "hit_ratio": 1 / 3, "size": 2})
+        self.assertEqual(snapshot["queries"]["cli"]["getblock"]["bytes_received"], 2 ** 20)
+        summary = metrics.summary()
+        self.assertIn("cli:getblock 1 calls/1 reqs", summary)
+        self.assertIn("cache:double 1/3 hits", summary)
+        
+        metrics.enabled = False
+        metrics.record_query(transport="cli", method="getblock", seconds=0.01)
+        self.assertEqual(metrics.snapshot()["queries"]["cli"]["getblock"]["requests"], 1)
+    
+    def test_rpc_call_through_bitcoin_cli(self):
+        chain = FakeChain(num_blocks=3, txs_per_block=2, seed=random.getrandbits(64))
+        server = FakeBitcoind(chain).start()
+        bitcoin_cli.set_bitcoin_rpc(BitcoinRPC(port=server.port, user=server.user, password=server.password))
+        try:
+            self.assertEqual(bitcoin_cli.blockchain_height(), 2)
+        finally:
+            bitcoin_cli.set_bitcoin_rpc(None)
+            server.stop()
+        self.assertEqual(METRICS.snapshot()["queries"]["rpc"]["getblockcount"]["requests"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,21 @@
 import os
 import shutil
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import get_leveldb_cache_fullpath, leveldb_cache
+from utils import bulk_population, get_leveldb_cache_fullpath, leveldb_cache
 
 
 class MyTestCase(unittest.TestCase):
     
-    @staticmethod
-    def __init_cached_function(key_to_str=None):
-        db_path = get_leveldb_cache_fullpath("test_method_for_leveldb_cache_test")
+    def __init_cached_function(self, key_to_str=None):
+        # a leveldb can't be opened twice by the same process, so every test uses its own db
+        db_path = get_leveldb_cache_fullpath(f"test_method_for_leveldb_cache_test_{self._testMethodName}")
         if os.path.exists(db_path):
             shutil.rmtree(db_path)
         
-        @leveldb_cache(value_to_str=str, str_to_value=float, key_to_str=key_to_str)
+        @leveldb_cache(value_to_str=str, str_to_value=float, key_to_str=key_to_str, db_path=db_path)
         def test_method_for_leveldb_cache_test(x, y, z) -> float:
             test_method_for_leveldb_cache_test.calls_counter += 1
             return (x + y) * z
@@ -50,6 +52,109 @@ class MyTestCase(unittest.TestCase):
 
         self.assertEqual(cached_function.calls_counter, 1)
 
+    def test_cache_get_and_put(self):
+        cached_function = self.__init_cached_function()
+        self.assertIsNone(cached_function.cache_get(1, 2, 3))
+        
+        cached_function.cache_put(42.0, 1, 2, 3)
+        self.assertEqual(cached_function.cache_get(1, 2, 3), 42.0)
+        # the value that was put is returned without calling the function
+        self.assertEqual(cached_function(1, 2, 3), 42.0)
+        self.assertEqual(cached_function.calls_counter, 0)
+        
+        cached_function(2, 2, 2)
+        self.assertEqual(cached_function.cache_get(2, 2, 2), 8.0)
+
+        cached_function.cache_delete(2, 2, 2)
+        self.assertIsNone(cached_function.cache_get(2, 2, 2))
+        cached_function.cache_delete(5, 5, 5)  # not cached
+
+    def test_bulk_population(self):
+        cached_function = self.__init_cached_function()
+        cached_function(1, 1, 1)
+        db = cached_function.cache_db
+        
+        with bulk_population(cached_function, max_pending=6, max_delay=60) as buffer:
+            for x in range(2, 6):
+                cached_function(x, 1, 1)
+            # nothing was written yet, but lookups see the pending writes
+            self.assertIsNone(db.get(b"2,1,1"))
+            self.assertEqual(cached_function.cache_get(2, 1, 1), 3.0)
+            cached_function(2, 1, 1)
+            self.assertEqual(cached_function.calls_counter, 5)
+            
+            # a pending delete hides the value on disk
+            cached_function.cache_delete(1, 1, 1)
+            self.assertEqual(db.get(b"1,1,1"), b"2")
+            self.assertIsNone(cached_function.cache_get(1, 1, 1))
+            
+            # the 6th pending write triggers a flush
+            cached_function.cache_put(42.0, 6, 1, 1)
+            self.assertEqual(buffer.flushes, 1)
+            self.assertEqual(db.get(b"2,1,1"), b"3")
+            self.assertIsNone(db.get(b"1,1,1"))
+            
+            cached_function.cache_put(43.0, 7, 1, 1)
+            cached_function.flush()
+            self.assertEqual(db.get(b"7,1,1"), b"43.0")
+            
+            cached_function.cache_put(44.0, 8, 1, 1)
+        # closing the buffer flushes it, and writes are direct again
+        self.assertEqual(db.get(b"8,1,1"), b"44.0")
+        self.assertIsNone(cached_function.write_buffer)
+        cached_function.cache_put(45.0, 9, 1, 1)
+        self.assertEqual(db.get(b"9,1,1"), b"45.0")
+    
+    def test_bulk_population_is_flushed_on_error_and_periodically(self):
+        cached_function = self.__init_cached_function()
+        db = cached_function.cache_db
+        
+        with self.assertRaises(KeyboardInterrupt):
+            with cached_function.bulk_population(max_delay=60):
+                cached_function(1, 1, 1)
+                raise KeyboardInterrupt()
+        self.assertEqual(db.get(b"1,1,1"), b"2")
+        
+        with cached_function.bulk_population(max_delay=0.01) as buffer:
+            cached_function(2, 1, 1)
+            deadline = time.time() + 5
+            while db.get(b"2,1,1") is None and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(db.get(b"2,1,1"), b"3")
+            self.assertGreaterEqual(buffer.flushes, 1)
+
+    def test_get_many_reads_pending_writes(self):
+        cached_function = self.__init_cached_function()
+        cached_function(1, 1, 1)
+        with cached_function.bulk_population(max_delay=60):
+            cached_function.cache_delete(1, 1, 1)
+            self.assertEqual(cached_function.get_many([(2, 1, 1)]), [3.0])
+            self.assertIsNone(cached_function.cache_db.get(b"2,1,1"))
+            self.assertEqual(cached_function.cache_get_many([(1, 1, 1), (2, 1, 1)]), [None, 3.0])
+        self.assertEqual(cached_function.cache_db.get(b"2,1,1"), b"3")
+    
+    def test_get_many(self):
+        cached_function = self.__init_cached_function()
+        cached_function(1, 1, 1)
+        cached_function.cache_put(42.0, 2, 2, 2)
+        
+        args_list = [(x, 1, 1) for x in range(1000)] + [(2, 2, 2), (3, 1, 1)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = cached_function.get_many(args_list, executor=executor)
+        self.assertEqual(results, [float(x + 1) for x in range(1000)] + [42.0, 4.0])
+        # only the misses were computed, once each
+        self.assertEqual(cached_function.calls_counter, 1 + 999)
+        
+        # the computed results were cached
+        self.assertEqual(cached_function.cache_get(500, 1, 1), 501.0)
+        self.assertEqual(cached_function.get_many(args_list), results)
+        self.assertEqual(cached_function.calls_counter, 1000)
+        self.assertEqual(cached_function.cache_get_many([(7, 1, 1), (7, 7, 7)]), [8.0, None])
+        
+        cached_function.cache_put_many([1.5, 2.5], [(7, 7, 7), (8, 8, 8)])
+        self.assertEqual(cached_function.cache_get_many([(7, 7, 7), (8, 8, 8)]), [1.5, 2.5])
+        self.assertEqual(cached_function.get_many([]), [])
+
 
 if __name__ == '__main__':
     unittest.main()
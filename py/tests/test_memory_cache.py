@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+from memory_cache import MISSING, MemoryCache
+from utils import leveldb_cache, sqlite_cache, two_tier_cache
+
+
+class MemoryCacheTest(unittest.TestCase):
+    
+    def test_max_entries(self):
+        cache = MemoryCache(max_entries=3)
+        for i in range(3):
+            cache.put(i, i * i)
+        self.assertEqual(cache.get(0), 0)  # 0 is now the most recently used
+        cache.put(3, 9)
+        self.assertIs(cache.get(1), MISSING)
+        self.assertEqual(cache.get(0), 0)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.cache_info().hits, 2)
+        self.assertEqual(cache.cache_info().misses, 1)
+        self.assertEqual(cache.evicted, 1)
+    
+    def test_max_bytes(self):
+        cache = MemoryCache(max_bytes=100, sizeof=lambda o: 10)
+        for i in range(10):
+            cache.put(i, i)
+        self.assertEqual(cache.total_bytes, 100)
+        self.assertTrue(cache.is_full())
+        cache.put(10, 10)
+        self.assertEqual(len(cache), 5)
+        cache.delete(10)
+        self.assertEqual(cache.total_bytes, 80)
+        # None is a value like any other
+        cache.put("none", None)
+        self.assertIsNone(cache.get("none"))
+
+
+class TwoTierCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def get_cached_function(self, persistent_cache, **kwargs):
+        @two_tier_cache(persistent_cache(value_to_str=str, str_to_value=int, db_path=self.db_path), **kwargs)
+        def square(x: int) -> int:
+            square.calls_counter += 1
+            return x * x
+        
+        square.calls_counter = 0
+        return square
+    
+    def assert_tiers(self, persistent_cache):
+        square = self.get_cached_function(persistent_cache, l1_max_entries=5)
+        self.assertEqual([square(x) for x in range(10)], [x * x for x in range(10)])
+        self.assertEqual(square(9), 81)
+        self.assertEqual(square.calls_counter, 10)
+        # 0 was evicted from the L1, but is still in the L2
+        self.assertEqual(square(0), 0)
+        self.assertEqual(square.calls_counter, 10)
+        self.assertEqual(square.tier_stats()["l1"]["hits"], 1)
+        self.assertEqual(square.tier_stats()["l1"]["size"], 5)
+        self.assertEqual(square.tier_stats()["l2"], {"hits": 1, "misses": 10})
+        
+        self.assertEqual(square.get_many([(x,) for x in range(12)]), [x * x for x in range(12)])
+        self.assertEqual(square.calls_counter, 12)
+        square.cache_delete(11)
+        self.assertIsNone(square.cache_get(11))
+        square.flush()
+        return square
+    
+    def test_leveldb(self):
+        self.db_path = os.path.join(self.tmpdir.name, "leveldb")
+        square = self.assert_tiers(leveldb_cache)
+        square.persistent.cache_db.close()
+        
+        warm = self.get_cached_function(leveldb_cache, l1_max_entries=5, warm_up=[(x,) for x in range(20)])
+        self.assertEqual(warm.tier_stats()["l1"]["size"], 5)
+        self.assertEqual(warm(0), 0)
+        self.assertEqual(warm.tier_stats()["l1"]["hits"], 1)
+        self.assertEqual(warm.tier_stats()["l2"], {"hits": 0, "misses": 0})
+        warm.persistent.cache_db.close()
+    
+    def test_sqlite(self):
+        self.db_path = os.path.join(self.tmpdir.name, "sqlite")
+        square = self.assert_tiers(sqlite_cache)
+        square.persistent.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
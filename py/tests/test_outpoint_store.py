@@ -0,0 +1,69 @@
+import random
+import tempfile
+import unittest
+
+import bitcoin_cli
+from bitcoin_rpc import BitcoinRPC
+from fake_bitcoind import FakeBitcoind, FakeChain
+from outpoint_store import OutpointValueStore
+
+
+class OutpointValueStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = OutpointValueStore(db_path=self.tmpdir.name)
+        self.chain = FakeChain(num_blocks=10, txs_per_block=5, seed=random.getrandbits(64))
+    
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+    
+    def full_block(self, height: int):
+        return self.chain.getblock(self.chain.blocks[height]["hash"], 2)
+    
+    def test_add_block_and_lookup(self):
+        self.assertIsNone(self.store.last_height)
+        for h in range(3):
+            self.store.add_block(self.full_block(h))
+        self.assertEqual(self.store.last_height, 2)
+        
+        tx = self.chain.txs[self.chain.blocks[2]["tx"][0]]
+        outpoints = [(tx["txid"], out["n"]) for out in tx["vout"]] + [("00" * 32, 0)]
+        values = self.store.get_many(outpoints)
+        for out in tx["vout"]:
+            self.assertEqual(values[(tx["txid"], out["n"])], round(out["value"] * 10 ** 8))
+        self.assertIsNone(values[("00" * 32, 0)])
+    
+    def test_spent_outputs_are_pruned(self):
+        self.store.add_block(self.full_block(0))
+        self.store.add_block(self.full_block(1))
+        spent = [
+            (src_entry["txid"], src_entry["vout"])
+            for txid in self.chain.blocks[1]["tx"][1:]
+            for src_entry in self.chain.txs[txid]["vin"]
+        ]
+        self.assertTrue(spent)
+        self.assertEqual(set(self.store.get_many(spent).values()), {None})
+    
+    def test_block_stats_without_fetching_parents(self):
+        server = FakeBitcoind(self.chain).start()
+        self.chain.supports_prevouts = False
+        bitcoin_cli.set_bitcoin_rpc(BitcoinRPC(port=server.port, user=server.user, password=server.password))
+        bitcoin_cli.set_outpoint_store(self.store)
+        try:
+            for h in range(self.chain.height() + 1):
+                requests_before = server.requests_count
+                stats = bitcoin_cli.get_block_txs_stats(h)
+                # getblockhash and getblock only. all parents are in the store
+                self.assertEqual(server.requests_count - requests_before, 2)
+                for txid, tx_stats in stats.items():
+                    self.assertEqual(tx_stats.fee, self.chain.txs[txid].get("fee_sat", 0))
+        finally:
+            bitcoin_cli.set_outpoint_store(None)
+            bitcoin_cli.set_bitcoin_rpc(None)
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+
+import plyvel
+
+from cache_eviction import METADATA_PREFIX
+from shared_store import Namespace, count_unmigrated, migrate_leveldb, namespace_prefix
+from utils import bulk_population, leveldb_cache, open_shared_store
+
+
+class SharedStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "shared")
+    
+    def tearDown(self):
+        open_shared_store(self.db_path).close()
+        self.tmpdir.cleanup()
+    
+    def get_cached_functions(self, **kwargs):
+        @leveldb_cache(value_to_str=str, str_to_value=int, db_path=self.db_path, shared=True, **kwargs)
+        def square(x: int) -> int:
+            return x * x
+        
+        @leveldb_cache(value_to_str=str, str_to_value=int, db_path=self.db_path, shared=True, **kwargs)
+        def cube(x: int) -> int:
+            return x * x * x
+        
+        return square, cube
+    
+    def test_namespaces(self):
+        square, cube = self.get_cached_functions()
+        self.assertIs(square.cache_db.root, cube.cache_db.root)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(cube(3), 27)
+        self.assertEqual(square.cache_get_many([(3,), (4,)]), [9, None])
+        self.assertEqual(cube.get_many([(3,), (4,)]), [27, 64])
+        
+        root = open_shared_store(self.db_path)
+        self.assertEqual(root.get(b"square\x003"), b"9")
+        self.assertEqual(dict(cube.cache_db.iterator()), {b"3": b"27", b"4": b"64"})
+        square.cache_delete(3)
+        self.assertIsNone(square.cache_get(3))
+        self.assertEqual(cube.cache_get(3), 27)
+    
+    def test_cross_function_batch(self):
+        class CountingRoot:
+            def __init__(self, db):
+                self.db = db
+                self.batches = 0
+            
+            def write_batch(self):
+                self.batches += 1
+                return self.db.write_batch()
+            
+            def __getattr__(self, name):
+                return getattr(self.db, name)
+        
+        square, cube = self.get_cached_functions()
+        root = CountingRoot(open_shared_store(self.db_path))
+        square.cache_db.root = cube.cache_db.root = root
+        with bulk_population(square, cube, max_pending=1000):
+            square.cache_put_many([1, 4], [(1,), (2,)])
+            cube.cache_put_many([1, 8], [(1,), (2,)])
+        # a single batch for both functions
+        self.assertEqual(root.batches, 1)
+        self.assertEqual(square.cache_get(2), 4)
+        self.assertEqual(cube.cache_get(2), 8)
+    
+    def test_bounded_namespace(self):
+        square, _ = self.get_cached_functions(max_entries=10)
+        for x in range(20):
+            square(x)
+        root = open_shared_store(self.db_path)
+        prefix = namespace_prefix("square")
+        entries = [key for key in root.iterator(prefix=prefix, include_value=False) if METADATA_PREFIX not in key]
+        self.assertLessEqual(len(entries), 10)
+    
+    def test_migration(self):
+        src_path = os.path.join(self.tmpdir.name, "square")
+        src = plyvel.DB(src_path, create_if_missing=True)
+        for x in range(10):
+            src.put(str(x).encode("utf-8"), str(x * x).encode("utf-8"))
+        src.close()
+        
+        root = open_shared_store(self.db_path)
+        dst = Namespace(root, namespace_prefix("square"))
+        self.assertEqual(count_unmigrated(src_path, dst, batch_size=3), 10)
+        self.assertEqual(migrate_leveldb(src_path, dst, batch_size=3), 10)
+        self.assertEqual(count_unmigrated(src_path, dst, batch_size=3), 0)
+        dst.put(b"3", b"0")
+        self.assertEqual(count_unmigrated(src_path, dst, batch_size=3), 1)
+        dst.put(b"3", b"9")
+        square, _ = self.get_cached_functions()
+        self.assertEqual(square.cache_get(7), 49)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import METRICS
+from single_flight import SingleFlight, single_flight
+from utils import leveldb_cache, sqlite_cache, two_tier_cache
+
+NUM_THREADS = 8
+
+
+class SingleFlightTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        METRICS.reset()
+    
+    def tearDown(self):
+        METRICS.reset()
+        self.tmpdir.cleanup()
+    
+    def call_concurrently(self, func, args):
+        # all threads start before the first call ends
+        barrier = threading.Barrier(NUM_THREADS)
+        
+        def call():
+            barrier.wait()
+            return func(*args)
+        
+        with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+            futures = [executor.submit(call) for _ in range(NUM_THREADS)]
+            return [f.result() for f in futures]
+    
+    def slow_square(self):
+        def square(x: int) -> int:
+            square.calls_counter += 1
+            time.sleep(0.2)
+            return x * x
+        
+        square.calls_counter = 0
+        return square
+    
+    def test_decorator(self):
+        square = single_flight(self.slow_square())
+        self.assertEqual(self.call_concurrently(square, (3,)), [9] * NUM_THREADS)
+        self.assertEqual(square.__wrapped__.calls_counter, 1)
+        self.assertEqual(square.single_flight.coalesced, NUM_THREADS - 1)
+        self.assertEqual(METRICS.snapshot()["coalesced"], {"square": NUM_THREADS - 1})
+        # the result isn't kept once the call is done
+        square(3)
+        self.assertEqual(square.__wrapped__.calls_counter, 2)
+    
+    def test_exceptions_are_shared(self):
+        flight = SingleFlight()
+        calls = []
+        
+        def fail():
+            calls.append(1)
+            time.sleep(0.2)
+            raise ValueError("failed")
+        
+        def call():
+            with self.assertRaises(ValueError):
+                flight.do("key", fail)
+        
+        self.call_concurrently(call, ())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.coalesced, NUM_THREADS - 1)
+    
+    def test_caches(self):
+        decorators = [
+            leveldb_cache(value_to_str=str, str_to_value=int, db_path=os.path.join(self.tmpdir.name, "leveldb")),
+            sqlite_cache(value_to_str=str, str_to_value=int, db_path=os.path.join(self.tmpdir.name, "sqlite")),
+            two_tier_cache(sqlite_cache(
+                value_to_str=str, str_to_value=int, db_path=os.path.join(self.tmpdir.name, "two_tier"),
+            )),
+        ]
+        squares = []
+        for decorator in decorators:
+            square = decorator(self.slow_square())
+            squares.append(square)
+            self.assertEqual(self.call_concurrently(square, (3,)), [9] * NUM_THREADS)
+            self.assertEqual(square.__wrapped__.calls_counter, 1)
+            self.assertEqual(square.single_flight.coalesced, NUM_THREADS - 1)
+            
+            # get_many of different threads, with overlapping misses
+            self.call_concurrently(square.get_many, ([(x,) for x in range(4, 7)],))
+            self.assertEqual(square.__wrapped__.calls_counter, 4)
+            self.assertEqual(square(5), 25)
+            self.assertEqual(square.__wrapped__.calls_counter, 4)
+            square.flush()
+        squares[0].cache_db.close()
+        squares[1].close()
+        squares[2].persistent.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
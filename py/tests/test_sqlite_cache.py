@@ -1,22 +1,38 @@
+import gc
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import get_sqlite_cache_fullpath, sqlite_cache
+from utils import SQLITE_FLUSHER, get_sqlite_cache_fullpath, sqlite_cache
 
 
 class MyTestCase(unittest.TestCase):
     
-    def __init_cached_function(self, key_to_str=None):
-        db_path = get_sqlite_cache_fullpath("foo")
-        if os.path.isfile(db_path):
-            os.remove(db_path)
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.functions = []
         
-        @sqlite_cache(value_to_str=str, str_to_value=float, key_to_str=key_to_str)
+    def tearDown(self):
+        for foo in self.functions:
+            foo.close()
+        self.tmpdir.cleanup()
+    
+    def __init_cached_function(self, key_to_str=None, **kwargs):
+        # connections of earlier tests may still be open (e.g. by their committing
+        # threads), so every test uses its own db
+        self.db_path = os.path.join(self.tmpdir.name, os.path.basename(get_sqlite_cache_fullpath("foo")))
+        
+        @sqlite_cache(value_to_str=str, str_to_value=float, key_to_str=key_to_str, db_path=self.db_path, **kwargs)
         def foo(x, y, z) -> float:
             foo.calls_counter += 1
             return (x + y) * z
         
         foo.calls_counter = 0
+        self.functions.append(foo)
         return foo
     
     def test_not_entering_original_funcion_twice(self):
@@ -48,6 +64,138 @@ class MyTestCase(unittest.TestCase):
         
         self.assertEqual(foo.calls_counter, 1)
 
+    def test_cache_get_and_put(self):
+        foo = self.__init_cached_function()
+        self.assertIsNone(foo.cache_get(1, 2, 3))
+        
+        foo.cache_put(42.0, 1, 2, 3)
+        self.assertEqual(foo.cache_get(1, 2, 3), 42.0)
+        # the value that was put is returned without calling the function
+        self.assertEqual(foo(1, 2, 3), 42.0)
+        self.assertEqual(foo.calls_counter, 0)
+        
+        foo(2, 2, 2)
+        self.assertEqual(foo.cache_get(2, 2, 2), 8.0)
+
+        foo.cache_delete(2, 2, 2)
+        self.assertIsNone(foo.cache_get(2, 2, 2))
+        foo.cache_delete(5, 5, 5)  # not cached
+
+    def test_get_many(self):
+        foo = self.__init_cached_function()
+        foo(1, 1, 1)
+        foo.cache_put(42.0, 2, 2, 2)
+        
+        args_list = [(x, 1, 1) for x in range(1000)] + [(2, 2, 2), (3, 1, 1)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = foo.get_many(args_list, executor=executor)
+        self.assertEqual(results, [float(x + 1) for x in range(1000)] + [42.0, 4.0])
+        # only the misses were computed, once each
+        self.assertEqual(foo.calls_counter, 1 + 999)
+        
+        # the computed results were cached
+        self.assertEqual(foo.cache_get(500, 1, 1), 501.0)
+        self.assertEqual(foo.get_many(args_list), results)
+        self.assertEqual(foo.calls_counter, 1000)
+        self.assertEqual(foo.cache_get_many([(7, 1, 1), (7, 7, 7)]), [8.0, None])
+        
+        foo.cache_put_many([1.5, 2.5], [(7, 7, 7), (8, 8, 8)])
+        self.assertEqual(foo.cache_get_many([(7, 7, 7), (8, 8, 8)]), [1.5, 2.5])
+        self.assertEqual(foo.get_many([]), [])
+
+
+    def test_group_commit(self):
+        foo = self.__init_cached_function(commit_every=10, commit_interval=60)
+        
+        def committed_rows() -> int:
+            with sqlite3.connect(self.db_path) as conn:
+                return conn.execute("select count(*) from foo").fetchone()[0]
+        
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        for x in range(9):
+            foo(x, 0, 1)
+        # the writes are pending, but are seen by lookups
+        self.assertEqual(committed_rows(), 0)
+        self.assertEqual(foo.cache_get(3, 0, 1), 3.0)
+        foo(9, 0, 1)
+        self.assertEqual(committed_rows(), 10)
+        
+        foo(10, 0, 1)
+        foo.flush()
+        self.assertEqual(committed_rows(), 11)
+        
+        foo = self.__init_cached_function(commit_interval=0.01)
+        foo(11, 0, 1)
+        deadline = time.time() + 5
+        while committed_rows() < 12 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(committed_rows(), 12)
+    
+    def test_close(self):
+        registered = len(SQLITE_FLUSHER)
+        foo = self.__init_cached_function(commit_interval=60)
+        self.assertEqual(len(SQLITE_FLUSHER), registered + 1)
+        
+        def call_in_thread():
+            foo(2, 0, 1)
+        
+        foo(1, 0, 1)
+        thread = threading.Thread(target=call_in_thread)
+        thread.start()
+        thread.join()
+        foo.close()
+        # the pending writes were committed, and the connections of all threads closed
+        self.assertEqual(len(SQLITE_FLUSHER), registered)
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute("select count(*) from foo").fetchone()[0], 2)
+    
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc to count open files")
+    def test_connections_of_exited_threads_are_closed(self):
+        foo = self.__init_cached_function(commit_interval=60)
+        foo(1, 0, 1)
+        
+        def open_files() -> int:
+            paths = []
+            for fd in os.listdir("/proc/self/fd"):
+                try:
+                    paths.append(os.readlink(f"/proc/self/fd/{fd}"))
+                except OSError:
+                    pass  # closed in the meantime
+            return sum(path.startswith(self.db_path) for path in paths)
+        
+        open_before = open_files()
+        # e.g. the threads of short-lived executors
+        threads = [threading.Thread(target=foo, args=(x, 0, 1)) for x in range(20)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        gc.collect()
+        # sqlite defers closing the file of a closed connection while another
+        # connection of the process holds a lock on it (a single file here)
+        self.assertLessEqual(open_files(), open_before + 1)
+    
+    def test_concurrent_calls(self):
+        foo = self.__init_cached_function(commit_every=50)
+        errors = []
+        
+        def call_many(offset):
+            try:
+                for x in range(200):
+                    self.assertEqual(foo(x + offset, 1, 1), float(x + offset + 1))
+            except Exception as e:
+                errors.append(e)
+        
+        threads = [threading.Thread(target=call_many, args=(i * 200,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(foo.calls_counter, 1600)
+        self.assertEqual(foo.get_many([(x, 1, 1) for x in range(1600)]), [float(x + 1) for x in range(1600)])
+        self.assertEqual(foo.calls_counter, 1600)
+
 
 if __name__ == '__main__':
     unittest.main()
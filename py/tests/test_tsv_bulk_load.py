@@ -0,0 +1,89 @@
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+
+from cache_codecs import TXID_FLOAT64_CODEC, convert_leveldb_format
+from tsv_bulk_load import external_sort, load_into_leveldb, load_into_sqlite, read_tsv_rows
+from utils import leveldb_cache, sqlite_cache
+
+TXIDS = [f"{random.getrandbits(256):064x}" for _ in range(1000)]
+
+
+class TsvBulkLoadTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # every tx is in one of 10 block files, in no particular order
+        self.expected = {txid: str(i / 7) for i, txid in enumerate(TXIDS)}
+        self.paths = []
+        for block in range(10):
+            path = os.path.join(self.tmpdir.name, f"block_{block}_feerates.tsv")
+            with open(path, mode="w") as f:
+                for txid in TXIDS[block::10]:
+                    f.write(f"{txid}\t{self.expected[txid]}\n")
+            self.paths.append(path)
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def sorted_rows(self):
+        return external_sort(read_tsv_rows(self.paths), max_rows_in_memory=150, tmpdir=self.tmpdir.name)
+    
+    def get_cached_function(self, cache, **kwargs):
+        @cache(value_to_str=str, str_to_value=float, **kwargs)
+        def get_tx_feerate(txid: str) -> float:
+            raise AssertionError("not cached")
+        
+        return get_tx_feerate
+    
+    def test_external_sort(self):
+        # a duplicate row, as of a tx that was dumped in two blocks
+        rows = list(read_tsv_rows(self.paths)) + [(TXIDS[0], "0.0")]
+        sorted_rows = list(external_sort(rows, max_rows_in_memory=150, tmpdir=self.tmpdir.name))
+        self.assertEqual(sorted_rows, sorted(self.expected.items()))
+        # the sorted runs are removed
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), sorted(os.path.basename(p) for p in self.paths))
+        # everything fits in memory
+        self.assertEqual(list(external_sort(rows)), sorted_rows)
+    
+    def test_leveldb(self):
+        db_path = os.path.join(self.tmpdir.name, "leveldb")
+        self.assertEqual(load_into_leveldb(self.sorted_rows(), db_path, batch_size=64), len(TXIDS))
+        get_tx_feerate = self.get_cached_function(leveldb_cache, db_path=db_path)
+        self.assertEqual(get_tx_feerate.get_many([(txid,) for txid in TXIDS]), [float(i / 7) for i in range(1000)])
+        get_tx_feerate.cache_db.close()
+        
+        # a binary db is loaded in binary
+        convert_leveldb_format(db_path, str, float, TXID_FLOAT64_CODEC, to_binary=True)
+        with self.assertRaises(ValueError):
+            load_into_leveldb(self.sorted_rows(), db_path)
+        load_into_leveldb(self.sorted_rows(), db_path, str_to_value=float, binary_codec=TXID_FLOAT64_CODEC)
+        get_tx_feerate = self.get_cached_function(leveldb_cache, db_path=db_path, binary_codec=TXID_FLOAT64_CODEC)
+        self.assertEqual(get_tx_feerate(TXIDS[5]), 5 / 7)
+        get_tx_feerate.cache_db.close()
+    
+    def test_sqlite(self):
+        db_path = os.path.join(self.tmpdir.name, "cache.sqlite")
+        self.assertEqual(load_into_sqlite(self.sorted_rows(), db_path, table="get_tx_feerate"), len(TXIDS))
+        conn = sqlite3.connect(db_path)
+        plan = conn.execute("EXPLAIN QUERY PLAN select output from get_tx_feerate where input='a'").fetchall()
+        self.assertIn("get_tx_feerate_input", str(plan))
+        conn.close()
+        
+        get_tx_feerate = self.get_cached_function(sqlite_cache, db_path=db_path)
+        self.assertEqual(get_tx_feerate(TXIDS[5]), 5 / 7)
+        # the cache keeps working with the loaded table
+        get_tx_feerate.cache_put(1.5, TXIDS[5])
+        self.assertEqual(get_tx_feerate.cache_get(TXIDS[5]), 1.5)
+        get_tx_feerate.close()
+        # loading again replaces the rows
+        load_into_sqlite(self.sorted_rows(), db_path, table="get_tx_feerate")
+        conn = sqlite3.connect(db_path)
+        self.assertEqual(conn.execute("select count(*) from get_tx_feerate").fetchone()[0], len(TXIDS))
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
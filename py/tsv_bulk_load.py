@@ -0,0 +1,204 @@
+import heapq
+import os
+import sqlite3
+import tempfile
+import time
+from logging import Logger
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+import plyvel
+
+from cache_codecs import BINARY_FORMAT, BinaryCodec, FORMAT_KEY
+
+"""
+Bulk loading of the tsv files dumped by dump_feerates_to_tsv.py / dump_tx_weights_to_tsv.py
+(a "key<TAB>value" line per tx) into the caches of get_tx_feerate / get_tx_weight.
+
+The rows of all files are sorted by an external merge sort: sorted runs of at most
+max_rows_in_memory rows are written to temporary files, and then merged. the
+sorted rows are written to the db in order:
+- leveldb: in large batches of consecutive keys, so the tables written from the
+  memtable don't overlap, and compaction has little to do
+- sqlite: in a single transaction into a table without an index, which is built
+  once all rows are in (if the table is new)
+"""
+
+TSV_SEPARATOR = "\t"
+
+# number of rows sorted in memory at once. a row of a txid and a feerate takes a few
+# hundred bytes in memory, so this is about 1GB
+SORT_MAX_ROWS_IN_MEMORY = 4_000_000
+
+# rows written to the db in a single batch
+LOAD_BATCH_SIZE = 100_000
+
+# the write buffer of a leveldb while it is loaded (the default is 4MB)
+LOAD_WRITE_BUFFER_SIZE = 128 * 2 ** 20
+
+# seconds between progress logs
+PROGRESS_LOG_INTERVAL = 10
+
+Row = Tuple[str, str]
+
+
+def read_tsv_rows(paths: Iterable[str], separator: str = TSV_SEPARATOR) -> Iterator[Row]:
+    """
+    yield the (key, value) rows of the given tsv files, in the order of the files
+    """
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line:
+                    key, value = line.split(separator, 1)
+                    yield key, value
+
+
+def __write_run(rows: List[Row], directory: str, index: int) -> str:
+    path = os.path.join(directory, f"run_{index}.tsv")
+    with open(path, mode="w") as f:
+        f.writelines(f"{key}{TSV_SEPARATOR}{value}\n" for key, value in rows)
+    return path
+
+
+def external_sort(
+    rows: Iterable[Row],
+    max_rows_in_memory: int = SORT_MAX_ROWS_IN_MEMORY,
+    tmpdir: str = None,
+) -> Iterator[Row]:
+    """
+    yield the given rows sorted by key, keeping at most max_rows_in_memory of them in
+    memory. rows with a key that was already yielded are dropped.
+    the sorted runs are written to a temporary directory in tmpdir (the system
+    default if None), which is removed once the rows are consumed
+    """
+    with tempfile.TemporaryDirectory(prefix="tsv_sort_", dir=tmpdir) as directory:
+        runs = []
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= max_rows_in_memory:
+                chunk.sort()
+                runs.append(__write_run(chunk, directory, len(runs)))
+                chunk = []
+        chunk.sort()
+        if runs:
+            if chunk:
+                runs.append(__write_run(chunk, directory, len(runs)))
+            chunk = []
+            merged = heapq.merge(*[read_tsv_rows([run]) for run in runs])
+        else:
+            # everything fit in memory
+            merged = iter(chunk)
+        
+        prev_key = None
+        for key, value in merged:
+            if key != prev_key:
+                yield key, value
+                prev_key = key
+
+
+class __Progress:
+    """
+    log the number of rows loaded so far, and the rate, every PROGRESS_LOG_INTERVAL seconds
+    """
+    
+    def __init__(self, logger: Logger) -> None:
+        self.logger = logger
+        self.t0 = time.time()
+        self.last_log = self.t0
+        self.rows = 0
+    
+    def add(self, rows: int) -> None:
+        self.rows += rows
+        if time.time() - self.last_log >= PROGRESS_LOG_INTERVAL:
+            self.log()
+    
+    def log(self) -> None:
+        self.last_log = time.time()
+        if self.logger is not None:
+            rate = round(self.rows / max(self.last_log - self.t0, 1e-9))
+            self.logger.info(f"loaded {self.rows} rows ({rate} rows/sec)")
+
+
+def __batches(rows: Iterable[Row], batch_size: int) -> Iterator[List[Row]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_into_leveldb(
+    sorted_rows: Iterable[Row],
+    db_path: str,
+    str_to_value: Callable[[str], Any] = None,
+    binary_codec: BinaryCodec = None,
+    batch_size: int = LOAD_BATCH_SIZE,
+    logger: Logger = None,
+) -> int:
+    """
+    write rows, sorted by key, into the leveldb of a leveldb_cache decorated function,
+    and return the number of rows written. rows are written as is to a db in text
+    format. if the db is in binary format, they are converted with str_to_value and
+    binary_codec (a hex txid key sorts the same as its bytes, so the order holds).
+    the db must not be open by anyone else
+    """
+    db = plyvel.DB(db_path, create_if_missing=True, write_buffer_size=LOAD_WRITE_BUFFER_SIZE)
+    try:
+        binary = db.get(FORMAT_KEY) == BINARY_FORMAT
+        if binary and (binary_codec is None or str_to_value is None):
+            raise ValueError(f"the leveldb at {db_path} is in binary format, but no binary codec was given")
+        progress = __Progress(logger)
+        for batch in __batches(sorted_rows, batch_size):
+            with db.write_batch() as wb:
+                for key, value in batch:
+                    if binary:
+                        wb.put(binary_codec.str_key_to_bytes(key), binary_codec.value_to_bytes(str_to_value(value)))
+                    else:
+                        wb.put(key.encode("utf-8"), value.encode("utf-8"))
+            progress.add(len(batch))
+        progress.log()
+        return progress.rows
+    finally:
+        db.close()
+
+
+def load_into_sqlite(
+    sorted_rows: Iterable[Row],
+    db_path: str,
+    table: str,
+    batch_size: int = LOAD_BATCH_SIZE,
+    logger: Logger = None,
+) -> int:
+    """
+    write rows, sorted by key, into the table of a sqlite_cache decorated function,
+    in a single transaction, and return the number of rows written.
+    a new table is created without an index, and its unique index on the key is built
+    after all rows are in (sqlite_cache uses it as is)
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        # it's only a cache. if we crash, load it again
+        conn.execute("PRAGMA synchronous=OFF")
+        new_table = conn.execute(
+            "select count(*) from sqlite_master where type='table' and name=(?)", (table,),
+        ).fetchone()[0] == 0
+        progress = __Progress(logger)
+        with conn:
+            if new_table:
+                conn.execute(f"CREATE TABLE {table} (input TEXT, output TEXT)")
+            for batch in __batches(sorted_rows, batch_size):
+                conn.executemany(f"INSERT OR REPLACE INTO {table} (input, output) values (?, ?)", batch)
+                progress.add(len(batch))
+            if new_table:
+                if logger is not None:
+                    logger.info(f"building the index of {table}")
+                conn.execute(f"CREATE UNIQUE INDEX {table}_input ON {table} (input)")
+        progress.log()
+        return progress.rows
+    finally:
+        conn.close()
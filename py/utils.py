@@ -1,18 +1,34 @@
+import atexit
 import json
 import logging
 import os
+import shutil
+import signal
 import sqlite3
 import sys
+import tempfile
+import threading
 import time
+import weakref
+from concurrent.futures import Executor
 from datetime import datetime
 from functools import wraps
 from logging import Logger
-from typing import Any, Callable
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import plyvel
 
+from cache_codecs import BINARY_FORMAT, BinaryCodec, FORMAT_KEY
+from cache_eviction import EvictionPolicy, LRU, METADATA_PREFIX
+from cache_server import RemoteDB, connect_to_cache_server, leveldb_get_many
 from datatypes import Json
+from instrumentation import METRICS
+from memory_cache import MISSING, MemoryCache
 from paths import CACHES_DIR
+from shared_store import (
+    DEFAULT_SHARED_STORE_PATH, Namespace, RootDB, SHARED_LRU_CACHE_SIZE, SHARED_WRITE_BUFFER_SIZE, namespace_prefix,
+)
+from single_flight import SingleFlight
 
 
 def print_json(o: Json):
@@ -105,27 +121,390 @@ def get_db_str_key(*args, **kwargs) -> str:
     return ",".join(args_str + kwargs_str)
 
 
+# max number of parameters in a single sqlite query (the limit of old sqlite versions is 999)
+SQLITE_MAX_VARIABLES = 900
+
+# default group commit thresholds of sqlite_cache: commit the pending writes once
+# there are that many, or that many seconds after the first of them
+SQLITE_COMMIT_EVERY = 1000
+SQLITE_COMMIT_INTERVAL = 0.1  # seconds
+
+# seconds a connection waits for a lock held by another connection (e.g. another process)
+SQLITE_BUSY_TIMEOUT = 30
+
+# default capacity of the in-memory tier of two_tier_cache
+L1_MAX_ENTRIES = 100_000
+
+# number of entries read from the persistent tier at once when warming up the memory tier
+L1_WARM_UP_CHUNK = 10_000
+
+
+def __call_many(func: Callable, args_list: Sequence[Tuple], executor: Executor = None) -> List[Any]:
+    """
+    return [func(*args) for args in args_list], computed concurrently if an executor is given
+    """
+    if executor is None:
+        return [func(*args) for args in args_list]
+    return list(executor.map(lambda args: func(*args), args_list))
+
+
+def __get_many(
+    args_list: Iterable[Tuple],
+    cache_get_many: Callable[[Sequence[Tuple]], List[Any]],
+    cache_put_many: Callable[[Sequence[Any], Sequence[Tuple]], None],
+    func: Callable,
+    executor: Executor = None,
+) -> List[Any]:
+    """
+    the get_many method of the cache decorators: look up all args in the cache at once,
+    compute the misses (once per distinct args), and cache their results at once
+    """
+    args_list = [tuple(args) for args in args_list]
+    cached = cache_get_many(args_list)
+    missing = list(dict.fromkeys(args for args, value in zip(args_list, cached) if value is None))
+    if not missing:
+        return cached
+    
+    values = __call_many(func, missing, executor=executor)
+    cache_put_many(values, missing)
+    computed = dict(zip(missing, values))
+    return [computed[args] if value is None else value for args, value in zip(args_list, cached)]
+
+
+def uncached(func: Callable) -> Callable:
+    """
+    return a wrapper of func with the cache_get/cache_put interface of the cache
+    decorators, that doesn't cache anything.
+    used when a cache can't be opened
+    """
+    
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    
+    wrapper.cache_get = lambda *args, **kwargs: None
+    wrapper.cache_put = lambda value, *args, **kwargs: None
+    wrapper.cache_delete = lambda *args, **kwargs: None
+    wrapper.cache_get_many = lambda args_list: [None for _ in args_list]
+    wrapper.cache_put_many = lambda values, args_list: None
+    wrapper.get_many = lambda args_list, executor=None: __call_many(
+        func, [tuple(args) for args in args_list], executor=executor,
+    )
+    wrapper.bulk_population = lambda **kwargs: bulk_population(wrapper, **kwargs)
+    wrapper.flush = lambda: None
+    wrapper.close = lambda: None
+    wrapper.eviction_policy = None
+    return wrapper
+
+
 def get_leveldb_cache_fullpath(func_name: str) -> str:
     return os.path.join(CACHES_DIR, f"{func_name}_py_function_leveldb")
 
 
+# number of times to try snapshotting a db whose files change while they are copied
+SNAPSHOT_ATTEMPTS = 3
+
+
+def open_leveldb_snapshot(db_path: str, **options) -> plyvel.DB:
+    """
+    open a private copy of the leveldb at db_path, which may be open (and locked) by
+    another process. the copy is deleted when the interpreter exits, so anything
+    written to it is lost.
+    
+    the table files of a leveldb are immutable, so they are hard linked (copied, if
+    they can't be linked) rather than copied. the rest of the files are small. a
+    compaction in the owning process may delete tables while they are linked, in
+    which case the copy is inconsistent and we try again
+    """
+    if not os.path.isdir(db_path):
+        raise FileNotFoundError(f"no leveldb at {db_path}")
+    tmpdir = tempfile.mkdtemp(prefix="leveldb_snapshot_")
+    atexit.register(shutil.rmtree, tmpdir, True)
+    error = None
+    for attempt in range(SNAPSHOT_ATTEMPTS):
+        snapshot_path = os.path.join(tmpdir, str(attempt))
+        os.mkdir(snapshot_path)
+        try:
+            for filename in os.listdir(db_path):
+                if filename == "LOCK":
+                    continue
+                src = os.path.join(db_path, filename)
+                dst = os.path.join(snapshot_path, filename)
+                if filename.endswith((".ldb", ".sst")):
+                    try:
+                        os.link(src, dst)
+                        continue
+                    except FileNotFoundError:
+                        raise
+                    except OSError:
+                        pass  # e.g. tmpdir is on another file system
+                shutil.copy2(src, dst)
+            return plyvel.DB(snapshot_path, **options)
+        except (FileNotFoundError, plyvel.Error) as e:
+            error = e
+            shutil.rmtree(snapshot_path, ignore_errors=True)
+    raise error
+
+
+def open_leveldb(db_path: str, description: str, **options) -> Optional[RootDB]:
+    """
+    open the leveldb at db_path (creating it if it doesn't exist) for a cache: through
+    the cache server if it is running, otherwise directly, and if the db is locked by
+    another process, a snapshot of it.
+    return None if the db can't be opened. options are passed to plyvel.DB
+    """
+    # if a cache server is running, it owns the db (see cache_server)
+    db = connect_to_cache_server(db_path)
+    if db is not None:
+        return db
+    try:
+        return plyvel.DB(db_path, create_if_missing=True, **options)
+    except plyvel.IOError as e:
+        # most likely the db is locked by another process. read a snapshot of it
+        try:
+            db = open_leveldb_snapshot(db_path, **options)
+        except (OSError, plyvel.Error):
+            print(
+                f"WARNING: leveldb_cache: IOERROR occurred when trying to open leveldb "
+                f"for {description}. function will NOT be cached. "
+                f"Error: {type(e)}: {str(e)}",
+                file=sys.stderr,
+            )
+            return None
+        print(
+            f"WARNING: leveldb_cache: failed to open leveldb for {description} "
+            f"({type(e)}: {str(e)}). using a snapshot of it instead. results computed by "
+            f"this process will NOT be saved. run a cache server to share the db",
+            file=sys.stderr,
+        )
+        return db
+
+
+# options of the shared stores opened by this process, by path (see shared_store)
+SHARED_STORE_OPTIONS = {
+    "lru_cache_size": SHARED_LRU_CACHE_SIZE,
+    "write_buffer_size": SHARED_WRITE_BUFFER_SIZE,
+}
+__shared_stores: Dict[str, Optional[RootDB]] = {}
+__shared_stores_lock = threading.Lock()
+
+
+def set_shared_store_options(lru_cache_size: int = None, write_buffer_size: int = None) -> None:
+    """
+    set the size of the block cache and the write buffer of the shared store (see
+    shared_store), for all the functions in it. affects stores opened afterwards,
+    i.e. call it before importing modules with shared caches
+    """
+    if lru_cache_size is not None:
+        SHARED_STORE_OPTIONS["lru_cache_size"] = lru_cache_size
+    if write_buffer_size is not None:
+        SHARED_STORE_OPTIONS["write_buffer_size"] = write_buffer_size
+
+
+def open_shared_store(db_path: str = None) -> Optional[RootDB]:
+    """
+    return the shared store at db_path (DEFAULT_SHARED_STORE_PATH if None), which is
+    opened once per process. return None if it can't be opened
+    """
+    db_path = db_path if db_path else DEFAULT_SHARED_STORE_PATH
+    with __shared_stores_lock:
+        db = __shared_stores.get(db_path)
+        if db is None or db.closed:
+            db = open_leveldb(db_path, description="the shared store", **SHARED_STORE_OPTIONS)
+            __shared_stores[db_path] = db
+        return db
+
+
+# default thresholds of bulk population: flush after that many pending writes, or
+# after that many seconds since the last flush, whichever comes first
+BULK_MAX_PENDING = 100_000
+BULK_MAX_DELAY = 10  # seconds
+
+
+class LevelDBWriteBuffer:
+    """
+    Buffer the writes (puts and deletes) to the caches of leveldb_cache decorated
+    functions, and write them in batches (a plyvel WriteBatch per db), instead of a
+    synchronous db.put per cache miss.
+    
+    Lookups in the caches read the pending writes first, so the functions keep
+    working (and keep hitting the cache) during population.
+    
+    The writes are flushed when max_pending writes are pending, every max_delay
+    seconds (by a background thread), on flush(), and when the buffer is closed.
+    A buffer is used as a context manager (see bulk_population), which is closed
+    also on KeyboardInterrupt, SIGTERM and interpreter exit.
+    
+    The dbs are written in the order their functions were given. if the cache of
+    one function marks work whose results are in the caches of other functions
+    (e.g. populate_block), give it last, so the mark never makes it to disk before
+    the results
+    """
+    
+    def __init__(
+        self,
+        funcs: List[Callable],
+        max_pending: int = BULK_MAX_PENDING,
+        max_delay: float = BULK_MAX_DELAY,
+    ) -> None:
+        # functions that couldn't open their db (see uncached) aren't buffered
+        self.funcs = [func for func in funcs if hasattr(func, "cache_db")]
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.flushes = 0
+        
+        self.__pending: Dict[plyvel.DB, Dict[bytes, Optional[bytes]]] = {
+            func.cache_db: {} for func in self.funcs
+        }
+        self.__num_pending = 0
+        self.__lock = threading.RLock()
+        self.__closed = threading.Event()
+        self.__flusher: Optional[threading.Thread] = None
+        self.__prev_sigterm_handler = None
+    
+    def get(self, db: plyvel.DB, key: bytes) -> Optional[bytes]:
+        """
+        return the value of key in db: the pending one if there is, and otherwise
+        the one on disk. return None if it doesn't exist (or is pending deletion)
+        """
+        with self.__lock:
+            pending = self.__pending[db]
+            if key in pending:
+                return pending[key]
+        return db.get(key)
+    
+    def get_pending(self, db: plyvel.DB, keys: Iterable[bytes]) -> Dict[bytes, Optional[bytes]]:
+        """
+        return the pending writes to the given keys in db (None for a pending delete)
+        """
+        with self.__lock:
+            pending = self.__pending[db]
+            return {key: pending[key] for key in keys if key in pending}
+    
+    def put(self, db: plyvel.DB, key: bytes, value: Optional[bytes]) -> None:
+        """
+        write value to key in db (or delete key, if value is None)
+        """
+        with self.__lock:
+            if self.__closed.is_set():
+                # a write that raced with close
+                if value is None:
+                    db.delete(key)
+                else:
+                    db.put(key, value)
+                return
+            self.__pending[db][key] = value
+            self.__num_pending += 1
+            if self.__num_pending >= self.max_pending:
+                self.flush()
+    
+    def flush(self) -> None:
+        with self.__lock:
+            if self.__num_pending == 0:
+                return
+            # the writes to namespaces of the same shared store (see shared_store)
+            # are written in a single batch, so they are atomic
+            batches: Dict[Union[RootDB, Namespace], List[Tuple[bytes, Optional[bytes]]]] = {}
+            for db, pending in self.__pending.items():
+                root, prefix = (db.root, db.prefix) if isinstance(db, Namespace) else (db, b"")
+                batches.setdefault(root, []).extend((prefix + key, value) for key, value in pending.items())
+                pending.clear()
+            for db, items in batches.items():
+                with db.write_batch() as wb:
+                    for key, value in items:
+                        if value is None:
+                            wb.delete(key)
+                        else:
+                            wb.put(key, value)
+            self.__num_pending = 0
+            self.flushes += 1
+    
+    def __flush_periodically(self) -> None:
+        while not self.__closed.wait(self.max_delay):
+            self.flush()
+    
+    def __on_sigterm(self, signum, frame) -> None:
+        # exit as on KeyboardInterrupt, so the buffer is flushed on the way out
+        raise SystemExit(128 + signum)
+    
+    def open(self) -> "LevelDBWriteBuffer":
+        for func in self.funcs:
+            func.write_buffer = self
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread():
+            self.__prev_sigterm_handler = signal.signal(signal.SIGTERM, self.__on_sigterm)
+        self.__flusher = threading.Thread(target=self.__flush_periodically, daemon=True)
+        self.__flusher.start()
+        return self
+    
+    def close(self) -> None:
+        """
+        flush the pending writes, and write directly to the dbs from now on
+        """
+        if self.__closed.is_set():
+            return
+        self.__closed.set()
+        with self.__lock:
+            self.flush()
+            for func in self.funcs:
+                func.write_buffer = None
+        atexit.unregister(self.close)
+        if self.__prev_sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, self.__prev_sigterm_handler)
+    
+    def __enter__(self) -> "LevelDBWriteBuffer":
+        return self.open()
+    
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+def bulk_population(
+    *funcs: Callable,
+    max_pending: int = BULK_MAX_PENDING,
+    max_delay: float = BULK_MAX_DELAY,
+) -> LevelDBWriteBuffer:
+    """
+    return a context manager in which the cache writes of the given leveldb_cache
+    decorated functions are buffered and written in batches. see LevelDBWriteBuffer.
+    
+    Usage example:
+    
+    with bulk_population(get_tx_feerate, get_tx_weight, populate_block) as buffer:
+        for h in blocks:
+            populate_block(h)
+    """
+    return LevelDBWriteBuffer(list(funcs), max_pending=max_pending, max_delay=max_delay)
+
+
 def leveldb_cache(
     value_to_str: Callable[[Any], str],
     str_to_value: Callable[[str], Any],
     key_to_str: Callable[..., str] = None,
     db_path: str = None,
-
+    binary_codec: BinaryCodec = None,
+    max_entries: int = None,
+    max_bytes: int = None,
+    eviction: str = LRU,
+    ttl: float = None,
+    shared: bool = False,
 ):
     """
     This decorator caches results of function calls in a LevelDB on disk.
-    The cache size is (currently) not configurable, and is unlimited.
+    The cache is unlimited, unless max_entries, max_bytes or ttl are given.
     
     Each DB entry is a pair of input/output, representing function arguments and
     the function result for these arguments. Both represented as strings.
     
     The decision to store only strings in the DB was made to allow other
     applications (specifically, not python) to open the DB and to be able to easily
-    parse and understand it.
+    parse and understand it. a db that no other application reads may be converted
+    to a compact binary format (see binary_codec).
+    
+    A leveldb can be opened by a single process. if a cache server is running (see
+    cache_server), the db is accessed through it, so any number of processes share
+    it. otherwise, if the db is locked by another process, a private snapshot of it
+    is used: lookups still hit, but new results aren't saved.
     
     Args:
         value_to_str: a callable that takes results of the cached function and return
@@ -141,8 +520,50 @@ def leveldb_cache(
                     or they will be considered equal
                     
         db_path: full path to the db file. if None (default) use a default one
+        
+        shared: if True, keep the cache in the namespace of the function in the shared
+                store (see shared_store), rather than in a db of its own. db_path is
+                then the path of the shared store
+        
+        binary_codec: the encoding of keys and values if the db is in binary format
+                      (see cache_codecs). the format is recorded in the db, and is
+                      text unless the db was converted with convert_cache_format.py
+        
+        max_entries, max_bytes: the max number of entries in the cache, and the max
+                                total size of their keys and values. None (default)
+                                for no limit
+        
+        eviction: which entries are evicted when the cache is full: "lru" (default)
+                  or "lfu". see cache_eviction
+        
+        ttl: seconds after which a cached result expires and is computed again.
+             None (default) for no expiration
+    
+    
+    The decorated function has two additional methods, to access the cache directly
+    (e.g. when results are computed in bulk by other means):
+        cache_get(*args, **kwargs): return the cached result for the given arguments,
+                                    or None if it isn't cached
+        cache_put(value, *args, **kwargs): cache `value` as the result for the given arguments
+        cache_delete(*args, **kwargs): remove the cached result for the given arguments, if exists
     
+    And methods to look up many arguments at once. each item of args_list is a
+    tuple of positional arguments:
+        get_many(args_list, executor=None): return the results for all items of
+                                            args_list. the cache is read in a single
+                                            pass, the results that aren't cached are
+                                            computed (concurrently, if an executor is
+                                            given) and written in a single batch
+        cache_get_many(args_list): return the cached results (or None) for all items
+        cache_put_many(values, args_list): cache values[i] as the result for args_list[i]
     
+    Concurrent calls with the same (uncached) arguments are computed once: the
+    other callers wait for the result. their number is in single_flight.coalesced.
+    
+    Writes may be buffered and batched when populating the cache in bulk (see
+    bulk_population). the function also has:
+        bulk_population(**kwargs): same as bulk_population(func, **kwargs)
+        flush(): write the buffered writes to the db, if there are any
     
     Usage examples:
     
@@ -162,32 +583,211 @@ def leveldb_cache(
         key_to_str = get_db_str_key
     
     def decorator(func):
-        try:
-            # TODO if we fail to open because the db is locked, go around it and
-            #  open it, just don't write in case new input/output arrive
+        if shared:
+            store = open_shared_store(db_path)
+            if store is None:
+                return uncached(func)
+            db = Namespace(store, namespace_prefix(func.__name__))
+            if (
+                isinstance(store, plyvel.DB)
+                and os.path.exists(get_leveldb_cache_fullpath(func.__name__))
+                and db.is_empty()
+            ):
+                print(
+                    f"WARNING: leveldb_cache: the cache of function `{func.__name__}` in the shared store "
+                    f"is empty, but it has a db of its own. migrate it with migrate_caches_to_shared_store.py",
+                    file=sys.stderr,
+                )
+        else:
             cache_fullpath = db_path if db_path else get_leveldb_cache_fullpath(func_name=func.__name__)
-            db = plyvel.DB(cache_fullpath, create_if_missing=True)
-        except plyvel.IOError as e:
+            db = open_leveldb(cache_fullpath, description=f"function `{func.__name__}`")
+            if db is None:
+                return uncached(func)
+        remote = isinstance(db.root if isinstance(db, Namespace) else db, RemoteDB)
+        
+        if db.get(FORMAT_KEY) == BINARY_FORMAT:
+            if binary_codec is None:
+                print(
+                    f"WARNING: leveldb_cache: the leveldb of function `{func.__name__}` is in "
+                    f"binary format, but the function has no binary codec. function will NOT be cached",
+                    file=sys.stderr,
+                )
+                db.close()
+                return uncached(func)
+            encode_key = binary_codec.key_to_bytes
+            encode_value = binary_codec.value_to_bytes
+            decode_value = binary_codec.bytes_to_value
+        else:
+            def encode_key(*args, **kwargs) -> bytes:
+                return key_to_str(*args, **kwargs).encode("utf-8")
+            
+            def encode_value(value: Any) -> bytes:
+                return value_to_str(value).encode("utf-8")
+            
+            def decode_value(value: bytes) -> Any:
+                return str_to_value(value.decode("utf-8"))
+        
+        policy = None
+        metadata_db = None
+        bounded = max_entries is not None or max_bytes is not None or ttl is not None
+        if bounded and remote:
             print(
-                f"WARNING: leveldb_cache: IOERROR occurred when trying to open leveldb "
-                f"for function `{func.__name__}`. function will NOT be cached. "
-                f"Error: {type(e)}: {str(e)}",
+                f"WARNING: leveldb_cache: the leveldb of function `{func.__name__}` is served by "
+                f"the cache server. its capacity limits and ttl are ignored",
                 file=sys.stderr,
             )
-            return func
+        elif bounded:
+            metadata_db = db.prefixed_db(METADATA_PREFIX)
+            policy = EvictionPolicy(max_entries=max_entries, max_bytes=max_bytes, eviction=eviction, ttl=ttl)
+            
+            def existing_entries() -> Iterable[Tuple[bytes, int, Optional[bytes]]]:
+                metadata = dict(metadata_db.iterator())
+                return (
+                    (key, len(key) + len(value), metadata.get(key))
+                    for key, value in db.iterator()
+                    if key != FORMAT_KEY and not key.startswith(METADATA_PREFIX)
+                )
+            
+            # scanning the db may take minutes, so it's left for the first lookup
+            policy.load_lazily(existing_entries)
+            atexit.register(lambda: db.closed or save_metadata(force=True))
+        
+        def save_metadata(force: bool = False) -> None:
+            if policy is None or not (force or policy.should_save()):
+                return
+            with metadata_db.write_batch() as wb:
+                for key, encoded in policy.take_dirty().items():
+                    if encoded is None:
+                        wb.delete(key)
+                    else:
+                        wb.put(key, encoded)
+        
+        def is_hit(db_key: bytes, value: Optional[bytes]) -> bool:
+            # an expired entry is a miss
+            return bool(value) and (policy is None or policy.on_hit(db_key))
+        
+        def db_get(db_key: bytes) -> Optional[bytes]:
+            t0 = time.perf_counter()
+            buffer: LevelDBWriteBuffer = wrapper.write_buffer
+            value = buffer.get(db, db_key) if buffer is not None else db.get(db_key)
+            hit = is_hit(db_key, value)
+            METRICS.record_cache_lookup(func.__name__, hit=hit, seconds=time.perf_counter() - t0)
+            if policy is not None:
+                save_metadata()
+            return value if hit else None
+        
+        def db_write(items: Sequence[Tuple[bytes, Optional[bytes]]]) -> None:
+            """
+            write the given (key, value) pairs to the db (a value of None deletes the key),
+            and evict entries if the cache is full
+            """
+            if policy is not None:
+                evicted = []
+                for db_key, value in items:
+                    if value is None:
+                        policy.on_delete(db_key)
+                    else:
+                        evicted.extend(policy.on_put(db_key, len(db_key) + len(value)))
+                items = list(items) + [(db_key, None) for db_key in evicted]
+            
+            buffer: LevelDBWriteBuffer = wrapper.write_buffer
+            if buffer is not None:
+                for db_key, value in items:
+                    buffer.put(db, db_key, value)
+            elif len(items) == 1 and items[0][1] is not None:
+                db.put(*items[0])
+            else:
+                with db.write_batch() as wb:
+                    for db_key, value in items:
+                        if value is None:
+                            wb.delete(db_key)
+                        else:
+                            wb.put(db_key, value)
+            if policy is not None:
+                save_metadata()
+        
+        def db_put(db_key: bytes, value: Optional[bytes]) -> None:
+            db_write([(db_key, value)])
+        
+        def db_get_many(db_keys: Sequence[bytes]) -> Dict[bytes, bytes]:
+            """
+            return the values of the given keys that exist, read in a single pass
+            (or a single request to the cache server)
+            """
+            t0 = time.perf_counter()
+            buffer: LevelDBWriteBuffer = wrapper.write_buffer
+            pending = buffer.get_pending(db, db_keys) if buffer is not None else {}
+            unread = [db_key for db_key in db_keys if db_key not in pending]
+            values = leveldb_get_many(db, unread) if isinstance(db, plyvel.DB) else db.get_many(unread)
+            values.update({db_key: value for db_key, value in pending.items() if value is not None})
+            values = {db_key: value for db_key, value in values.items() if is_hit(db_key, value)}
+            seconds = (time.perf_counter() - t0) / max(1, len(db_keys))
+            for db_key in db_keys:
+                METRICS.record_cache_lookup(func.__name__, hit=db_key in values, seconds=seconds)
+            if policy is not None:
+                save_metadata()
+            return values
+        
+        # concurrent misses of the same key are computed once
+        flight = SingleFlight(name=func.__name__)
         
         @wraps(func)
         def wrapper(*args, **kwargs):
-            db_key = key_to_str(*args, **kwargs).encode("utf-8")
-            value: bytes = db.get(db_key)
+            db_key = encode_key(*args, **kwargs)
+            value = db_get(db_key)
             if value:
-                return str_to_value(value.decode("utf-8"))
+                return decode_value(value)
             
-            value = func(*args, **kwargs)
+            def compute():
+                value = func(*args, **kwargs)
+                db_put(db_key, encode_value(value))
+                return value
             
-            db.put(db_key, value_to_str(value).encode("utf-8"))
-            return value
+            return flight.do(db_key, compute)
+        
+        def compute_many(*args) -> Any:
+            return flight.do(encode_key(*args), lambda: func(*args))
+        
+        def cache_get(*args, **kwargs) -> Any:
+            value = db_get(encode_key(*args, **kwargs))
+            return decode_value(value) if value else None
+        
+        def cache_put(value: Any, *args, **kwargs) -> None:
+            db_put(encode_key(*args, **kwargs), encode_value(value))
+        
+        def cache_delete(*args, **kwargs) -> None:
+            db_put(encode_key(*args, **kwargs), None)
+        
+        def cache_get_many(args_list: Sequence[Tuple]) -> List[Any]:
+            db_keys = [encode_key(*args) for args in args_list]
+            values = db_get_many(db_keys)
+            return [
+                decode_value(values[db_key]) if values.get(db_key) else None
+                for db_key in db_keys
+            ]
+        
+        def cache_put_many(values: Sequence[Any], args_list: Sequence[Tuple]) -> None:
+            db_write([(encode_key(*args), encode_value(value)) for value, args in zip(values, args_list)])
+        
+        def get_many(args_list: Iterable[Tuple], executor: Executor = None) -> List[Any]:
+            return __get_many(args_list, cache_get_many, cache_put_many, compute_many, executor=executor)
         
+        def flush() -> None:
+            if wrapper.write_buffer is not None:
+                wrapper.write_buffer.flush()
+        
+        wrapper.cache_get = cache_get
+        wrapper.cache_put = cache_put
+        wrapper.cache_delete = cache_delete
+        wrapper.cache_get_many = cache_get_many
+        wrapper.cache_put_many = cache_put_many
+        wrapper.get_many = get_many
+        wrapper.single_flight = flight
+        wrapper.cache_db = db
+        wrapper.eviction_policy = policy
+        wrapper.write_buffer = None
+        wrapper.bulk_population = lambda **kwargs: bulk_population(wrapper, **kwargs)
+        wrapper.flush = flush
         return wrapper
     
     return decorator
@@ -197,62 +797,511 @@ def get_sqlite_cache_fullpath(func_name: str) -> str:
     return os.path.join(CACHES_DIR, f"{func_name}_py_function_cache.sqlite")
 
 
+class PeriodicFlusher:
+    """
+    a single daemon thread that commits the pending writes of all open sqlite caches
+    (instead of a thread per cache), and commits them all at exit.
+    
+    a cache registers a function of `force`, which commits its pending writes if
+    they are due (or if force is True), and how often it should be called
+    """
+    
+    def __init__(self) -> None:
+        self.__flushes: Dict[int, Tuple[Callable[[bool], None], float]] = {}
+        self.__next_id = 0
+        self.__cond = threading.Condition()
+        self.__thread: Optional[threading.Thread] = None
+        atexit.register(self.flush_all)
+    
+    def __len__(self) -> int:
+        return len(self.__flushes)
+    
+    def register(self, flush: Callable[[bool], None], interval: float) -> int:
+        """
+        call flush(False) about every interval seconds, until unregistered with the
+        returned id
+        """
+        with self.__cond:
+            flush_id = self.__next_id
+            self.__next_id += 1
+            self.__flushes[flush_id] = (flush, interval)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+            # the interval may be shorter than the current one
+            self.__cond.notify()
+        return flush_id
+    
+    def unregister(self, flush_id: int) -> None:
+        with self.__cond:
+            self.__flushes.pop(flush_id, None)
+    
+    def __run(self) -> None:
+        while True:
+            with self.__cond:
+                interval = min((interval for _, interval in self.__flushes.values()), default=None)
+                self.__cond.wait(timeout=interval)
+                flushes = [flush for flush, _ in self.__flushes.values()]
+            for flush in flushes:
+                flush(False)
+    
+    def flush_all(self) -> None:
+        with self.__cond:
+            flushes = [flush for flush, _ in self.__flushes.values()]
+        for flush in flushes:
+            flush(True)
+
+
+SQLITE_FLUSHER = PeriodicFlusher()
+
+
+class ThreadConnection:
+    """
+    the sqlite connection of a single thread, kept in a threading.local. it is
+    closed when the thread exits (and the local drops it), or by close()
+    """
+    
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.close = weakref.finalize(self, conn.close)
+        # the pending writes are committed at exit (see PeriodicFlusher), so the
+        # connections must stay open until then
+        self.close.atexit = False
+
+
 def sqlite_cache(
     value_to_str: Callable[[Any], str],
     str_to_value: Callable[[str], Any],
     key_to_str: Callable[..., str] = None,
     db_path: str = None,
+    max_entries: int = None,
+    max_bytes: int = None,
+    eviction: str = LRU,
+    ttl: float = None,
+    commit_every: int = SQLITE_COMMIT_EVERY,
+    commit_interval: float = SQLITE_COMMIT_INTERVAL,
 ):
     """
     similar of leveldb_cache, only based on sqlite.
     see documentation of leveldb_cache
+    
+    the decorated function may be called from many threads: every thread has its
+    own connection, and the db is in WAL mode, so readers don't wait for writers.
+    writes are group-committed: they are kept in memory (where lookups see them)
+    and committed in a single transaction once commit_every of them are pending, or
+    commit_interval seconds after the first of them (by SQLITE_FLUSHER), and at
+    exit, on flush() or on close(). the cache must not be used after close()
     """
     
     if key_to_str is None:
         key_to_str = get_db_str_key
     
     def decorator(func):
+        table = func.__name__
+        # the access metadata of bounded caches (see cache_eviction)
+        metadata_table = f"{func.__name__}_access_metadata"
+        cache_fullpath = db_path if db_path else get_sqlite_cache_fullpath(func_name=func.__name__)
+        # the statements are the same for all calls, so sqlite3 prepares each of them
+        # once per connection
+        select_one = f"select output from {table} where input=(?)"
+        insert = f"INSERT OR REPLACE INTO {table} (input, output) values (?, ?)"
+        delete = f"DELETE FROM {table} where input=(?)"
+        local = threading.local()
+        # the connections of all live threads, closed by close()
+        connections: "weakref.WeakSet[ThreadConnection]" = weakref.WeakSet()
+        connections_lock = threading.Lock()
+        
+        def get_conn() -> sqlite3.Connection:
+            thread_connection = getattr(local, "connection", None)
+            if thread_connection is None:
+                # every connection is used by its own thread only, but may be closed by
+                # the thread that calls close(), or by the garbage collector
+                conn = sqlite3.connect(cache_fullpath, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                # with WAL, a commit is durable once the WAL is synced at a checkpoint
+                conn.execute("PRAGMA synchronous=NORMAL")
+                thread_connection = ThreadConnection(conn)
+                local.connection = thread_connection
+                with connections_lock:
+                    connections.add(thread_connection)
+            return thread_connection.conn
+        
         try:
-            cache_fullpath = (
-                db_path if db_path else get_sqlite_cache_fullpath(func_name=func.__name__)
-            )
-            conn = sqlite3.connect(cache_fullpath)
-            c = conn.cursor()
-            c.execute(
-                f"CREATE TABLE IF NOT EXISTS {func.__name__} "
+            conn = get_conn()
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
                 f"(input TEXT PRIMARY KEY, output TEXT);"
             )
+            conn.commit()
         except sqlite3.Error as e:
             print(
                 f"WARNING: sqlite_cache: ERROR occurred when trying to open sqlite db "
                 f"for function `{func.__name__}`. function will NOT be cached. Error: {e}",
                 file=sys.stderr,
             )
-            return func
+            return uncached(func)
+        
+        # writes that weren't committed yet (an output of None is a delete)
+        pending: Dict[str, Optional[str]] = {}
+        pending_since = [0.0]
+        lock = threading.RLock()
+        
+        policy = None
+        if max_entries is not None or max_bytes is not None or ttl is not None:
+            policy = EvictionPolicy(max_entries=max_entries, max_bytes=max_bytes, eviction=eviction, ttl=ttl)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {metadata_table} (input TEXT PRIMARY KEY, metadata BLOB);")
+            conn.commit()
+            
+            def existing_entries() -> Iterable[Tuple[str, int, Optional[bytes]]]:
+                conn = get_conn()
+                metadata = dict(conn.execute(f"select input, metadata from {metadata_table}").fetchall())
+                return (
+                    (db_key, size, metadata.get(db_key))
+                    for db_key, size in conn.execute(
+                        f"select input, length(input) + length(output) from {table}"
+                    ).fetchall()
+                )
+            
+            # scanning the table may take minutes, so it's left for the first lookup
+            policy.load_lazily(existing_entries)
+            
+        def flush() -> None:
+            """
+            commit the pending writes (and the access metadata) in a single transaction
+            """
+            with lock:
+                if not pending and (policy is None or not policy.should_save()):
+                    return
+                conn = get_conn()
+                with conn:
+                    conn.executemany(insert, [(db_key, output) for db_key, output in pending.items() if output is not None])
+                    conn.executemany(delete, [(db_key,) for db_key, output in pending.items() if output is None])
+                    if policy is not None:
+                        dirty = policy.take_dirty()
+                        conn.executemany(
+                            f"INSERT OR REPLACE INTO {metadata_table} (input, metadata) values (?, ?)",
+                            [(db_key, encoded) for db_key, encoded in dirty.items() if encoded is not None],
+                        )
+                        conn.executemany(
+                            f"DELETE FROM {metadata_table} where input=(?)",
+                            [(db_key,) for db_key, encoded in dirty.items() if encoded is None],
+                        )
+                pending.clear()
+        
+        def flush_or_warn(force: bool = True) -> None:
+            """
+            commit the pending writes, if force is True or the first of them is
+            commit_interval seconds old
+            """
+            if not force and not (pending and time.time() - pending_since[0] >= commit_interval):
+                return
+            try:
+                flush()
+            except sqlite3.Error as e:
+                # e.g. the db was removed. it's only a cache
+                print(f"WARNING: sqlite_cache: failed to commit the cache of `{func.__name__}`: {e}", file=sys.stderr)
+            
+        flusher_id = SQLITE_FLUSHER.register(flush_or_warn, interval=commit_interval)
+        
+        def close() -> None:
+            """
+            commit the pending writes, stop committing periodically, and close the
+            connections of all threads
+            """
+            SQLITE_FLUSHER.unregister(flusher_id)
+            flush_or_warn()
+            with connections_lock:
+                for thread_connection in list(connections):
+                    thread_connection.close()
+                connections.clear()
+        
+        def db_get_many(db_keys: Sequence[str]) -> Dict[str, str]:
+            """
+            return the outputs of the given keys that exist (and didn't expire)
+            """
+            distinct_keys = list(dict.fromkeys(db_keys))
+            t0 = time.perf_counter()
+            with lock:
+                pending_outputs = {db_key: pending[db_key] for db_key in distinct_keys if db_key in pending}
+            distinct_keys = [db_key for db_key in distinct_keys if db_key not in pending_outputs]
+            outputs = {}
+            conn = get_conn()
+            for i in range(0, len(distinct_keys), SQLITE_MAX_VARIABLES):
+                chunk = distinct_keys[i:i + SQLITE_MAX_VARIABLES]
+                res = conn.execute(
+                    f"select input, output from {table} "
+                    f"where input in ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                outputs.update(res.fetchall())
+            outputs.update({db_key: output for db_key, output in pending_outputs.items() if output is not None})
+            if policy is not None:
+                outputs = {db_key: output for db_key, output in outputs.items() if policy.on_hit(db_key)}
+            seconds = (time.perf_counter() - t0) / max(1, len(db_keys))
+            for db_key in db_keys:
+                METRICS.record_cache_lookup(func.__name__, hit=db_key in outputs, seconds=seconds)
+            return outputs
+        
+        def db_get(db_key: str) -> Optional[str]:
+            t0 = time.perf_counter()
+            with lock:
+                is_pending = db_key in pending
+                output = pending.get(db_key)
+            if not is_pending:
+                line = get_conn().execute(select_one, (db_key,)).fetchone()
+                output = line[0] if line else None
+            # an expired entry is a miss
+            hit = output is not None and (policy is None or policy.on_hit(db_key))
+            METRICS.record_cache_lookup(func.__name__, hit=hit, seconds=time.perf_counter() - t0)
+            return output if hit else None
+        
+        def db_write(items: Sequence[Tuple[str, Optional[str]]]) -> None:
+            """
+            write the given (key, output) pairs to the db (an output of None deletes the
+            key), and evict entries if the cache is full
+            """
+            with lock:
+                if not pending:
+                    pending_since[0] = time.time()
+                for db_key, output in items:
+                    pending[db_key] = output
+                    if policy is None:
+                        continue
+                    if output is None:
+                        policy.on_delete(db_key)
+                    else:
+                        for evicted in policy.on_put(db_key, len(db_key) + len(output)):
+                            pending[evicted] = None
+                if len(pending) >= commit_every:
+                    flush()
+        
+        # concurrent misses of the same key are computed once
+        flight = SingleFlight(name=func.__name__)
         
         @wraps(func)
         def wrapper(*args, **kwargs):
             db_key = key_to_str(*args, **kwargs)
-            res = c.execute(
-                f"select output from {func.__name__} where input=(?)",
-                (db_key,)
-            )
-            line = res.fetchone()
-            if line:
-                # key exists
-                serialized_value = line[0]
+            serialized_value = db_get(db_key)
+            if serialized_value is not None:
                 return str_to_value(serialized_value)
             
-            value = func(*args, **kwargs)
+            def compute():
+                value = func(*args, **kwargs)
+                db_write([(db_key, value_to_str(value))])
+                return value
             
-            c.execute(
-                F"INSERT INTO {func.__name__} (input, output) values (?, ?)",
-                (db_key, value_to_str(value)),
-            )
-            conn.commit()
+            return flight.do(db_key, compute)
+        
+        def compute_many(*args) -> Any:
+            return flight.do(key_to_str(*args), lambda: func(*args))
+        
+        def cache_get(*args, **kwargs) -> Any:
+            serialized_value = db_get(key_to_str(*args, **kwargs))
+            return str_to_value(serialized_value) if serialized_value is not None else None
+        
+        def cache_put(value: Any, *args, **kwargs) -> None:
+            db_write([(key_to_str(*args, **kwargs), value_to_str(value))])
+        
+        def cache_delete(*args, **kwargs) -> None:
+            db_write([(key_to_str(*args, **kwargs), None)])
+        
+        def cache_get_many(args_list: Sequence[Tuple]) -> List[Any]:
+            db_keys = [key_to_str(*args) for args in args_list]
+            outputs = db_get_many(db_keys)
+            return [str_to_value(outputs[db_key]) if db_key in outputs else None for db_key in db_keys]
+        
+        def cache_put_many(values: Sequence[Any], args_list: Sequence[Tuple]) -> None:
+            db_write([(key_to_str(*args), value_to_str(value)) for value, args in zip(values, args_list)])
+        
+        def get_many(args_list: Iterable[Tuple], executor: Executor = None) -> List[Any]:
+            return __get_many(args_list, cache_get_many, cache_put_many, compute_many, executor=executor)
+        
+        wrapper.cache_get = cache_get
+        wrapper.cache_put = cache_put
+        wrapper.cache_delete = cache_delete
+        wrapper.cache_get_many = cache_get_many
+        wrapper.cache_put_many = cache_put_many
+        wrapper.get_many = get_many
+        wrapper.single_flight = flight
+        wrapper.flush = flush
+        wrapper.close = close
+        wrapper.eviction_policy = policy
+        return wrapper
+    
+    return decorator
+
+
+def two_tier_cache(
+    persistent_cache: Callable[[Callable], Callable],
+    l1_max_entries: int = None,
+    l1_max_bytes: int = None,
+    l1_sizeof: Callable[[Any], int] = sys.getsizeof,
+    warm_up: Iterable[Tuple] = None,
+):
+    """
+    This decorator caches results of function calls in two tiers: a bounded in-memory
+    cache (L1, see memory_cache), in front of a persistent cache (L2) given as a
+    leveldb_cache or sqlite_cache decorator.
+    
+    The L1 is keyed by the arguments themselves, so an L1 hit doesn't build a db key,
+    and doesn't reach anything that decorates the function under the persistent cache
+    (e.g. timeit, which therefore logs only the calls that are actually computed).
+    
+    Args:
+        persistent_cache: the decorator of the L2, e.g. leveldb_cache(value_to_str=str, str_to_value=float)
+        
+        l1_max_entries, l1_max_bytes: the max number of entries in the L1, and the max
+                                      total size of their keys and values (as measured
+                                      by l1_sizeof). if both are None, the L1 is
+                                      limited to L1_MAX_ENTRIES entries
+        
+        warm_up: arguments (tuples of positional arguments) whose results are loaded
+                 from the L2 into the L1 when the function is decorated, as long as
+                 the L1 isn't full. results that aren't in the L2 aren't computed
+    
+    
+    The L1 tells apart positional and keyword arguments (as lru_cache does), so f(1)
+    and f(x=1) are cached in it separately. warm it up with the arguments the way the
+    function is called.
+    
+    The decorated function has the methods of the persistent cache (cache_get,
+    cache_put, cache_get_many, get_many, etc.), which go through the L1, and:
+        warm_up(args_list): load results of args_list from the L2 into the L1, and
+                            return the number of results loaded
+        tier_stats(): the hits and misses of each tier
+        persistent: the function decorated by persistent_cache. give it (rather
+                    than the two-tier function) to bulk_population
+    
+    Usage example:
+    
+    @two_tier_cache(leveldb_cache(value_to_str=str, str_to_value=float), l1_max_entries=10_000)
+    @timeit(logger=logger)
+    def foo(arg1: int, arg2: float) -> float:
+        ...
+    """
+    
+    if l1_max_entries is None and l1_max_bytes is None:
+        l1_max_entries = L1_MAX_ENTRIES
+    
+    def decorator(func):
+        persistent = persistent_cache(func)
+        l1 = MemoryCache(max_entries=l1_max_entries, max_bytes=l1_max_bytes, sizeof=l1_sizeof)
+        l2_stats = {"hits": 0, "misses": 0}
+        l2_stats_lock = threading.Lock()
+        flight = SingleFlight(name=func.__name__)
+        
+        def l1_key(args: Tuple, kwargs: Dict[str, Any]) -> Tuple:
+            return (args, tuple(sorted(kwargs.items()))) if kwargs else args
+        
+        def record_l2_lookups(hits: int, misses: int) -> None:
+            with l2_stats_lock:
+                l2_stats["hits"] += hits
+                l2_stats["misses"] += misses
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = l1_key(args, kwargs)
+            value = l1.get(key)
+            if value is not MISSING:
+                return value
+            
+            def compute():
+                value = persistent.cache_get(*args, **kwargs)
+                record_l2_lookups(hits=int(value is not None), misses=int(value is None))
+                if value is None:
+                    value = func(*args, **kwargs)
+                    persistent.cache_put(value, *args, **kwargs)
+                l1.put(key, value)
+                return value
             
+            # concurrent L1 misses of the same arguments go through the L2 once
+            return flight.do(key, compute)
+        
+        def compute_many(*args) -> Any:
+            return flight.do(args, lambda: func(*args))
+        
+        def cache_get(*args, **kwargs) -> Any:
+            key = l1_key(args, kwargs)
+            value = l1.get(key)
+            if value is not MISSING:
+                return value
+            value = persistent.cache_get(*args, **kwargs)
+            record_l2_lookups(hits=int(value is not None), misses=int(value is None))
+            if value is not None:
+                l1.put(key, value)
             return value
         
+        def cache_put(value: Any, *args, **kwargs) -> None:
+            persistent.cache_put(value, *args, **kwargs)
+            l1.put(l1_key(args, kwargs), value)
+        
+        def cache_delete(*args, **kwargs) -> None:
+            persistent.cache_delete(*args, **kwargs)
+            l1.delete(l1_key(args, kwargs))
+        
+        def cache_get_many(args_list: Sequence[Tuple]) -> List[Any]:
+            args_list = [tuple(args) for args in args_list]
+            values = [l1.get(args) for args in args_list]
+            missing = list(dict.fromkeys(args for args, value in zip(args_list, values) if value is MISSING))
+            if not missing:
+                return values
+            found = dict(zip(missing, persistent.cache_get_many(missing)))
+            hits = 0
+            for args, value in found.items():
+                if value is not None:
+                    l1.put(args, value)
+                    hits += 1
+            record_l2_lookups(hits=hits, misses=len(missing) - hits)
+            return [found[args] if value is MISSING else value for args, value in zip(args_list, values)]
+        
+        def cache_put_many(values: Sequence[Any], args_list: Sequence[Tuple]) -> None:
+            persistent.cache_put_many(values, args_list)
+            for value, args in zip(values, args_list):
+                l1.put(tuple(args), value)
+        
+        def get_many(args_list: Iterable[Tuple], executor: Executor = None) -> List[Any]:
+            return __get_many(args_list, cache_get_many, cache_put_many, compute_many, executor=executor)
+        
+        def load(args_list: Iterable[Tuple]) -> int:
+            args_list = iter(args_list)
+            loaded = 0
+            while not l1.is_full():
+                chunk = [tuple(args) for _, args in zip(range(L1_WARM_UP_CHUNK), args_list)]
+                if not chunk:
+                    break
+                for args, value in zip(chunk, persistent.cache_get_many(chunk)):
+                    if l1.is_full():
+                        break  # don't evict what was just loaded
+                    if value is not None:
+                        l1.put(args, value)
+                        loaded += 1
+            return loaded
+        
+        def tier_stats() -> Dict[str, Dict[str, int]]:
+            info = l1.cache_info()
+            return {
+                "l1": {"hits": info.hits, "misses": info.misses, "size": info.currsize, "bytes": l1.total_bytes},
+                "l2": dict(l2_stats),
+            }
+        
+        wrapper.cache_get = cache_get
+        wrapper.cache_put = cache_put
+        wrapper.cache_delete = cache_delete
+        wrapper.cache_get_many = cache_get_many
+        wrapper.cache_put_many = cache_put_many
+        wrapper.get_many = get_many
+        wrapper.flush = persistent.flush
+        wrapper.eviction_policy = persistent.eviction_policy
+        wrapper.single_flight = flight
+        wrapper.warm_up = load
+        wrapper.tier_stats = tier_stats
+        wrapper.persistent = persistent
+        wrapper.l1 = l1
+        # the L2 lookups are recorded by the persistent cache itself
+        METRICS.register_lru_cache(f"{func.__name__}:l1", l1)
+        
+        if warm_up is not None:
+            load(warm_up)
         return wrapper
     
     return decorator